@@ -5,3 +5,17 @@ from django.apps import AppConfig
 
 class OdkDashboardConfig(AppConfig):
     name = 'odk_dashboard'
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+        from vendor.models import RawSubmissions
+        from odk_dashboard.materialize import drop_table
+        from odk_dashboard.models import MaterializedView
+        from odk_dashboard.registry import parser_registry
+        from odk_dashboard.sync import index_saved_submission
+        parser_registry.setup()
+        # the table of a materialized view is dropped with the view, which is deleted with its saved view
+        post_delete.connect(drop_table, sender=MaterializedView, dispatch_uid='odk_dashboard.materialize.drop_table')
+        # the index of a raw submission is kept in step with every save of its raw data
+        post_save.connect(index_saved_submission, sender=RawSubmissions, dispatch_uid='odk_dashboard.sync.index_saved_submission')
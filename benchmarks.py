@@ -0,0 +1,366 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import resource
+import datetime
+import threading
+import subprocess
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from vendor.models import ODKForm, RawSubmissions
+
+
+SCALES = {'10k': 10000, '100k': 100000, '1m': 1000000}
+# the settings overridden for the run, passed on to the processes which measure the memory of the requests
+BENCHMARK_SETTINGS = ('ONADATA_URL', 'ONADATA_TOKEN', 'USE_DB_SETTINGS', 'ALLOWED_HOSTS')
+
+
+def synthetic_form(form_id, repeat_depth=3, no_selects=20, no_choices=50):
+    """
+    Build the json definition of a synthetic form with nested repeat groups and wide select questions
+    :param form_id: The ONA id of the form
+    :param repeat_depth: The number of repeat groups nested in each other
+    :param no_selects: The number of select questions at the top level of the form
+    :param no_choices: The number of choices of each select question
+    :return: The form definition in the format of the ONA form.json endpoint
+    """
+    choices = [{'name': 'opt_%d' % i, 'label': 'Option %d' % i} for i in range(no_choices)]
+    children = [
+        {'type': 'start', 'name': 'start'},
+        {'type': 'text', 'name': 'respondent', 'label': 'Respondent'},
+        {'type': 'integer', 'name': 'age', 'label': 'Age'},
+        {'type': 'geopoint', 'name': 'location', 'label': 'Location'},
+    ]
+    for i in range(no_selects):
+        children.append({'type': 'select one' if i % 2 == 0 else 'select all that apply', 'name': 'select_%d' % i, 'label': 'Select %d' % i, 'children': choices})
+
+    # the innermost repeat is built first and wrapped by each of its parents
+    repeat = None
+    for level in range(repeat_depth, 0, -1):
+        repeat_children = [
+            {'type': 'text', 'name': 'item_%d' % level, 'label': 'Item %d' % level},
+            {'type': 'decimal', 'name': 'amount_%d' % level, 'label': 'Amount %d' % level},
+        ]
+        if repeat is not None:
+            repeat_children.append(repeat)
+        repeat = {'type': 'repeat', 'name': 'repeat_%d' % level, 'label': 'Repeat %d' % level, 'children': repeat_children}
+    if repeat is not None:
+        children.append(repeat)
+
+    return {'id_string': 'bench_form_%d' % form_id, 'title': 'Benchmark Form %d' % form_id, 'name': 'bench_form_%d' % form_id, 'type': 'survey', 'children': children}
+
+
+def synthetic_submission(form, subm_id, rng, no_repeats=3):
+    """
+    Build a submission of a synthetic form, with its repeats as lists of instances the way ONA returns them
+    """
+    submitted = datetime.datetime(2020, 1, 1) + datetime.timedelta(minutes=subm_id)
+    subm = {
+        '_id': subm_id,
+        '_uuid': str(uuid.UUID(int=rng.getrandbits(128))),
+        '_submission_time': submitted.isoformat(),
+        '_date_modified': submitted.isoformat(),
+        '_geolocation': [rng.uniform(-4.5, 4.5), rng.uniform(34, 41)],
+        'start': submitted.isoformat(),
+        'respondent': 'Respondent %d' % subm_id,
+        'age': rng.randint(18, 90),
+        'location': '%f %f 0 0' % (rng.uniform(-4.5, 4.5), rng.uniform(34, 41)),
+    }
+
+    for child in form['children']:
+        if child['type'] == 'select one':
+            subm[child['name']] = rng.choice(child['children'])['name']
+        elif child['type'] == 'select all that apply':
+            subm[child['name']] = ' '.join(choice['name'] for choice in rng.sample(child['children'], 3))
+        elif child['type'] == 'repeat':
+            subm[child['name']] = synthetic_repeat(child, child['name'], rng, no_repeats)
+
+    return subm
+
+
+def synthetic_repeat(repeat, path, rng, no_repeats):
+    instances = []
+    for i in range(rng.randint(1, no_repeats)):
+        instance = {}
+        for child in repeat['children']:
+            child_path = '%s/%s' % (path, child['name'])
+            if child['type'] == 'repeat':
+                instance[child_path] = synthetic_repeat(child, child_path, rng, no_repeats)
+            elif child['type'] == 'decimal':
+                instance[child_path] = round(rng.uniform(0, 1000), 2)
+            else:
+                instance[child_path] = 'item %d' % i
+        instances.append(instance)
+    return instances
+
+
+def load_submissions(no_submissions, no_forms=1, seed=42, batch_size=5000):
+    """
+    Create the synthetic forms and save their submissions as raw submissions in the benchmark database
+    :return: A dict of the ONA form id to a tuple of the form definition and its submissions
+    """
+    if not is_benchmark_db():
+        raise Exception('The synthetic submissions are only loaded in the test database created for the benchmarks')
+
+    rng = random.Random(seed)
+    forms = {}
+    per_form = no_submissions // no_forms
+    for form_no in range(no_forms):
+        form_id = 900000 + form_no
+        form = synthetic_form(form_id)
+        (odk_form, is_created) = ODKForm.objects.get_or_create(form_id=form_id, defaults={'form_name': form['title']})
+        RawSubmissions.objects.filter(form=odk_form).delete()
+
+        submissions = []
+        batch = []
+        for i in range(per_form):
+            subm = synthetic_submission(form, form_no * per_form + i + 1, rng)
+            submissions.append(subm)
+            batch.append(RawSubmissions(form=odk_form, uuid=subm['_uuid'], submission_time=subm['_submission_time'], raw_data=subm))
+            if len(batch) == batch_size:
+                RawSubmissions.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            RawSubmissions.objects.bulk_create(batch)
+        forms[form_id] = (form, submissions)
+
+    return forms
+
+
+class StandInOnaHandler(BaseHTTPRequestHandler):
+    """
+    Answers the ONA API requests made by the dashboard from the synthetic forms
+    """
+    forms = {}
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        parts = [part for part in url.path.split('/') if part]
+
+        if parts == ['api', 'v1', 'forms']:
+            body = [{'formid': form_id, 'id_string': form['id_string'], 'title': form['title'], 'num_of_submissions': len(submissions)} for form_id, (form, submissions) in self.forms.items()]
+        elif parts[:3] == ['api', 'v1', 'forms'] and len(parts) == 5 and parts[4] == 'form.json':
+            body = self.forms[int(parts[3])][0]
+        elif parts[:3] == ['api', 'v1', 'data'] and len(parts) == 4:
+            submissions = self.forms[int(parts[3])][1]
+            page = int(params.get('page', ['1'])[0])
+            page_size = int(params.get('page_size', [str(len(submissions))])[0])
+            body = submissions[(page - 1) * page_size:page * page_size]
+            if page > 1 and len(body) == 0:
+                return self.send_json(404, {'detail': 'Invalid page.'})
+        else:
+            return self.send_json(404, {'detail': 'Not found.'})
+
+        self.send_json(200, body)
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in_ona(forms):
+    """
+    Start the stand-in ONA API in a background thread
+    :return: The server and its base url
+    """
+    handler = type('BenchOnaHandler', (StandInOnaHandler,), {'forms': forms})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return (server, 'http://127.0.0.1:%d' % server.server_address[1])
+
+
+def is_benchmark_db():
+    # the benchmarks replace the data of their forms, so they only run in the test database
+    return connection.settings_dict['NAME'] == connection.creation._get_test_db_name()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(int(round(pct / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure_request_rss():
+    """
+    Make a single request and print how much it grew the peak RSS of the process. Runs in a fresh process started by
+    request_rss_kb, with the request read from stdin
+    """
+    spec = json.loads(sys.stdin.read())
+    connection.settings_dict['NAME'] = spec['db_name']
+    client = Client()
+    client.force_login(get_user_model().objects.get(id=spec['user_id']))
+
+    with override_settings(**spec['settings']):
+        before = peak_rss_kb()
+        if spec['method'] == 'GET':
+            response = client.get(spec['path'], spec['data'])
+        elif spec['content_type'] is not None:
+            response = client.post(spec['path'], spec['data'], content_type=spec['content_type'])
+        else:
+            response = client.post(spec['path'], spec['data'])
+        # streamed responses are only produced as they are read
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        sys.stdout.write('\n' + json.dumps({'rss_delta_kb': peak_rss_kb() - before}))
+
+
+def request_rss_kb(user, method, path, data, content_type):
+    """
+    Measure the memory used by a request in a separate process, since the peak RSS of this process is reached while
+    loading the synthetic data
+    :return: The growth of the peak RSS in kilobytes, None when the database can't be shared with another process
+    """
+    if connection.vendor == 'sqlite' and connection.creation.is_in_memory_db(connection.settings_dict['NAME']):
+        return None
+
+    spec = {
+        'db_name': connection.settings_dict['NAME'],
+        'user_id': user.id,
+        'settings': dict((name, getattr(settings, name)) for name in BENCHMARK_SETTINGS),
+        'method': method,
+        'path': path,
+        'data': data,
+        'content_type': content_type
+    }
+    output = subprocess.run(
+        [sys.executable, '-c', 'import django; django.setup(); from odk_dashboard.benchmarks import measure_request_rss; measure_request_rss()'],
+        input=json.dumps(spec).encode('utf-8'), stdout=subprocess.PIPE, check=True, cwd=os.getcwd()
+    ).stdout.decode('utf-8')
+    return json.loads(output.strip().splitlines()[-1])['rss_delta_kb']
+
+
+def time_endpoint(client, user, name, method, path, data=None, content_type=None, repeats=5):
+    """
+    Time the requests to an endpoint
+    :return: A dict of the latency percentiles, query counts, response size and memory use of the endpoint
+    """
+    latencies = []
+    queries = []
+    status = None
+    size = 0
+    for i in range(repeats):
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            if method == 'GET':
+                response = client.get(path, data)
+            elif content_type is not None:
+                response = client.post(path, data, content_type=content_type)
+            else:
+                response = client.post(path, data)
+            # streamed responses are only produced as they are read
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+            latencies.append((time.perf_counter() - started) * 1000)
+        queries.append(len(captured.captured_queries))
+        status = response.status_code
+        size = len(content)
+
+    return {
+        'endpoint': name,
+        'status': status,
+        'repeats': repeats,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p90_ms': round(percentile(latencies, 90), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'max_ms': round(max(latencies), 2),
+        'queries': max(queries),
+        'response_bytes': size,
+        'rss_delta_kb': request_rss_kb(user, method, path, data, content_type)
+    }
+
+
+def benchmark_endpoints(form_ids, repeats=5):
+    """
+    Time the hot endpoints of the dashboard against the synthetic data
+    :param form_ids: The ONA ids of the synthetic forms, the first of which is used by the single form endpoints
+    :return: A list of the timings of each endpoint
+    """
+    # the bulk processing is limited to the submissions of the synthetic forms
+    db_form_ids = list(ODKForm.objects.filter(form_id__in=form_ids).values_list('id', flat=True))
+    export = json.dumps({'form_id': form_ids[0], 'format': 'csv', 'action': 'download', 'view_name': None})
+    grid = {'perPage': 25, 'offset': 0, 'page': 1}
+    endpoints = [
+        ('form_structure', 'GET', '/form_structure/', {'form_id': form_ids[0]}, None),
+        ('download_data', 'POST', '/get_data/', export, 'application/json'),
+        ('submissions_search', 'GET', '/submissions_search/', {'query': 'Respondent 1'}, None),
+        ('fetch_processing_errors', 'GET', '/fetch_processing_errors/', grid, None),
+        ('manual_data_process', 'POST', '/manual_data_process/', {'is_dry_run': 'true', 'bulk_load': 'true', 'form_ids': json.dumps(db_form_ids)}, None),
+    ]
+
+    client = Client()
+    user = get_user_model()(username='benchmark_user_%s' % uuid.uuid4().hex[:8], is_superuser=True, is_staff=True)
+    user.set_unusable_password()
+    user.save()
+    try:
+        client.force_login(user)
+        return [time_endpoint(client, user, name, method, path, data, content_type, repeats) for (name, method, path, data, content_type) in endpoints]
+    finally:
+        user.delete()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def run_benchmarks(scale='10k', no_forms=1, repeats=5, seed=42, keepdb=False):
+    """
+    Create the test database, load the synthetic data at the given scale, stand up the ONA API stand-in and time the
+    endpoints
+    :param keepdb: Whether to keep the test database between runs
+    :return: The results, ready to be dumped as json
+    """
+    no_submissions = SCALES[scale.lower()]
+    # the synthetic data never touches the configured database
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=keepdb)
+    try:
+        started = time.perf_counter()
+        forms = load_submissions(no_submissions, no_forms, seed)
+        load_seconds = time.perf_counter() - started
+
+        (server, ona_url) = start_stand_in_ona(forms)
+        try:
+            # the dashboard reads the ONA settings from the settings file for the duration of the run
+            with override_settings(ONADATA_URL=ona_url, ONADATA_TOKEN='benchmark', USE_DB_SETTINGS=False, ALLOWED_HOSTS=['*']):
+                results = benchmark_endpoints(list(forms.keys()), repeats)
+        finally:
+            server.shutdown()
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+
+    return {
+        'commit': git_commit(),
+        'scale': scale,
+        'no_submissions': no_submissions,
+        'no_forms': no_forms,
+        'seed': seed,
+        'load_seconds': round(load_seconds, 2),
+        'database': connection.vendor,
+        'ran_at': datetime.datetime.utcnow().isoformat(),
+        'endpoints': results
+    }
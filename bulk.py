@@ -0,0 +1,299 @@
+import json
+import time
+import logging
+import traceback
+
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, IntegrityError, connections, transaction
+from django.utils import timezone
+
+from vendor.models import ProcessingErrors, RawSubmissions
+
+from odk_dashboard.plans import mapping_plans
+
+# the error codes of the submissions which the bulk loader couldn't load, kept clear of the codes used by the parser
+ERR_INVALID_SUBMISSION = 101
+ERR_LOAD_FAILED = 102
+
+
+class TableStats(object):
+    def __init__(self):
+        self.rows = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    def as_dict(self):
+        return {
+            'rows': self.rows,
+            'batches': self.batches,
+            'seconds': round(self.seconds, 3),
+            'rows_per_second': round(self.rows / self.seconds, 1) if self.seconds else None
+        }
+
+
+def atomic_blocks(using):
+    # the raw submissions and the processing errors are in the default database, which may not be the destination
+    stack = ExitStack()
+    stack.enter_context(transaction.atomic(using=using))
+    if using != DEFAULT_DB_ALIAS:
+        stack.enter_context(transaction.atomic())
+    return stack
+
+
+class BulkLoader(object):
+    """
+    Buffers the rows for each destination table and writes them with multi-row inserts. Rows whose record identifier
+    is already in the table are skipped, and the foreign keys to the other mapped tables are resolved from the
+    identifier of the parent row to its key, looked up as the parent rows are written. The lookups and the row counts
+    are kept for the chunk of submissions being written, and only the counts are kept once the chunk is committed
+    """
+    def __init__(self, plan, using=None, batch_size=None):
+        self.plan = plan
+        self.using = using or getattr(settings, 'DEST_DB_ALIAS', 'default')
+        self.batch_size = batch_size or getattr(settings, 'BULK_LOAD_BATCH_SIZE', 1000)
+        self.connection = connections[self.using]
+        self.buffers = dict((table, []) for table in plan.table_order)
+        self.stats = dict((table, TableStats()) for table in plan.table_order)
+        # {(table, key column): {identifier: key}}
+        self.lookups = {}
+        self.chunk_counts = {}
+
+    def add(self, table_plan, row):
+        self.buffers[table_plan.name].append(row)
+        if len(self.buffers[table_plan.name]) >= self.batch_size:
+            # parent tables are written first so that their rows exist when the child rows reference them
+            for table in self.plan.table_order[:self.plan.table_order.index(table_plan.name) + 1]:
+                self.flush(self.plan.tables[table])
+
+    def select_keys(self, table, key_column, identifier_column, identifiers):
+        """
+        Get the keys of the rows of a table with the given identifiers
+        :return: A dict of the identifier, as a string, to the key
+        """
+        qn = self.connection.ops.quote_name
+        identifiers = list(identifiers)
+        keys = {}
+        for i in range(0, len(identifiers), self.batch_size):
+            batch = identifiers[i:i + self.batch_size]
+            with self.connection.cursor() as cursor:
+                cursor.execute('SELECT %s, %s FROM %s WHERE %s IN (%s)' % (qn(key_column), qn(identifier_column), qn(table), qn(identifier_column), ', '.join(['%s'] * len(batch))), batch)
+                for (key, identifier) in cursor.fetchall():
+                    keys[str(identifier)] = key
+        return keys
+
+    def resolve(self, table_plan, link, rows):
+        # parent rows written by an earlier run aren't in the lookups, so they are read from the table
+        lookup = self.lookups.setdefault((link.parent.name, link.ref_column), {})
+        missing = set(row[link.column] for row in rows if row.get(link.column) is not None and str(row[link.column]) not in lookup)
+        if missing:
+            lookup.update(self.select_keys(link.parent.name, link.ref_column, link.parent.identifier, missing))
+
+        for row in rows:
+            if row.get(link.column) is None:
+                continue
+            if str(row[link.column]) not in lookup:
+                raise IntegrityError("The record '%s' of %s referenced by %s.%s does not exist" % (row[link.column], link.parent.name, table_plan.name, link.column))
+            row[link.column] = lookup[str(row[link.column])]
+
+    def new_rows(self, table_plan, rows):
+        # without a unique key on the identifier, the identifiers of the batch are checked against the table
+        seen = set(self.select_keys(table_plan.name, table_plan.identifier, table_plan.identifier, set(row[table_plan.identifier] for row in rows if row.get(table_plan.identifier) is not None)))
+        new_rows = []
+        for row in rows:
+            identifier = row.get(table_plan.identifier)
+            if identifier is not None:
+                if str(identifier) in seen:
+                    continue
+                seen.add(str(identifier))
+            new_rows.append(row)
+        return new_rows
+
+    def insert(self, table_plan, rows):
+        columns = sorted(set(col for row in rows for col in row.keys()))
+        qn = self.connection.ops.quote_name
+        placeholders = '(%s)' % ', '.join(['%s'] * len(columns))
+        query = 'INSERT INTO %s (%s) VALUES %s' % (qn(table_plan.name), ', '.join(qn(col) for col in columns), ', '.join([placeholders] * len(rows)))
+        if table_plan.is_identifier_unique:
+            # rows which are already in the table are left as they are
+            if self.connection.vendor == 'mysql':
+                query = 'INSERT IGNORE' + query[len('INSERT'):]
+            else:
+                query += ' ON CONFLICT (%s) DO NOTHING' % qn(table_plan.identifier)
+        params = [row.get(col) for row in rows for col in columns]
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.rowcount if cursor.rowcount >= 0 else len(rows)
+
+    def flush(self, table_plan):
+        rows = self.buffers[table_plan.name]
+        if not rows:
+            return
+        self.buffers[table_plan.name] = []
+
+        started = time.time()
+        for link in table_plan.parents:
+            if link.by_key:
+                self.resolve(table_plan, link, rows)
+        if table_plan.identifier is not None and not table_plan.is_identifier_unique:
+            rows = self.new_rows(table_plan, rows)
+
+        if rows:
+            no_rows = self.insert(table_plan, rows)
+            counts = self.chunk_counts.setdefault(table_plan.name, [0, 0])
+            counts[0] += no_rows
+            counts[1] += 1
+            for key_column in table_plan.referenced_keys:
+                # the keys of the rows just written, and of those which were already there, for their child rows
+                lookup = self.lookups.setdefault((table_plan.name, key_column), {})
+                lookup.update(self.select_keys(table_plan.name, key_column, table_plan.identifier, set(row[table_plan.identifier] for row in rows if row.get(table_plan.identifier) is not None)))
+        self.stats[table_plan.name].seconds += time.time() - started
+
+    def flush_all(self):
+        for table in self.plan.table_order:
+            self.flush(self.plan.tables[table])
+
+    def commit(self):
+        for (table, (no_rows, no_batches)) in self.chunk_counts.items():
+            self.stats[table].rows += no_rows
+            self.stats[table].batches += no_batches
+        self.discard()
+
+    def discard(self):
+        # the keys of a rolled back chunk may belong to rows which no longer exist
+        self.buffers = dict((table, []) for table in self.plan.table_order)
+        self.lookups = {}
+        self.chunk_counts = {}
+
+    def table_stats(self):
+        return dict((table, stats.as_dict()) for table, stats in self.stats.items())
+
+
+def submission_data(raw_data):
+    # the raw data is saved as text by some of the sync paths
+    if isinstance(raw_data, (str, bytes)):
+        raw_data = json.loads(raw_data)
+    if not isinstance(raw_data, dict):
+        raise ValueError('The submission data is not a json object')
+    return raw_data
+
+
+def iter_chunks(submissions, chunk_size):
+    # the submissions are paged on their id, so the submissions which fail and stay unprocessed are not read again
+    last_id = 0
+    while True:
+        chunk = list(submissions.filter(id__gt=last_id).order_by('id').values_list('id', 'uuid', 'raw_data')[:chunk_size])
+        if len(chunk) == 0:
+            break
+        yield chunk
+        last_id = chunk[-1][0]
+
+
+def write_submissions(loader, prepared):
+    with atomic_blocks(loader.using):
+        for (submission_id, uuid, table_rows) in prepared:
+            for (table_plan, rows) in table_rows:
+                for row in rows:
+                    loader.add(table_plan, row)
+        loader.flush_all()
+        RawSubmissions.objects.filter(id__in=[submission[0] for submission in prepared]).update(is_processed=True)
+    loader.commit()
+
+
+def record_errors(errors):
+    # the failed submissions are kept with the processing errors, where they can be reviewed and reprocessed. The
+    # errors already recorded for a submission are updated and the new ones inserted, each with a single query
+    if not errors:
+        return
+    existing = ProcessingErrors.objects.filter(data_uuid__in=list(errors.keys()))
+    existing = dict((proc_error.data_uuid, proc_error) for proc_error in existing)
+    updated = []
+    created = []
+    for uuid, (err_code, message) in errors.items():
+        proc_error = existing.get(uuid) or ProcessingErrors(data_uuid=uuid)
+        proc_error.err_code = err_code
+        proc_error.err_message = message[:1000]
+        proc_error.is_resolved = False
+        (updated if proc_error.pk is not None else created).append(proc_error)
+
+    ProcessingErrors.objects.bulk_update(updated, ['err_code', 'err_message', 'is_resolved'])
+    ProcessingErrors.objects.bulk_create(created)
+
+
+def load_chunk(plan, loader, chunk, now):
+    """
+    Load a chunk of submissions in a single transaction. When the chunk fails its submissions are loaded one at a time,
+    so only the submissions which fail are recorded as errors
+    :return: A tuple of the number of loaded submissions and a dict of the uuid to the error code and message of each
+        submission which could not be loaded
+    """
+    errors = {}
+    prepared = []
+    for (submission_id, uuid, raw_data) in chunk:
+        try:
+            prepared.append((submission_id, uuid, plan.table_rows(submission_data(raw_data), now)))
+        except (ValueError, TypeError) as e:
+            errors[uuid] = (ERR_INVALID_SUBMISSION, str(e))
+
+    no_loaded = 0
+    try:
+        if prepared:
+            write_submissions(loader, prepared)
+        no_loaded = len(prepared)
+    except DatabaseError:
+        loader.discard()
+        for submission in prepared:
+            try:
+                write_submissions(loader, [submission])
+                no_loaded += 1
+            except DatabaseError as e:
+                loader.discard()
+                errors[submission[1]] = (ERR_LOAD_FAILED, str(e))
+
+    record_errors(errors)
+    return (no_loaded, errors)
+
+
+def bulk_process_submissions(parser, is_dry_run, submissions=None, using=None, batch_size=None):
+    """
+    Process the unprocessed raw submissions into the destination tables using the saved mappings. The submissions
+    are loaded in chunks, each in its own transaction, and marked as processed with their rows. A dry run loads all
+    the chunks in a single transaction which is rolled back at the end
+    :param parser: The OdkParser to use for compiling the mapping plan
+    :param is_dry_run: Whether to roll back the inserts after checking them
+    :param submissions: The RawSubmissions queryset to process, all the submissions when None
+    :param using: The database alias of the destination database
+    :param batch_size: The number of rows written in each insert
+    :return: A tuple of the success flag, comments and the throughput stats of each table
+    """
+    plan = mapping_plans.get(parser)
+    loader = BulkLoader(plan, using, batch_size)
+    submissions = RawSubmissions.objects.all() if submissions is None else submissions
+    submissions = submissions.filter(is_processed=False)
+    chunk_size = getattr(settings, 'BULK_LOAD_CHUNK_SIZE', 500)
+
+    now = timezone.now()
+    no_loaded = 0
+    no_failed = 0
+    try:
+        with (atomic_blocks(loader.using) if is_dry_run else ExitStack()):
+            for chunk in iter_chunks(submissions, chunk_size):
+                (no_chunk_loaded, errors) = load_chunk(plan, loader, chunk, now)
+                no_loaded += no_chunk_loaded
+                no_failed += len(errors)
+            if is_dry_run:
+                transaction.set_rollback(True, using=loader.using)
+                transaction.set_rollback(True)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        return (False, [{'type': 'danger', 'message': 'There was an error while loading the data: %s' % str(e)}], loader.table_stats())
+
+    stats = loader.table_stats()
+    comments = [{'type': 'info', 'message': '%d submissions were %s' % (no_loaded, 'checked' if is_dry_run else 'processed')}]
+    if no_failed:
+        comments.append({'type': 'warning', 'message': '%d submissions could not be loaded%s' % (no_failed, '' if is_dry_run else ' and were added to the processing errors')})
+    for table, table_stats in stats.items():
+        comments.append({'type': 'info', 'message': '%s: %d rows at %s rows/s' % (table, table_stats['rows'], table_stats['rows_per_second'])})
+    return (True, comments, stats)
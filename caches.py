@@ -0,0 +1,160 @@
+import json
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class FormStructureCache(object):
+    """
+    Caches the json structure of the forms together with an ETag of the structure. The cache keys include a version
+    which is bumped when the forms are refreshed from the server, so all the cached structures are dropped at once
+    """
+    version_key = 'odk_dashboard:form_structures_version'
+
+    def __init__(self):
+        self.timeout = getattr(settings, 'FORM_STRUCTURE_CACHE_TIMEOUT', None)
+
+    def version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            version = 1
+            cache.add(self.version_key, version, None)
+        return version
+
+    def key(self, form_id):
+        # the form id comes as a string from some requests and an int from others, both are the same form
+        return 'odk_dashboard:form_structure:%s:%d' % (self.version(), int(form_id))
+
+    def get(self, parser, form_id):
+        """
+        Get the structure of a form, building it with the parser if it is not cached
+        :param parser: The OdkParser to use for building the structure
+        :param form_id: The ONA id of the form
+        :return: A tuple of the structure and its ETag
+        """
+        cached = cache.get(self.key(form_id))
+        if cached is not None:
+            return (cached['structure'], cached['etag'])
+
+        return self.rebuild(parser, form_id)
+
+    def rebuild(self, parser, form_id):
+        """
+        Build the structure of a form with the parser and cache it
+        :return: A tuple of the structure and its ETag
+        """
+        structure = parser.get_form_structure_as_json(int(form_id))
+        etag = '"%s"' % hashlib.md5(json.dumps(structure, sort_keys=True).encode('utf-8')).hexdigest()
+        cache.set(self.key(form_id), {'structure': structure, 'etag': etag}, self.timeout)
+
+        return (structure, etag)
+
+    def etag(self, form_id):
+        cached = cache.get(self.key(form_id))
+        return None if cached is None else cached['etag']
+
+    def invalidate(self):
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.set(self.version_key, 2, None)
+
+
+form_structures = FormStructureCache()
+
+
+class SubmissionCache(object):
+    """
+    A size bounded LRU cache of the merged submissions shown in the record viewer, kept in each process. The entries
+    are keyed on the uuid of the submission and a hash of its raw data together with the version of the form
+    structures, so a submission re-synced from the server or a refreshed form is merged again
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes or getattr(settings, 'SUBMISSION_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.no_bytes = 0
+
+    def key(self, uuid, raw_data):
+        raw_hash = hashlib.md5(json.dumps(raw_data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return (uuid, raw_hash, form_structures.version())
+
+    def get(self, uuid, raw_data):
+        key = self.key(uuid, raw_data)
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, uuid, raw_data, merged):
+        key = self.key(uuid, raw_data)
+        size = len(json.dumps(merged, default=str))
+        with self.lock:
+            if key not in self.entries and size <= self.max_bytes:
+                self.entries[key] = (merged, size)
+                self.no_bytes += size
+            # the least recently used submissions are dropped until the cache is within its size
+            while self.no_bytes > self.max_bytes:
+                (old_key, (old_merged, old_size)) = self.entries.popitem(last=False)
+                self.no_bytes -= old_size
+
+    def get_or_merge(self, submission, neighbours, merge):
+        """
+        Get a merged submission, merging it if it is not cached. When the records next to it have been opened, ie the
+        user is clicking through the records, the ones which aren't cached are merged in the same call so they aren't
+        merged one at a time. A record opened on its own is merged alone
+        :param submission: A tuple of the uuid and raw data of the submission
+        :param neighbours: A list of the uuid and raw data tuples of the records next to the submission
+        :param merge: A callable which merges a list of uuids into a list of merged submissions
+        :return: The merged submission, None when the submission doesn't merge into a record
+        """
+        merged = self.get(*submission)
+        if merged is not None:
+            return merged
+
+        uncached = [(uuid, raw_data) for (uuid, raw_data) in neighbours if self.get(uuid, raw_data) is None]
+        if len(uncached) == len(neighbours):
+            uncached = []
+        merged = self.merge_batch(dict([submission] + uncached), submission[0], merge)
+        if merged is None and len(uncached) != 0:
+            # the records of the batch couldn't be told apart, eg a view without the _uuid column, so the submission
+            # is merged on its own
+            merged = self.merge_batch(dict([submission]), submission[0], merge)
+        return merged
+
+    def merge_batch(self, to_merge, uuid, merge):
+        """
+        Merge a batch of submissions and cache the records which can be matched to their submission
+        :param to_merge: A dict of the uuids of the submissions to merge to their raw data
+        :param uuid: The uuid of the requested submission
+        :return: The merged requested submission, None when it isn't among the records
+        """
+        rows = merge(list(to_merge.keys()))
+        if len(to_merge) == 1 and len(rows) == 1 and rows[0] and rows[0].get('_uuid') is None:
+            # a view without the _uuid column, the single record is the requested submission
+            rows = [dict(rows[0], _uuid=uuid)]
+        merged = None
+        for row in rows:
+            # empty merges are never cached, so a submission which failed to merge is merged again the next time
+            if row and row.get('_uuid') in to_merge:
+                self.put(row['_uuid'], to_merge[row['_uuid']], row)
+                if row['_uuid'] == uuid:
+                    merged = row
+        return merged
+
+    def invalidate(self, uuid=None):
+        """
+        Drop the cached copies of a submission, or of all the submissions when the uuid is not known
+        """
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if uuid is None or key[0] == uuid:
+                    self.no_bytes -= self.entries.pop(key)[1]
+
+
+submissions_cache = SubmissionCache()
@@ -0,0 +1,122 @@
+import logging
+import datetime
+import threading
+import traceback
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from odk_dashboard.models import FormCatalogue
+from odk_dashboard.registry import get_parser, parser_registry
+from odk_dashboard.sync import ona_api_settings, ona_timeout
+
+
+class FormCatalogueMirror(object):
+    """
+    Serves the list of forms from the local catalogue table. The catalogue is refreshed in a background thread when it
+    is older than FORM_CATALOGUE_REFRESH_INTERVAL, and the forms are only rebuilt when the ONA server reports a change
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.is_refreshing = False
+        self.is_force_pending = False
+
+    def catalogue(self):
+        (catalogue, is_created) = FormCatalogue.objects.get_or_create(name='default')
+        return catalogue
+
+    def get_all_forms(self, parser):
+        """
+        Get the list of forms, building it synchronously only when the catalogue has never been built
+        :param parser: The OdkParser to use for building the list of forms
+        :return: The list of forms, in the format of OdkParser.get_all_forms
+        """
+        catalogue = self.catalogue()
+        if catalogue.refreshed_at is None:
+            return self.refresh(parser, True, catalogue).forms
+
+        interval = datetime.timedelta(seconds=getattr(settings, 'FORM_CATALOGUE_REFRESH_INTERVAL', 300))
+        if catalogue.checked_at is None or timezone.now() - catalogue.checked_at > interval:
+            self.refresh_in_background()
+        return catalogue.forms
+
+    def upstream_changed(self, parser, catalogue):
+        """
+        Ask the ONA server whether its forms changed since the catalogue was built, using a conditional request
+        :return: Whether the forms changed
+        """
+        (ona_url, ona_token) = ona_api_settings(parser)
+        headers = {'Authorization': 'Token %s' % ona_token}
+        if catalogue.etag:
+            headers['If-None-Match'] = catalogue.etag
+        if catalogue.last_modified:
+            headers['If-Modified-Since'] = catalogue.last_modified
+
+        response = parser_registry.http_session.get('%s/api/v1/forms' % ona_url, headers=headers, timeout=ona_timeout())
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+
+        catalogue.etag = response.headers.get('ETag')
+        catalogue.last_modified = response.headers.get('Last-Modified')
+        # without validators from the server every check counts as a change
+        return True
+
+    def refresh(self, parser, force=False, catalogue=None):
+        """
+        Rebuild the list of forms if the ONA server reports a change
+        :param parser: The OdkParser to use for building the list of forms
+        :param force: Whether to rebuild the list even if the server reports no change
+        :param catalogue: The FormCatalogue to refresh, loaded when not given
+        :return: The refreshed FormCatalogue
+        """
+        catalogue = catalogue or self.catalogue()
+        try:
+            is_changed = self.upstream_changed(parser, catalogue)
+        except Exception:
+            # the list is still rebuilt when it is forced, eg after the forms were refreshed by the user
+            logging.error(traceback.format_exc())
+            is_changed = False
+
+        catalogue.checked_at = timezone.now()
+        if is_changed or force:
+            catalogue.forms = parser.get_all_forms()
+            catalogue.refreshed_at = catalogue.checked_at
+        catalogue.save()
+
+        return catalogue
+
+    def invalidate(self):
+        # the list is rebuilt on its next read, eg after the details of a form or group were changed locally
+        FormCatalogue.objects.filter(name='default').update(refreshed_at=None)
+
+    def refresh_in_background(self, force=False):
+        with self.lock:
+            if self.is_refreshing:
+                # a forced refresh requested during a running refresh is run once the running one finishes
+                self.is_force_pending = self.is_force_pending or force
+                return
+            self.is_refreshing = True
+
+        threading.Thread(target=self.run_refresh, args=(force,), name='form_catalogue', daemon=True).start()
+
+    def run_refresh(self, force):
+        try:
+            while True:
+                try:
+                    self.refresh(get_parser(), force)
+                except Exception:
+                    logging.error(traceback.format_exc())
+
+                with self.lock:
+                    if not self.is_force_pending:
+                        self.is_refreshing = False
+                        return
+                    self.is_force_pending = False
+                    force = True
+        finally:
+            connection.close()
+
+
+form_catalogue = FormCatalogueMirror()
@@ -0,0 +1,243 @@
+import os
+import json
+import shutil
+import zipfile
+import tempfile
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from datetime import datetime
+
+from django.conf import settings
+
+from odk_dashboard.exports import flatten_value, iter_merged_rows
+
+# formats which are written as typed arrow record batches
+COLUMNAR_FORMATS = {
+    'parquet': 'application/vnd.apache.parquet',
+    'feather': 'application/vnd.apache.arrow.file',
+}
+ZIP_CONTENT_TYPE = 'application/zip'
+
+
+def value_kind(value):
+    # bools are ints in python, so they are checked first
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int' if -2 ** 63 <= value < 2 ** 63 else 'string'
+    if isinstance(value, float):
+        return 'float'
+    return 'string'
+
+
+class ColumnType(object):
+    """
+    The type of a column, worked out from the values of all its rows. Columns with a mix of ints and floats are
+    floats, and any other mix is text. Text columns with few distinct values, such as the answers to select one
+    questions, are dictionary encoded, so their distinct values are counted up to the dictionary limit
+    """
+    def __init__(self, max_cardinality):
+        self.kind = None
+        self.max_cardinality = max_cardinality
+        self.distinct = set()
+
+    def add(self, value):
+        if value is None or value == '':
+            return
+        kind = value_kind(value)
+        if self.kind is None:
+            self.kind = kind
+        elif self.kind != kind:
+            self.kind = 'float' if set((self.kind, kind)) == set(('int', 'float')) else 'string'
+        if len(self.distinct) <= self.max_cardinality:
+            self.distinct.add(str(flatten_value(value)))
+
+    def field(self, name, no_rows):
+        if self.kind == 'bool':
+            return pa.field(name, pa.bool_())
+        if self.kind == 'int':
+            return pa.field(name, pa.int64())
+        if self.kind == 'float':
+            return pa.field(name, pa.float64())
+        if self.kind is not None and len(self.distinct) <= self.max_cardinality and len(self.distinct) * 10 <= no_rows:
+            return pa.field(name, pa.dictionary(pa.int32(), pa.string()))
+        return pa.field(name, pa.string())
+
+
+def convert_value(value, arrow_type):
+    # the types are worked out from every row, so a value which doesn't fit its column is a bug and fails the export
+    if value is None or value == '':
+        return None
+    if pa.types.is_boolean(arrow_type) and isinstance(value, bool):
+        return value
+    if pa.types.is_integer(arrow_type) and value_kind(value) == 'int':
+        return value
+    if pa.types.is_floating(arrow_type) and value_kind(value) in ('int', 'float'):
+        return float(value)
+    if pa.types.is_string(arrow_type):
+        value = flatten_value(value)
+        return value if isinstance(value, str) else str(value)
+    raise ValueError("The value %r doesn't fit the %s column type" % (value, arrow_type))
+
+
+class ColumnarTable(object):
+    """
+    Spools the rows of one output table to a temporary file while the type of each column is worked out from all the
+    rows, then writes them as record batches. Columns which only appear in later rows are part of the schema, and the
+    dictionaries of the encoded columns only grow so that every batch can be written as a dictionary delta
+    """
+    def __init__(self, name, path, d_format):
+        self.name = name
+        self.path = path
+        self.d_format = d_format
+        self.columns = {}
+        self.dictionaries = {}
+        self.spool = tempfile.TemporaryFile(mode='w+', dir=os.path.dirname(path))
+        self.no_rows = 0
+
+    def add(self, row):
+        for key, value in row.items():
+            if key not in self.columns:
+                self.columns[key] = ColumnType(getattr(settings, 'COLUMNAR_DICTIONARY_MAX_CARDINALITY', 1000))
+            self.columns[key].add(value)
+        self.spool.write(json.dumps(row, default=str) + '\n')
+        self.no_rows += 1
+
+    def column_array(self, field, values):
+        if pa.types.is_dictionary(field.type):
+            (index, dictionary) = self.dictionaries.setdefault(field.name, ({}, []))
+            indices = []
+            for value in values:
+                value = convert_value(value, pa.string())
+                if value is None:
+                    indices.append(None)
+                    continue
+                if value not in index:
+                    index[value] = len(dictionary)
+                    dictionary.append(value)
+                indices.append(index[value])
+            return pa.DictionaryArray.from_arrays(pa.array(indices, type=pa.int32()), pa.array(dictionary, type=pa.string()))
+
+        return pa.array([convert_value(value, field.type) for value in values], type=field.type)
+
+    def write_batch(self, writer, schema, rows):
+        arrays = [self.column_array(field, [row.get(field.name) for row in rows]) for field in schema]
+        batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+        if self.d_format == 'parquet':
+            writer.write_table(pa.Table.from_batches([batch], schema=schema))
+        else:
+            writer.write_batch(batch)
+
+    def close(self):
+        try:
+            schema = pa.schema([column.field(name, self.no_rows) for name, column in self.columns.items()])
+            if self.d_format == 'parquet':
+                writer = pq.ParquetWriter(self.path, schema, compression=getattr(settings, 'COLUMNAR_COMPRESSION', 'zstd'))
+            else:
+                writer = pa.ipc.new_file(self.path, schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+            try:
+                batch_size = getattr(settings, 'COLUMNAR_BATCH_SIZE', 10000)
+                self.spool.seek(0)
+                rows = []
+                for line in self.spool:
+                    rows.append(json.loads(line))
+                    if len(rows) >= batch_size:
+                        self.write_batch(writer, schema, rows)
+                        rows = []
+                if rows:
+                    self.write_batch(writer, schema, rows)
+            finally:
+                writer.close()
+        finally:
+            self.spool.close()
+
+
+def split_repeats(row, table_name, submission_uuid, parent_row_id, tables, row_ids):
+    """
+    Split a merged submission into the row of its table and the rows of its repeat groups. The rows of the repeats are
+    added to their own tables, linked to the submission by its uuid and to the instance of the parent repeat by its
+    row id
+    :param row_ids: The last row id given in each repeat table, shared by all the submissions of the export
+    :return: The row of the table without the repeats
+    """
+    flat_row = {}
+    for key, value in row.items():
+        if isinstance(value, list) and len(value) != 0 and all(isinstance(instance, dict) for instance in value):
+            child_name = '%s.%s' % (table_name, key.split('/')[-1])
+            for instance in value:
+                row_ids[child_name] = row_ids.get(child_name, 0) + 1
+                child_row = {'_submission_uuid': submission_uuid, '_row_id': row_ids[child_name], '_parent_row_id': parent_row_id}
+                child_row.update(split_repeats(instance, child_name, submission_uuid, row_ids[child_name], tables, row_ids))
+                tables.append((child_name, child_row))
+        else:
+            flat_row[key] = value
+    return flat_row
+
+
+def write_columnar_export(parser, form_id, nodes, d_format, filters=None, on_row=None, rows=None):
+    """
+    Write the submissions of a form as parquet or feather. The repeat groups are written as separate tables, and when
+    a form has repeats all the tables are sent together in a zip file
+    :param parser: The OdkParser to use for merging the submissions
+    :param form_id: The ONA id of the form
+    :param nodes: The selected nodes to include in the export
+    :param d_format: One of the COLUMNAR_FORMATS
+    :param filters: Any filters to apply to the submissions
+    :param on_row: An optional callback called with each merged submission
+    :param rows: The already merged submissions to write, eg from a materialized view, merged from the raw submissions
+        when None
+    :return: A tuple of the name of the written file and its content type
+    """
+    if pa is None:
+        raise Exception('The %s export needs pyarrow to be installed' % d_format)
+    if rows is None:
+        rows = iter_merged_rows(parser, form_id, nodes, filters, on_row=on_row)
+
+    export_dir = getattr(settings, 'EXPORT_JOB_DIR', tempfile.gettempdir())
+    base_name = 'Form%s_%s' % (form_id, datetime.now().strftime('%Y%m%d_%H%M%S'))
+    work_dir = tempfile.mkdtemp(prefix=base_name, dir=export_dir)
+    tables = {}
+    row_ids = {}
+
+    def table(name):
+        if name not in tables:
+            tables[name] = ColumnarTable(name, os.path.join(work_dir, '%s.%s' % (name, d_format)), d_format)
+        return tables[name]
+
+    try:
+        for row in rows:
+            child_rows = []
+            main_row = split_repeats(row, 'submissions', row.get('_uuid'), None, child_rows, row_ids)
+            table('submissions').add(main_row)
+            for (child_name, child_row) in child_rows:
+                table(child_name).add(child_row)
+
+        if len(tables) == 0:
+            raise Exception('There are no submissions to export')
+        for cur_table in tables.values():
+            cur_table.close()
+
+        if len(tables) == 1:
+            filename = os.path.join(export_dir, '%s.%s' % (base_name, d_format))
+            shutil.move(tables['submissions'].path, filename)
+            return (filename, COLUMNAR_FORMATS[d_format])
+
+        # the columnar files are already compressed, so they are only stored in the zip
+        filename = os.path.join(export_dir, '%s_%s.zip' % (base_name, d_format))
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_STORED) as zip_file:
+            for cur_table in tables.values():
+                zip_file.write(cur_table.path, os.path.basename(cur_table.path))
+            zip_file.writestr('manifest.json', json.dumps({
+                'form_id': form_id,
+                'format': d_format,
+                'tables': dict((name, {'rows': cur_table.no_rows, 'file': os.path.basename(cur_table.path)}) for name, cur_table in tables.items())
+            }, indent=2))
+        return (filename, ZIP_CONTENT_TYPE)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,95 @@
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from odk_dashboard.registry import get_parser
+
+
+class SettingsGateCache(object):
+    """
+    Records in the shared cache whether the first login and ONA settings checks have passed. Only a pass is remembered,
+    so that a failing gate is rechecked on every request until the settings are saved. The key includes a version which
+    is bumped when the settings are saved, so the gate is dropped in all the processes at once
+    """
+    version_key = 'odk_dashboard:settings_gate_version'
+
+    def version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            version = 1
+            cache.add(self.version_key, version, None)
+        return version
+
+    def key(self):
+        return 'odk_dashboard:settings_gate:%s' % self.version()
+
+    def invalidate(self):
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.set(self.version_key, 2, None)
+
+    def check(self):
+        """
+        Run the settings checks unless they have already passed
+        :return: A tuple of whether the settings are ok and the number of queries saved by the cache
+        """
+        key = self.key()
+        setup_queries = cache.get(key)
+        if setup_queries is not None:
+            return (True, setup_queries)
+
+        query_count = [0]
+
+        def count_queries(execute, sql, params, many, context):
+            query_count[0] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_queries):
+            parser = get_parser()
+            is_first_login = parser.is_first_login()
+            are_ona_settings_saved = parser.are_ona_settings_saved()
+
+        if is_first_login is True or are_ona_settings_saved is False:
+            return (False, 0)
+
+        cache.set(key, query_count[0], getattr(settings, 'SETTINGS_GATE_CACHE_TIMEOUT', None))
+        return (True, 0)
+
+
+settings_gate = SettingsGateCache()
+
+
+def invalidate_settings_gate():
+    settings_gate.invalidate()
+
+
+def ona_settings_required(view=None, db_settings_only=False):
+    """
+    Show the system settings page instead of the view if this is the first login or the ONA settings are not saved
+    :param view: The view being decorated
+    :param db_settings_only: Only check the settings when USE_DB_SETTINGS is enabled
+    :return: The decorated view
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if db_settings_only is True and not settings.USE_DB_SETTINGS:
+                return view_func(request, *args, **kwargs)
+
+            (is_ok, saved_queries) = settings_gate.check()
+            if is_ok is False:
+                from odk_dashboard.views import system_settings
+                return system_settings(request)
+
+            response = view_func(request, *args, **kwargs)
+            if settings.DEBUG:
+                response['X-Setup-Queries-Saved'] = saved_queries
+            return response
+        return wrapper
+
+    if view is not None:
+        return decorator(view)
+    return decorator
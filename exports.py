@@ -0,0 +1,281 @@
+import csv
+import json
+import uuid
+import base64
+import logging
+import datetime
+import itertools
+import traceback
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from vendor.models import RawSubmissions
+
+from odk_dashboard.caches import form_structures
+from odk_dashboard.models import SubmissionIndex
+from odk_dashboard.sync import index_missing_submissions
+
+# formats which are written row by row as the submissions are merged
+STREAMING_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+# the csv column of the values of the columns which were not in the header
+EXTRA_COLUMN = '_extra'
+
+
+class Echo(object):
+    """
+    A file like object which returns what is written to it, so that the csv writer can be used in a generator
+    """
+    def write(self, value):
+        return value
+
+
+def iter_submission_uuids(form_id, batch_size=None):
+    """
+    Get the uuids of the locally saved submissions of a form in batches
+    :param form_id: The ONA id of the form
+    :param batch_size: The number of uuids in each batch
+    :return: A generator of uuid lists
+    """
+    batch_size = batch_size or getattr(settings, 'EXPORT_BATCH_SIZE', 500)
+    uuids = RawSubmissions.objects.filter(form__form_id=form_id).order_by('id').values_list('uuid', flat=True)
+
+    batch = []
+    for uuid in uuids.iterator(chunk_size=batch_size):
+        batch.append(uuid)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if len(batch) != 0:
+        yield batch
+
+
+def iter_merged_rows(parser, form_id, nodes, filters=None, batch_size=None, on_row=None, uuid_batches=None):
+    """
+    Merge the submissions of a form a batch at a time, so that only one batch is held in memory
+    :param parser: The OdkParser to use for merging the submissions
+    :param form_id: The ONA id of the form
+    :param nodes: The selected nodes to include in the export
+    :param filters: Any filters to apply to the submissions
+    :param batch_size: The number of submissions to merge at a time
+    :param on_row: An optional callback called with each merged submission, used for reporting progress
+    :param uuid_batches: The batches of the submissions to merge, all the submissions of the form when None
+    :return: A generator of merged submissions
+    """
+    if uuid_batches is None:
+        uuid_batches = iter_submission_uuids(form_id, batch_size)
+    for uuids in uuid_batches:
+        # form_id, nodes, d_format, download_type, view_name, uuids=None, update_local_data=True, is_dry_run=True
+        merged = parser.fetch_merge_data(form_id, nodes, 'json', 'submissions', None, uuids, False, settings.IS_DRY_RUN, filters)
+        for row in merged:
+            if on_row is not None:
+                on_row(row)
+            yield row
+
+
+def flatten_value(value):
+    # nested repeats and groups are written as json in the flat formats
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def export_columns(parser, form_id, nodes=None):
+    """
+    Get the columns of an export from the form structure, so the csv header can be written before any submission is
+    merged. The columns are the selected questions and repeats, in the order of the form, the questions inside the
+    repeats being part of their repeat's column
+    :param parser: The OdkParser to use for building the structure
+    :param form_id: The ONA id of the form
+    :param nodes: The names of the selected nodes, all the nodes of the form when None
+    :return: A list of the column names, empty when the structure can't be built
+    """
+    try:
+        (structure, etag) = form_structures.get(parser, form_id)
+    except Exception:
+        logging.error(traceback.format_exc())
+        return []
+
+    selected = None if nodes is None else set(nodes)
+    parents = dict((node['id'], node) for node in structure)
+    parent_ids = set(node.get('parent_id') for node in structure)
+    columns = []
+    for node in structure:
+        if selected is not None and node['name'] not in selected:
+            continue
+        # the nodes inside a repeat are written in the column of the repeat
+        parent = parents.get(node.get('parent_id'))
+        in_repeat = False
+        while parent is not None and not in_repeat:
+            in_repeat = parent.get('type') == 'repeat'
+            parent = parents.get(parent.get('parent_id'))
+        if in_repeat:
+            continue
+        if node.get('type') == 'repeat' or node['id'] not in parent_ids:
+            columns.append(node['name'])
+    return columns
+
+
+def csv_stream(rows, columns=None):
+    """
+    Write the merged submissions as csv, each row as soon as it is merged. The header has the given columns, eg from
+    the form structure, followed by the columns of the first submission. The columns which only appear in later
+    submissions are written as json in the last column, _extra, so nothing has to be held back for the header
+    :param rows: A generator of merged submissions
+    :param columns: The columns known before the submissions are merged
+    :return: A generator of csv lines
+    """
+    writer = csv.writer(Echo())
+    rows = iter(rows)
+    first_row = next(rows, None)
+    header = list(dict.fromkeys(list(columns or []) + (list(first_row.keys()) if first_row is not None else [])))
+    known = set(header)
+
+    yield writer.writerow(header + [EXTRA_COLUMN])
+    if first_row is None:
+        return
+    for row in itertools.chain([first_row], rows):
+        extra = dict((key, value) for key, value in row.items() if key not in known)
+        yield writer.writerow([flatten_value(row.get(col)) for col in header] + [json.dumps(extra, default=str) if extra else None])
+
+
+def ndjson_stream(rows):
+    """
+    Write the merged submissions as newline delimited json
+    :param rows: A generator of merged submissions
+    :return: A generator of json lines
+    """
+    for row in rows:
+        yield json.dumps(row, default=str) + '\n'
+
+
+def stream_export(parser, form_id, nodes, d_format, filters=None, on_row=None, rows=None):
+    """
+    Get a generator which writes the submissions of a form in the specified streaming format
+    :param parser: The OdkParser to use for merging the submissions
+    :param form_id: The ONA id of the form
+    :param nodes: The selected nodes to include in the export
+    :param d_format: One of the STREAMING_FORMATS
+    :param filters: Any filters to apply to the submissions
+    :param on_row: An optional callback called with each merged submission
+    :param rows: The already merged submissions to write, eg from a materialized view, merged from the raw submissions
+        when None
+    :return: A tuple of the generator and the name of the file to send it as
+    """
+    filename = 'Form%s_%s.%s' % (form_id, datetime.datetime.now().strftime('%Y%m%d_%H%M%S'), d_format)
+    # the rows of a view have the columns of the view rather than of the form
+    columns = None
+    if rows is None:
+        rows = iter_merged_rows(parser, form_id, nodes, filters, on_row=on_row)
+        columns = export_columns(parser, form_id, nodes) if d_format == 'csv' else None
+    if d_format == 'csv':
+        return (csv_stream(rows, columns), filename)
+
+    return (ndjson_stream(rows), filename)
+
+
+def encode_cursor(modified, uuid):
+    return base64.urlsafe_b64encode(json.dumps({'modified': modified.isoformat(), 'uuid': uuid}).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Get the position in a form's submissions from a cursor of a previous delta export
+    :param cursor: The cursor, empty or None to start from the first submission
+    :return: A tuple of the modification time and uuid of the last exported submission, or None
+    """
+    if not cursor:
+        return None
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        modified = parse_datetime(position['modified'])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("The cursor '%s' is not valid" % cursor)
+    if modified is None:
+        raise ValueError("The cursor '%s' is not valid" % cursor)
+    # the cursors given before the times were indexed have the ONA times, which are in UTC without the offset
+    if timezone.is_naive(modified):
+        modified = timezone.make_aware(modified, datetime.timezone.utc)
+    return (modified, position['uuid'])
+
+
+def delta_submissions(form_id, cursor=None, limit=None):
+    """
+    Get the submissions of a form which were added or edited after a cursor, in the order they were last modified
+    :param form_id: The ONA id of the form
+    :param cursor: The cursor returned by the previous delta export, None for all the submissions
+    :param limit: The maximum number of submissions in the delta
+    :return: A tuple of the uuids of the submissions and the cursor of the last one, the given cursor when there are none
+    """
+    limit = limit or getattr(settings, 'DELTA_EXPORT_MAX_SUBMISSIONS', 100000)
+    index_missing_submissions(form_id)
+    # the indexed time the submission was last edited on the ONA server, with the uuid to order the same times
+    submissions = SubmissionIndex.objects.filter(form__form_id=form_id)
+    position = decode_cursor(cursor)
+    if position is not None:
+        (modified, uuid) = position
+        submissions = submissions.filter(Q(modified__gt=modified) | Q(modified=modified, uuid__gt=uuid))
+
+    delta = list(submissions.order_by('modified', 'uuid').values_list('modified', 'uuid')[:limit])
+    if len(delta) == 0:
+        return ([], cursor or None)
+    return ([uuid for (modified, uuid) in delta], encode_cursor(delta[-1][0], delta[-1][1]))
+
+
+def delta_export(parser, form_id, nodes, d_format, cursor=None, filters=None, on_row=None):
+    """
+    Get a generator which writes the submissions added or edited since a cursor in a streaming format, together with
+    a manifest which tells the client how to apply the delta to what it already has
+    :param parser: The OdkParser to use for merging the submissions
+    :param form_id: The ONA id of the form
+    :param nodes: The selected nodes to include in the export
+    :param d_format: One of the STREAMING_FORMATS
+    :param cursor: The cursor returned by the previous delta export, None for a full export
+    :param filters: Any filters to apply to the submissions
+    :param on_row: An optional callback called with each merged submission
+    :return: A tuple of the generator, the name of the file to send it as and the manifest
+    """
+    batch_size = getattr(settings, 'EXPORT_BATCH_SIZE', 500)
+    (uuids, next_cursor) = delta_submissions(form_id, cursor)
+    uuid_batches = (uuids[i:i + batch_size] for i in range(0, len(uuids), batch_size))
+    rows = iter_merged_rows(parser, form_id, nodes, filters, on_row=on_row, uuid_batches=uuid_batches)
+
+    filename = 'Form%s_delta_%s.%s' % (form_id, datetime.datetime.now().strftime('%Y%m%d_%H%M%S'), d_format)
+    manifest = {
+        'form_id': form_id,
+        'format': d_format,
+        'since': cursor or None,
+        'next_cursor': next_cursor,
+        'no_submissions': len(uuids),
+        # the rows replace any rows already exported with the same uuid, a full export replaces everything
+        'mode': 'full' if not cursor else 'upsert',
+        'key': '_uuid',
+        'is_complete': len(uuids) < getattr(settings, 'DELTA_EXPORT_MAX_SUBMISSIONS', 100000),
+        'generated_at': datetime.datetime.now().isoformat()
+    }
+    if d_format == 'csv':
+        return (csv_stream(rows, export_columns(parser, form_id, nodes)), filename, manifest)
+
+    return (ndjson_stream(rows), filename, manifest)
+
+
+def save_manifest(manifest):
+    """
+    Keep the manifest of a delta export for its client to fetch next to the export, since it can be too large for a
+    response header
+    :return: The id of the saved manifest
+    """
+    manifest_id = uuid.uuid4().hex
+    cache.set('odk_dashboard:export_manifest:%s' % manifest_id, manifest, getattr(settings, 'EXPORT_JOB_TTL', 3600))
+    return manifest_id
+
+
+def get_manifest(manifest_id):
+    return cache.get('odk_dashboard:export_manifest:%s' % manifest_id)
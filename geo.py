@@ -0,0 +1,377 @@
+import os
+import json
+import math
+import tempfile
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Avg, Count, Max, Min
+from django.db.models.functions import Substr
+
+from odk_dashboard.models import SubmissionIndex
+from odk_dashboard.utilities import json_dumps
+
+try:
+    import shapely
+    from shapely.geometry import shape, mapping
+    # STRtree.query takes a predicate, and returns indices instead of geometries, since shapely 2
+    HAS_SHAPELY_2 = int(shapely.__version__.split('.')[0]) >= 2
+except ImportError:
+    shape = None
+    HAS_SHAPELY_2 = False
+
+
+def zoom_tolerance(zoom):
+    """
+    Get the simplification tolerance in degrees for a zoom level, about a pixel of a 256px web mercator tile
+    """
+    return 360.0 / (256 * 2 ** zoom) * getattr(settings, 'GEOMETRY_PIXEL_TOLERANCE', 1.0)
+
+
+def zoom_precision(zoom):
+    # the number of decimals needed to place a point to within a pixel at this zoom level
+    return max(int(math.ceil(-math.log10(zoom_tolerance(zoom)))), 0)
+
+
+def perpendicular_distance(point, start, end):
+    if start == end:
+        return math.hypot(point[0] - start[0], point[1] - start[1])
+
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    return abs(dy * point[0] - dx * point[1] + end[0] * start[1] - end[1] * start[0]) / math.hypot(dx, dy)
+
+
+def douglas_peucker(points, tolerance):
+    """
+    Simplify a line with the Douglas-Peucker algorithm
+    :param points: A list of [lon, lat] points
+    :param tolerance: The maximum distance, in degrees, a dropped point can be from the simplified line
+    :return: The simplified list of points
+    """
+    if len(points) < 3:
+        return points
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        (first, last) = stack.pop()
+        max_dist = 0
+        index = first
+        for i in range(first + 1, last):
+            dist = perpendicular_distance(points[i], points[first], points[last])
+            if dist > max_dist:
+                max_dist = dist
+                index = i
+        if max_dist > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return [point for point, is_kept in zip(points, keep) if is_kept]
+
+
+def simplify_ring(ring, tolerance, precision):
+    simplified = douglas_peucker(ring, tolerance)
+    simplified = [[round(point[0], precision), round(point[1], precision)] for point in simplified]
+    # a ring needs at least 4 points, the first and last being the same
+    if len(simplified) < 4:
+        return None
+    return simplified
+
+
+def simplify_polygon(rings, tolerance, precision):
+    simplified = []
+    for i, ring in enumerate(rings):
+        s_ring = simplify_ring(ring, tolerance, precision)
+        if s_ring is None:
+            if i == 0:
+                # keep the outer ring of tiny polygons so that no area disappears from the map
+                s_ring = [[round(point[0], precision), round(point[1], precision)] for point in ring]
+            else:
+                # holes smaller than the tolerance are dropped
+                continue
+        simplified.append(s_ring)
+    return simplified
+
+
+def simplify_geometry(geometry, zoom):
+    """
+    Simplify and quantise a GeoJSON geometry for a zoom level
+    :param geometry: A GeoJSON Polygon or MultiPolygon
+    :param zoom: The web map zoom level
+    :return: The simplified geometry
+    """
+    tolerance = zoom_tolerance(zoom)
+    precision = zoom_precision(zoom)
+
+    if shape is not None:
+        # shapely keeps the simplified rings valid and non self intersecting
+        geometry = mapping(shape(geometry).simplify(tolerance, preserve_topology=True))
+        geometry = json.loads(json.dumps(geometry))
+        if geometry['type'] == 'Polygon':
+            geometry['coordinates'] = [[[round(point[0], precision), round(point[1], precision)] for point in ring] for ring in geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            geometry['coordinates'] = [[[[round(point[0], precision), round(point[1], precision)] for point in ring] for ring in polygon] for polygon in geometry['coordinates']]
+        return geometry
+
+    if geometry['type'] == 'Polygon':
+        return {'type': 'Polygon', 'coordinates': simplify_polygon(geometry['coordinates'], tolerance, precision)}
+    if geometry['type'] == 'MultiPolygon':
+        return {'type': 'MultiPolygon', 'coordinates': [simplify_polygon(polygon, tolerance, precision) for polygon in geometry['coordinates']]}
+    return geometry
+
+
+def simplify_region(region, zoom):
+    # the polygon of a region can be saved as a geojson string, a geometry or a feature
+    polygon = region['polygon']
+    if isinstance(polygon, str):
+        polygon = json.loads(polygon)
+
+    if polygon.get('type') == 'Feature':
+        polygon = dict(polygon, geometry=simplify_geometry(polygon['geometry'], zoom))
+    else:
+        polygon = simplify_geometry(polygon, zoom)
+
+    return dict(region, polygon=polygon)
+
+
+def cache_path(c_code, zoom):
+    cache_dir = getattr(settings, 'GEOMETRY_CACHE_DIR', os.path.join(settings.MEDIA_ROOT, 'geometry_cache'))
+    return os.path.join(cache_dir, 'first_level_%s_v%s_z%d.json' % (c_code, getattr(settings, 'GEOMETRY_CACHE_VERSION', 1), zoom))
+
+
+def first_level_geojson(parser, c_code, zoom):
+    """
+    Get the first level regions of a country simplified for a zoom level, as serialised json. The simplified regions
+    are cached on disk, so each country and zoom level is only simplified once
+    :param parser: The OdkParser to use for fetching the full resolution regions
+    :param c_code: The country code
+    :param zoom: The web map zoom level
+    :return: The json bytes of the simplified regions
+    """
+    zoom = min(max(int(zoom), 0), getattr(settings, 'GEOMETRY_MAX_ZOOM', 14))
+    path = cache_path(c_code, zoom)
+    if os.path.exists(path):
+        with open(path, 'rb') as in_file:
+            return in_file.read()
+
+    regions = [simplify_region(region, zoom) for region in parser.first_level_geojson(c_code)]
+    body = json_dumps(regions)
+
+    # write to a temporary file first so that a concurrent request never reads a partly written file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as out_file:
+        out_file.write(body)
+    os.replace(tmp_path, path)
+
+    return body
+
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+# the precision of the indexed geohashes, the finest cells the points can be aggregated into
+GEOHASH_PRECISION = 9
+
+
+def geohash_encode(lat, lon, precision):
+    """
+    Encode a point as a geohash
+    :param lat: The latitude of the point
+    :param lon: The longitude of the point
+    :param precision: The number of characters of the geohash
+    :return: The geohash of the point
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    is_lon = True
+    while len(geohash) < precision:
+        (cur_range, value) = (lon_range, lon) if is_lon else (lat_range, lat)
+        mid = (cur_range[0] + cur_range[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            cur_range[0] = mid
+        else:
+            bits = bits << 1
+            cur_range[1] = mid
+        is_lon = not is_lon
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(geohash)
+
+
+def location_value(value, limit):
+    # a coordinate out of the raw json, None when it is missing, not a number or out of range
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(value) or not -limit <= value <= limit:
+        return None
+    return value
+
+
+def submission_location(raw_data):
+    """
+    Get the GPS point of a submission
+    :param raw_data: The raw data of the submission
+    :return: A (lat, lon) tuple, None when the submission has no valid point
+    """
+    location = raw_data.get(getattr(settings, 'SUBMISSION_GEO_FIELD', '_geolocation'))
+    if isinstance(location, str):
+        # an ODK geopoint saved as 'lat lon alt accuracy'
+        location = location.split()
+    if not isinstance(location, (list, tuple)) or len(location) < 2:
+        return None
+
+    (lat, lon) = (location_value(location[0], 90), location_value(location[1], 180))
+    if lat is None or lon is None:
+        return None
+    return (lat, lon)
+
+
+def zoom_geohash_precision(zoom):
+    # the geohash precision whose cells are a few dozen pixels across at this zoom level
+    return min(max(int(round((float(zoom) + 2) * 2 / 5.0)), 1), GEOHASH_PRECISION)
+
+
+def isoformat(s_time):
+    return s_time.isoformat() if s_time is not None else None
+
+
+def summarise_cell(cell_points):
+    times = [s_time for (lat, lon, s_time) in cell_points if s_time is not None]
+    return {
+        'count': len(cell_points),
+        'lat': round(sum(lat for (lat, lon, s_time) in cell_points) / len(cell_points), 6),
+        'lng': round(sum(lon for (lat, lon, s_time) in cell_points) / len(cell_points), 6),
+        'first_submission': isoformat(min(times)) if times else None,
+        'last_submission': isoformat(max(times)) if times else None
+    }
+
+
+def aggregate_by_geohash(form_id, precision):
+    """
+    Bin the indexed points of a form into geohash cells. The cells are the prefixes of the indexed geohashes, so the
+    points are grouped and summarised by the database
+    :param form_id: The ONA id of the form
+    :param precision: The geohash precision of the cells, 1 to 9
+    :return: A list of cells with their counts and summary stats
+    """
+    cells = SubmissionIndex.objects.filter(form__form_id=form_id, geohash__isnull=False) \
+        .annotate(cell=Substr('geohash', 1, precision)).values('cell') \
+        .annotate(count=Count('id'), lat=Avg('lat'), lng=Avg('lon'), first_submission=Min('submitted'), last_submission=Max('submitted')) \
+        .order_by()
+
+    return [{
+        'cell': cell['cell'],
+        'count': cell['count'],
+        'lat': round(cell['lat'], 6),
+        'lng': round(cell['lng'], 6),
+        'first_submission': isoformat(cell['first_submission']),
+        'last_submission': isoformat(cell['last_submission'])
+    } for cell in cells]
+
+
+def point_in_ring(lon, lat, ring):
+    is_inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        (xi, yi) = (ring[i][0], ring[i][1])
+        (xj, yj) = (ring[j][0], ring[j][1])
+        if (yi > lat) != (yj > lat) and lon < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+            is_inside = not is_inside
+        j = i
+    return is_inside
+
+
+def point_in_geometry(lon, lat, geometry):
+    polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+    for rings in polygons:
+        if point_in_ring(lon, lat, rings[0]) and not any(point_in_ring(lon, lat, hole) for hole in rings[1:]):
+            return True
+    return False
+
+
+def region_geometry(region):
+    polygon = region['polygon']
+    if isinstance(polygon, str):
+        polygon = json.loads(polygon)
+    return polygon['geometry'] if polygon.get('type') == 'Feature' else polygon
+
+
+def geometry_bbox(geometry):
+    polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+    lons = [point[0] for rings in polygons for point in rings[0]]
+    lats = [point[1] for rings in polygons for point in rings[0]]
+    return (min(lons), min(lats), max(lons), max(lats))
+
+
+def aggregate_by_region(form_id, regions):
+    """
+    Bin the indexed points of a form into the administrative regions. The candidate regions of each point are found
+    through an STR-tree when shapely 2 is installed, otherwise through the bounding boxes of the regions
+    :param form_id: The ONA id of the form
+    :param regions: The first level regions as returned by the parser
+    :return: A list of regions with their counts and summary stats
+    """
+    points = SubmissionIndex.objects.filter(form__form_id=form_id, lat__isnull=False, lon__isnull=False).values_list('lat', 'lon', 'submitted')
+    geometries = [region_geometry(region) for region in regions]
+    cells = {}
+
+    if HAS_SHAPELY_2:
+        from shapely.geometry import Point
+        from shapely.strtree import STRtree
+        shapes = [shape(geometry) for geometry in geometries]
+        tree = STRtree(shapes)
+        for point in points.iterator():
+            s_point = Point(point[1], point[0])
+            for index in tree.query(s_point, predicate='intersects'):
+                cells.setdefault(int(index), []).append(point)
+                break
+    else:
+        bboxes = [geometry_bbox(geometry) for geometry in geometries]
+        for point in points.iterator():
+            (lat, lon) = (point[0], point[1])
+            for index, bbox in enumerate(bboxes):
+                if bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3] and point_in_geometry(lon, lat, geometries[index]):
+                    cells.setdefault(index, []).append(point)
+                    break
+
+    return [dict(summarise_cell(cell_points), cell=regions[index].get('c_code', index)) for index, cell_points in cells.items()]
+
+
+def submission_aggregates(parser, form_id, by='geohash', precision=5, c_code=None):
+    """
+    Aggregate the indexed GPS points of a form's submissions into geohash cells or administrative regions. The
+    aggregates are cached per form until its submissions are synced or edited
+    :param parser: The OdkParser to use for fetching the regions
+    :param form_id: The ONA id of the form
+    :param by: 'geohash' or 'region'
+    :param precision: The geohash precision when aggregating by geohash
+    :param c_code: The country code of the regions when aggregating by region
+    :return: A list of cells with their counts and summary stats
+    """
+    # the index changes with every synced submission, and every edit moves the latest modified time
+    state = SubmissionIndex.objects.filter(form__form_id=form_id).aggregate(modified=Max('modified'), count=Count('id'))
+    modified = state['modified'].isoformat() if state['modified'] is not None else None
+    key = 'odk_dashboard:map_aggregates:%s:%s:%s:%s:%s' % (form_id, modified, state['count'], by, c_code if by == 'region' else precision)
+    cells = cache.get(key)
+    if cells is not None:
+        return cells
+
+    if by == 'region':
+        cells = aggregate_by_region(form_id, parser.first_level_geojson(c_code))
+    else:
+        cells = aggregate_by_geohash(form_id, min(max(int(precision), 1), GEOHASH_PRECISION))
+
+    cache.set(key, cells, getattr(settings, 'MAP_AGGREGATES_CACHE_TIMEOUT', None))
+    return cells
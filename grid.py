@@ -0,0 +1,178 @@
+import json
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+
+from vendor.models import ProcessingErrors
+
+
+class GridParams(object):
+    """
+    The paging, sorting and filtering parameters sent by dynatable, with the page size capped so that a single request
+    can't ask for an unbounded number of rows, and the key of the last row of the previous page when the grid sends it
+    back for seek pagination
+    """
+    def __init__(self, request):
+        max_per_page = getattr(settings, 'GRID_MAX_PER_PAGE', 100)
+
+        self.per_page = min(max(int(json.loads(request.GET['perPage'])), 1), max_per_page)
+        self.offset = max(int(json.loads(request.GET['offset'])), 0)
+        self.cur_page = self.offset // self.per_page + 1
+        self.sorts = json.loads(request.GET['sorts']) if 'sorts' in request.GET else None
+        self.queries = json.loads(request.GET['queries']) if 'queries' in request.GET else None
+        self.after = json.loads(request.GET['after']) if request.GET.get('after') else None
+
+    def as_args(self):
+        return (self.cur_page, self.per_page, self.offset, self.sorts, self.queries)
+
+    def sort(self, columns, default='id'):
+        """
+        Get the column and direction to sort on, only the indexed columns of the grid can be sorted on
+        :param columns: The columns which can be sorted on
+        :return: A tuple of the column and whether it is sorted in descending order
+        """
+        for column, direction in (self.sorts or {}).items():
+            if column in columns:
+                return (column, int(direction) < 0)
+        return (default, False)
+
+    def cache_key(self, grid_name):
+        params = json.dumps([self.per_page, self.offset, self.sorts, self.queries, self.after], sort_keys=True)
+        return 'odk_dashboard:grid:%s:%s:%s' % (grid_name, grid_version(grid_name), hashlib.md5(params.encode('utf-8')).hexdigest())
+
+
+def grid_version(grid_name):
+    version = cache.get('odk_dashboard:grid_version:%s' % grid_name)
+    return 1 if version is None else version
+
+
+def invalidate_grid(grid_name):
+    key = 'odk_dashboard:grid_version:%s' % grid_name
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 2, None)
+
+
+def fetch_grid_page(grid_name, params, fetch_page):
+    """
+    Get a page of a grid, reusing a recently fetched copy of the same page
+    :param grid_name: The name of the grid, used for the cache key and invalidation
+    :param params: The GridParams of the request
+    :param fetch_page: A callable which takes the grid arguments and returns a tuple of the success flag and the page
+    :return: The page in the dynatable format
+    """
+    key = params.cache_key(grid_name)
+    page = cache.get(key)
+    if page is not None:
+        return page
+
+    (is_success, page) = fetch_page(*params.as_args())
+    if is_success is not False:
+        cache.set(key, page, getattr(settings, 'GRID_CACHE_TIMEOUT', 30))
+
+    return page
+
+
+def estimated_count(model):
+    """
+    Get the number of rows of a table, from the planner statistics on postgres so that a table with millions of rows
+    isn't counted on every page. Small tables, whose statistics may not have been gathered yet, are counted exactly
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [connection.ops.quote_name(model._meta.db_table)])
+            row = cursor.fetchone()
+        if row is not None and row[0] >= getattr(settings, 'GRID_EXACT_COUNT_BELOW', 10000):
+            return int(row[0])
+    return model.objects.count()
+
+
+class KeysetGrid(object):
+    """
+    A grid read from a model with seek pagination. The rows are ordered on an indexed column and the id, and a page is
+    read from the key of the last row of the previous page, sent back by the grid, so the deep pages cost the same as
+    the first. The number of matching rows is capped at GRID_MAX_ROWS, so a filter is never counted past the cap, and
+    the pages without a key are read with an offset within the cap
+    """
+    def __init__(self, name, model, sort_columns, search_columns, record):
+        """
+        :param name: The name of the grid, used for the cache key and invalidation
+        :param model: The model of the rows
+        :param sort_columns: The indexed columns the grid can be sorted on, besides the id
+        :param search_columns: The columns matched by the search box
+        :param record: A callable which formats a row, a dict of the values of the model fields, as a grid record
+        """
+        self.name = name
+        self.model = model
+        self.sort_columns = ('id',) + tuple(sort_columns)
+        self.search_columns = search_columns
+        self.record = record
+
+    def filtered(self, queries):
+        """
+        Get the rows matching the grid queries, the text of the search box and exact matches on the sortable columns
+        """
+        rows = self.model.objects.all()
+        for column, value in (queries or {}).items():
+            if column == 'search' and value:
+                search = Q()
+                for search_column in self.search_columns:
+                    search |= Q(**{'%s__icontains' % search_column: value})
+                rows = rows.filter(search)
+            elif column in self.sort_columns and value not in (None, ''):
+                rows = rows.filter(**{column: value})
+        return rows
+
+    def page(self, params):
+        max_rows = getattr(settings, 'GRID_MAX_ROWS', 10000)
+        (column, is_desc) = params.sort(self.sort_columns)
+        rows = self.filtered(params.queries)
+
+        if params.queries:
+            # the filter is counted up to the cap
+            query_count = rows.order_by()[:max_rows].count()
+            total_count = estimated_count(self.model)
+        else:
+            total_count = estimated_count(self.model)
+            query_count = total_count
+
+        op = 'lt' if is_desc else 'gt'
+        ordering = ['-%s' % column, '-id'] if is_desc else [column, 'id']
+        if isinstance(params.after, list) and len(params.after) == 2:
+            (value, last_id) = params.after
+            if column == 'id':
+                rows = rows.filter(**{'id__%s' % op: last_id})
+            else:
+                rows = rows.filter(Q(**{'%s__%s' % (column, op): value}) | Q(**{column: value, 'id__%s' % op: last_id}))
+            page_rows = list(rows.order_by(*ordering).values()[:params.per_page])
+        else:
+            offset = min(params.offset, max_rows)
+            page_rows = list(rows.order_by(*ordering).values()[offset:min(offset + params.per_page, max_rows)])
+
+        return {
+            'records': [self.record(row) for row in page_rows],
+            'queryRecordCount': min(query_count, max_rows),
+            'totalRecordCount': total_count,
+            # the key the grid sends back for the next page
+            'last_key': [page_rows[-1][column], page_rows[-1]['id']] if page_rows else None
+        }
+
+    def fetch(self, params):
+        return fetch_grid_page(self.name, params, lambda *args: (True, self.page(params)))
+
+
+def error_record(row):
+    return {
+        'id': row['id'],
+        'err_code': row['err_code'],
+        'data_uuid': row['data_uuid'],
+        'err_message': row['err_message'],
+        'actions': '<button type="button" class="btn btn-outline btn-primary btn-xs edit_record" data-identifier="%d">View</button>' % row['id']
+    }
+
+
+processing_errors_grid = KeysetGrid('processing_errors', ProcessingErrors, ('err_code', 'data_uuid'), ('data_uuid', 'err_message'), error_record)
@@ -0,0 +1,189 @@
+import time
+import logging
+import threading
+
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+
+# the upper bounds of the request duration histogram, in seconds
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+local = threading.local()
+
+
+class RequestMetrics(object):
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.ona_count = 0
+        self.ona_time = 0.0
+        self.serialise_time = 0.0
+
+
+def current_metrics():
+    # the metrics of the request being handled by this thread, None outside of an instrumented request
+    return getattr(local, 'metrics', None)
+
+
+def record_ona_response(response, *args, **kwargs):
+    """
+    A requests response hook which adds the time taken by a call to the ONA server to the current request
+    """
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.ona_count += 1
+        metrics.ona_time += response.elapsed.total_seconds()
+    return response
+
+
+class timed_serialisation(object):
+    """
+    Adds the time spent in the block to the serialisation time of the current request
+    """
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.serialise_time += time.perf_counter() - self.started
+
+
+class ViewMetrics(object):
+    """
+    The totals of the metrics of all the requests to each view handled by this process
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def add(self, view_name, status, duration, metrics, response_size):
+        with self.lock:
+            if view_name not in self.views:
+                self.views[view_name] = {
+                    'requests': 0, 'errors': 0, 'duration': 0.0, 'sql_queries': 0, 'sql_time': 0.0, 'ona_requests': 0,
+                    'ona_time': 0.0, 'serialise_time': 0.0, 'response_bytes': 0, 'buckets': [0] * len(DURATION_BUCKETS)
+                }
+            totals = self.views[view_name]
+            totals['requests'] += 1
+            totals['errors'] += 1 if status >= 500 else 0
+            totals['duration'] += duration
+            totals['sql_queries'] += metrics.sql_count
+            totals['sql_time'] += metrics.sql_time
+            totals['ona_requests'] += metrics.ona_count
+            totals['ona_time'] += metrics.ona_time
+            totals['serialise_time'] += metrics.serialise_time
+            totals['response_bytes'] += response_size
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    totals['buckets'][i] += 1
+
+    def prometheus_text(self):
+        """
+        Format the totals in the prometheus text exposition format
+        """
+        counters = (
+            ('requests', 'odk_dashboard_requests_total', 'The number of requests'),
+            ('errors', 'odk_dashboard_server_errors_total', 'The number of requests which failed with a server error'),
+            ('sql_queries', 'odk_dashboard_sql_queries_total', 'The number of SQL queries'),
+            ('sql_time', 'odk_dashboard_sql_seconds_total', 'The time spent running SQL queries'),
+            ('ona_requests', 'odk_dashboard_ona_requests_total', 'The number of requests made to the ONA server'),
+            ('ona_time', 'odk_dashboard_ona_seconds_total', 'The time spent waiting for the ONA server'),
+            ('serialise_time', 'odk_dashboard_serialise_seconds_total', 'The time spent serialising the responses'),
+            ('response_bytes', 'odk_dashboard_response_bytes_total', 'The size of the responses'),
+        )
+        with self.lock:
+            views = dict((name, dict(totals, buckets=list(totals['buckets']))) for name, totals in self.views.items())
+
+        lines = []
+        for (key, metric, help_text) in counters:
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s counter' % metric)
+            for name, totals in sorted(views.items()):
+                lines.append('%s{view="%s"} %s' % (metric, name, totals[key]))
+
+        lines.append('# HELP odk_dashboard_request_duration_seconds The time taken to handle the requests')
+        lines.append('# TYPE odk_dashboard_request_duration_seconds histogram')
+        for name, totals in sorted(views.items()):
+            for bound, count in zip(DURATION_BUCKETS, totals['buckets']):
+                lines.append('odk_dashboard_request_duration_seconds_bucket{view="%s",le="%s"} %d' % (name, bound, count))
+            lines.append('odk_dashboard_request_duration_seconds_bucket{view="%s",le="+Inf"} %d' % (name, totals['requests']))
+            lines.append('odk_dashboard_request_duration_seconds_sum{view="%s"} %s' % (name, totals['duration']))
+            lines.append('odk_dashboard_request_duration_seconds_count{view="%s"} %d' % (name, totals['requests']))
+
+        return '\n'.join(lines) + '\n'
+
+
+view_metrics = ViewMetrics()
+
+
+def view_budget(view_name):
+    # VIEW_BUDGETS maps a view name to its limits, eg {'fetch_processing_errors': {'queries': 10, 'ms': 300}}
+    budgets = getattr(settings, 'VIEW_BUDGETS', {})
+    return budgets.get(view_name, getattr(settings, 'VIEW_BUDGET_DEFAULT', None))
+
+
+class InstrumentationMiddleware(object):
+    """
+    Records the SQL queries, SQL time, ONA server time, serialisation time and response size of each request. The
+    timings are sent in a Server-Timing header, added to the totals served by the metrics view and checked against
+    the budget of the view
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        local.metrics = metrics
+
+        def record_query(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                metrics.sql_count += 1
+                metrics.sql_time += time.perf_counter() - started
+
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(record_query))
+                response = self.get_response(request)
+        finally:
+            local.metrics = None
+
+        duration = time.perf_counter() - metrics.started
+        view_name = request.resolver_match.url_name if request.resolver_match is not None else 'unresolved'
+        # streamed responses are still being produced, so their size isn't known
+        response_size = 0 if response.streaming else len(response.content)
+
+        response['Server-Timing'] = ', '.join([
+            'db;dur=%.1f;desc="%d queries"' % (metrics.sql_time * 1000, metrics.sql_count),
+            'ona;dur=%.1f;desc="%d requests"' % (metrics.ona_time * 1000, metrics.ona_count),
+            'serialise;dur=%.1f' % (metrics.serialise_time * 1000),
+            'total;dur=%.1f' % (duration * 1000)
+        ])
+        view_metrics.add(view_name, response.status_code, duration, metrics, response_size)
+        self.check_budget(view_name, duration, metrics, response_size)
+
+        return response
+
+    def check_budget(self, view_name, duration, metrics, response_size):
+        budget = view_budget(view_name)
+        if budget is None:
+            return
+
+        exceeded = []
+        if 'queries' in budget and metrics.sql_count > budget['queries']:
+            exceeded.append('%d queries against %d' % (metrics.sql_count, budget['queries']))
+        if 'ms' in budget and duration * 1000 > budget['ms']:
+            exceeded.append('%.0fms against %dms' % (duration * 1000, budget['ms']))
+        if 'bytes' in budget and response_size > budget['bytes']:
+            exceeded.append('%d bytes against %d' % (response_size, budget['bytes']))
+
+        if exceeded:
+            logging.warning("The view '%s' exceeded its budget: %s" % (view_name, ', '.join(exceeded)))
@@ -0,0 +1,336 @@
+import os
+import json
+import uuid
+import datetime
+import hashlib
+import logging
+import tempfile
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from vendor.models import FormViews
+
+from odk_dashboard.columnar import COLUMNAR_FORMATS, write_columnar_export
+from odk_dashboard.exports import STREAMING_FORMATS, delta_export, stream_export
+from odk_dashboard.grid import invalidate_grid
+from odk_dashboard.materialize import materialized_rows, refresh_materialized_view
+from odk_dashboard.models import ExportJob
+from odk_dashboard.plans import mapping_plans
+from odk_dashboard.processing import partition_submissions, process_partitions, reprocess_errors, select_errors
+from odk_dashboard.registry import get_parser
+from odk_dashboard.spreadsheets import write_form_dictionary, write_form_structure, write_xlsx_export
+from odk_dashboard.sync import pull_form_submissions
+
+# the jobs which are too heavy for the web workers are left queued for the process_submissions command
+WORKER_JOBS = ('process_submissions',)
+
+
+class ExportJobQueue(object):
+    """
+    Runs the background jobs on a bounded pool of worker threads. The jobs are kept in the database, so the progress
+    and files can be served by any web worker. Identical requests which are still queued or running are given the job
+    which is already in flight. The WORKER_JOBS are only queued, and are claimed and run by a separate worker process
+    """
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or getattr(settings, 'EXPORT_JOB_WORKERS', 2)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def submit(self, kind, data):
+        """
+        Queue a job
+        :param kind: The type of job, one of the keys of JOB_RUNNERS
+        :param data: The request data for the job
+        :return: The queued (or deduplicated) ExportJob
+        """
+        key = hashlib.sha1(('%s:%s' % (kind, json.dumps(data, sort_keys=True))).encode('utf-8')).hexdigest()
+        self.purge_expired()
+        # a job whose worker died stops being updated, so it is not handed out once it has gone stale
+        stale_at = timezone.now() - datetime.timedelta(seconds=getattr(settings, 'EXPORT_JOB_STALE_AFTER', 600))
+        job = ExportJob.objects.filter(key=key, status__in=('queued', 'running'), updated_at__gte=stale_at).order_by('-created_at').first()
+        if job is not None:
+            return job
+
+        job = ExportJob.objects.create(id=uuid.uuid4().hex, key=key, kind=kind, data=data)
+        if kind in WORKER_JOBS:
+            return job
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='export_job')
+        self.executor.submit(self.run, job.id)
+
+        return job
+
+    def get(self, job_id):
+        return ExportJob.objects.filter(id=job_id).first()
+
+    def latest(self, kind):
+        return ExportJob.objects.filter(kind=kind).order_by('-created_at').first()
+
+    def claim(self, kinds):
+        """
+        Claim the oldest queued job of the given kinds, so that no other worker runs it
+        :param kinds: The kinds of jobs to claim
+        :return: The claimed ExportJob, None when there are no queued jobs
+        """
+        for job in ExportJob.objects.filter(kind__in=kinds, status='queued').order_by('created_at'):
+            if ExportJob.objects.filter(id=job.id, status='queued').update(status='running', updated_at=timezone.now()) == 1:
+                job.status = 'running'
+                return job
+        return None
+
+    def purge_expired(self):
+        # finished jobs are kept, with their files, for EXPORT_JOB_TTL seconds so that every client sharing a job can
+        # download it
+        expired_at = timezone.now() - datetime.timedelta(seconds=getattr(settings, 'EXPORT_JOB_TTL', 3600))
+        for job in ExportJob.objects.filter(finished_at__lt=expired_at):
+            if job.filename is not None:
+                try:
+                    os.remove(job.filename)
+                except OSError:
+                    # already removed, eg by another worker purging the same job
+                    pass
+            job.delete()
+
+    def run(self, job_id):
+        job = ExportJob.objects.get(id=job_id)
+        try:
+            self.execute(job)
+        finally:
+            # each worker thread has its own database connection
+            connection.close()
+
+    def execute(self, job):
+        job.status = 'running'
+        job.save(update_fields=['status', 'updated_at'])
+        heartbeat = JobHeartbeat(job.id)
+        heartbeat.start()
+        try:
+            JOB_RUNNERS[job.kind](job)
+            job.status = 'done'
+        except Exception as e:
+            logging.error(traceback.format_exc())
+            job.status = 'failed'
+            job.message = str(e)
+        finally:
+            heartbeat.stop()
+            job.finished_at = timezone.now()
+            job.save()
+
+
+class JobHeartbeat(threading.Thread):
+    """
+    Touches a running job every EXPORT_JOB_HEARTBEAT seconds, so that a job whose runner doesn't report any progress,
+    eg while the vendor parser merges a whole form, isn't taken as stale and started again by an identical request.
+    The heartbeat stops with its worker, so the job of a worker which died still goes stale
+    """
+    def __init__(self, job_id):
+        super(JobHeartbeat, self).__init__(name='export_job_heartbeat', daemon=True)
+        self.job_id = job_id
+        self.stopped = threading.Event()
+
+    def run(self):
+        interval = getattr(settings, 'EXPORT_JOB_HEARTBEAT', 60)
+        try:
+            while not self.stopped.wait(interval):
+                ExportJob.objects.filter(id=self.job_id, status='running').update(updated_at=timezone.now())
+        except Exception:
+            logging.error(traceback.format_exc())
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_data_export(job):
+    """
+    Run a get_data export, updating the job progress as the rows are merged and written
+    """
+    data = job.data
+    parser = get_parser(settings.ONADATA_TOKEN)
+    filters = data['filter_by'] if 'filter_by' in data else None
+    nodes = data['nodes[]'] if 'nodes[]' in data else None
+
+    if 'since' in data and data['format'] in STREAMING_FORMATS:
+        pull_form_submissions(parser, data['form_id'])
+        (rows, filename, job.result) = delta_export(parser, data['form_id'], nodes, data['format'], data['since'], filters, on_row=job_row_counter(job))
+        write_job_file(job, rows, filename, STREAMING_FORMATS[data['format']])
+        return
+
+    # the exports of a saved view are read from its materialized table, brought up to date first
+    rows = materialized_rows(parser, data['view_name'], filters) if data.get('view_name') else None
+    on_row = job_row_counter(job)
+    if rows is not None:
+        rows = counted_rows(rows, on_row)
+
+    if data['format'] in STREAMING_FORMATS:
+        (rows, filename) = stream_export(parser, data['form_id'], nodes, data['format'], filters, on_row=on_row, rows=rows)
+        write_job_file(job, rows, filename, STREAMING_FORMATS[data['format']])
+        return
+
+    if data['format'] in COLUMNAR_FORMATS:
+        (job.filename, job.content_type) = write_columnar_export(parser, data['form_id'], nodes, data['format'], filters, on_row=on_row, rows=rows)
+        job.bytes_written = os.path.getsize(job.filename)
+        return
+
+    if data['format'] == 'xlsx' and (rows is not None or data.get('action') != 'download_save'):
+        # the workbook is written from the merged rows so the progress is reported, only saving a new view, which the
+        # vendor parser does along with the export, is left to the parser
+        job.filename = write_xlsx_export(parser, data['form_id'], nodes, filters, on_row=on_row, rows=rows)
+        job.bytes_written = os.path.getsize(job.filename)
+        return
+
+    res = parser.fetch_merge_data(data['form_id'], nodes, data['format'], data['action'], data['view_name'], None, True, settings.IS_DRY_RUN, filters)
+    finish_file_job(job, res)
+
+
+def run_structure_export(job):
+    """
+    Run a get_structure export, the structure of the form written by the streaming writer
+    """
+    job.filename = write_form_structure(get_parser(settings.ONADATA_TOKEN), job.data['form_id'])
+    job.bytes_written = os.path.getsize(job.filename)
+
+
+def run_dictionary_export(job):
+    """
+    Run a get_dictionary export, the questions and choices of the form written by the streaming writer
+    """
+    job.filename = write_form_dictionary(get_parser(settings.ONADATA_TOKEN), job.data['form_id'])
+    job.bytes_written = os.path.getsize(job.filename)
+
+
+def run_xls_form_export(job):
+    """
+    Run a get_xls_form export, the form as it was uploaded to the server
+    """
+    parser = get_parser(settings.ONADATA_TOKEN)
+    res = parser.get_form_structure_from_server(job.data['form_id'])
+    finish_file_job(job, res)
+
+
+def run_partitioned_processing(job):
+    """
+    Process the raw submissions in partitions across a pool of worker processes, recording the outcome of each
+    partition in the job result as it finishes. Runs in the process_submissions command
+    """
+    # the partitions are loaded at the same time, so only the database can keep out the duplicate records
+    for table_plan in mapping_plans.get(get_parser()).tables.values():
+        if table_plan.identifier is not None and not table_plan.is_identifier_unique:
+            raise Exception("The record identifier '%s.%s' needs a unique constraint for the submissions to be processed in parallel" % (table_plan.name, table_plan.identifier))
+
+    partitions = partition_submissions(job.data.get('form_ids'))
+    job.result = {'partitions': partitions, 'no_partitions': len(partitions), 'no_done': 0, 'no_failed': 0}
+
+    def on_partition(partition):
+        job.rows_merged += partition['rows']
+        job.result['no_done' if partition['status'] == 'done' else 'no_failed'] += 1
+        job.save_progress(True)
+
+    try:
+        is_success = process_partitions(partitions, job.data['is_dry_run'], job.data.get('workers'), on_partition=on_partition)
+    finally:
+        invalidate_grid('processing_errors')
+        invalidate_grid('processing_status')
+
+    if not is_success:
+        raise Exception('%d of the %d partitions failed to process' % (job.result['no_failed'], len(partitions)))
+
+
+def run_error_reprocessing(job):
+    """
+    Reprocess all the processing errors which match the job filter, recording the outcome of each error
+    """
+    parser = get_parser()
+    err_ids = select_errors(job.data.get('queries'), job.data.get('err_codes'))
+    job.result = {'no_errors': len(err_ids), 'no_resolved': 0, 'no_failed': 0, 'failed': {}}
+    max_failed = getattr(settings, 'ERROR_REPROCESS_MAX_REPORTED', 1000)
+
+    def on_error(err_id, is_error, message):
+        job.rows_merged += 1
+        if is_error:
+            job.result['no_failed'] += 1
+            # the messages of the errors are kept in the error store, only the first ones are reported with the job
+            if len(job.result['failed']) < max_failed:
+                job.result['failed'][err_id] = message
+        else:
+            job.result['no_resolved'] += 1
+        job.save_progress()
+
+    try:
+        reprocess_errors(parser, err_ids, on_error=on_error)
+    finally:
+        invalidate_grid('processing_errors')
+        invalidate_grid('processing_status')
+
+    job.message = 'Resolved %d of the %d errors' % (job.result['no_resolved'], len(err_ids))
+
+
+def run_view_refresh(job):
+    """
+    Refresh the table of a materialized saved view
+    """
+    form_view = FormViews.objects.get(id=job.data['view_id'])
+    mat_view = refresh_materialized_view(get_parser(), form_view, job.data['full_rebuild'])
+    if mat_view is None:
+        raise Exception("The view '%s' is already being refreshed" % form_view.view_name)
+    if mat_view.last_refresh_error is not None:
+        raise Exception(mat_view.last_refresh_error)
+
+    job.rows_merged = mat_view.last_refresh_records
+    job.result = {'no_records': mat_view.no_records, 'last_refresh_seconds': mat_view.last_refresh_seconds}
+
+
+def write_job_file(job, rows, filename, content_type):
+    # write the lines of a streamed export to the file of the job
+    job.filename = os.path.join(getattr(settings, 'EXPORT_JOB_DIR', tempfile.gettempdir()), filename)
+    job.content_type = content_type
+    with open(job.filename, 'wb') as out_file:
+        for line in rows:
+            chunk = line.encode('utf-8')
+            out_file.write(chunk)
+            job.bytes_written += len(chunk)
+            job.save_progress()
+
+
+def counted_rows(rows, on_row):
+    # the rows read from a materialized view are counted as they are written, like the merged rows
+    for row in rows:
+        on_row(row)
+        yield row
+
+
+def job_row_counter(job):
+    def on_row(row):
+        job.rows_merged += 1
+        job.save_progress()
+    return on_row
+
+
+def finish_file_job(job, res):
+    if res['is_downloadable'] is True:
+        job.filename = res['filename']
+        job.bytes_written = os.path.getsize(job.filename)
+    job.message = res.get('message')
+
+
+JOB_RUNNERS = {
+    'get_data': run_data_export,
+    'get_dictionary': run_dictionary_export,
+    'get_structure': run_structure_export,
+    'get_xls_form': run_xls_form_export,
+    'process_submissions': run_partitioned_processing,
+    'reprocess_errors': run_error_reprocessing,
+    'refresh_view': run_view_refresh,
+}
+
+export_jobs = ExportJobQueue()
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from odk_dashboard.jobs import WORKER_JOBS, export_jobs
+
+
+class Command(BaseCommand):
+    help = 'Run the queued parallel processing jobs. Run it from cron or a process supervisor, or with --loop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', type=int, default=None, help='Keep running, checking for queued jobs every so many seconds')
+        parser.add_argument('--queue', action='store_true', help='Queue a processing job of all the submissions before running the queued jobs')
+        parser.add_argument('--forms', type=int, nargs='+', default=None, help='The database ids of the forms to process in the queued job')
+        parser.add_argument('--dry-run', action='store_true', help='Roll back the inserts of the queued job after checking them')
+        parser.add_argument('--workers', type=int, default=None, help='The number of worker processes of the queued job')
+
+    def handle(self, *args, **options):
+        if options['queue'] or options['forms'] is not None:
+            job = export_jobs.submit('process_submissions', {'is_dry_run': options['dry_run'], 'form_ids': options['forms'], 'workers': options['workers']})
+            self.stdout.write('Queued the processing job %s' % job.id)
+
+        while True:
+            job = export_jobs.claim(WORKER_JOBS)
+            while job is not None:
+                self.stdout.write('Running the %s job %s' % (job.kind, job.id))
+                export_jobs.execute(job)
+                self.stdout.write('The job %s is %s%s' % (job.id, job.status, ': %s' % job.message if job.message else ''))
+                job = export_jobs.claim(WORKER_JOBS)
+
+            if options['loop'] is None:
+                return
+            time.sleep(options['loop'])
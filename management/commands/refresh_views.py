@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from odk_dashboard.materialize import refresh_due_views
+from odk_dashboard.registry import get_parser
+
+
+class Command(BaseCommand):
+    help = 'Refresh the materialized saved views whose refresh interval has passed. Run it from cron, or with --loop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', type=int, default=None, help='Keep running, checking for due views every so many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            no_refreshed = refresh_due_views(get_parser())
+            self.stdout.write('Refreshed %d views' % no_refreshed)
+            if options['loop'] is None:
+                return
+            time.sleep(options['loop'])
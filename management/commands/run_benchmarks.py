@@ -0,0 +1,30 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from odk_dashboard.benchmarks import SCALES, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Time the hot endpoints of the dashboard against synthetic ODK data in a test database and output the results as json'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', default='10k', help='The number of synthetic submissions, one of %s' % ', '.join(SCALES.keys()))
+        parser.add_argument('--forms', type=int, default=1, help='The number of synthetic forms')
+        parser.add_argument('--repeats', type=int, default=5, help='The number of times each endpoint is requested')
+        parser.add_argument('--seed', type=int, default=42, help='The seed of the synthetic data')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the test database between runs')
+        parser.add_argument('--output', default=None, help='The file to write the results to, printed when not set')
+
+    def handle(self, *args, **options):
+        if options['scale'].lower() not in SCALES:
+            raise CommandError("Unknown scale '%s', use one of %s" % (options['scale'], ', '.join(SCALES.keys())))
+
+        results = run_benchmarks(options['scale'], options['forms'], options['repeats'], options['seed'], options['keepdb'])
+        output = json.dumps(results, indent=2)
+        if options['output'] is None:
+            self.stdout.write(output)
+        else:
+            with open(options['output'], 'w') as out_file:
+                out_file.write(output)
+            self.stdout.write(self.style.SUCCESS('Wrote the benchmark results to %s' % options['output']))
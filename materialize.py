@@ -0,0 +1,242 @@
+import json
+import time
+import logging
+import datetime
+import traceback
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from vendor.models import FormViews, ODKForm, RawSubmissions
+
+from odk_dashboard.exports import delta_submissions
+from odk_dashboard.models import MaterializedView
+from odk_dashboard.sync import pull_form_submissions
+
+
+def materialized_view(form_view):
+    (mat_view, is_created) = MaterializedView.objects.get_or_create(view=form_view, defaults={'table_name': 'odk_mv_%d' % form_view.id})
+    return mat_view
+
+
+def ensure_table(table_name):
+    # the merged submissions are kept as json, keyed and indexed on their uuid
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE TABLE IF NOT EXISTS %s (uuid varchar(100) PRIMARY KEY, modified varchar(50), data text NOT NULL)' % qn(table_name))
+        cursor.execute('CREATE INDEX IF NOT EXISTS %s ON %s (modified)' % (qn('%s_modified_idx' % table_name), qn(table_name)))
+
+
+def row_uuids(rows, uuids):
+    """
+    Match the merged submissions to the uuids of the batch they were merged from. The rows are matched on their
+    _uuid when the view has it, otherwise on their order, which is the order of the requested uuids
+    :param rows: The merged submissions
+    :param uuids: The uuids of the submissions which were merged
+    :return: A list of (uuid, row) tuples
+    """
+    batch = set(uuids)
+    if all(row.get('_uuid') in batch for row in rows):
+        return [(row['_uuid'], row) for row in rows]
+    if len(rows) == len(uuids):
+        return list(zip(uuids, rows))
+    raise ValueError('%d merged records could not be matched to the %d submissions they were merged from' % (len(rows), len(uuids)))
+
+
+def upsert_rows(table_name, uuids, rows):
+    """
+    Replace the rows of a batch of submissions in a materialized view table. The rows of all the uuids of the batch
+    are removed, so the submissions which no longer merge into the view are dropped from it
+    :param table_name: The name of the table
+    :param uuids: The uuids of the submissions which were merged
+    :param rows: The merged submissions
+    """
+    qn = connection.ops.quote_name
+    values = [(uuid, row.get('_date_modified', row.get('_submission_time')), json.dumps(row, default=str)) for (uuid, row) in row_uuids(rows, uuids)]
+
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM %s WHERE uuid IN (%s)' % (qn(table_name), ', '.join(['%s'] * len(uuids))), list(uuids))
+        if values:
+            cursor.execute('INSERT INTO %s (uuid, modified, data) VALUES %s' % (qn(table_name), ', '.join(['(%s, %s, %s)'] * len(values))), [item for value in values for item in value])
+
+
+def remove_deleted_rows(table_name, odk_form):
+    # the submissions deleted from the raw submissions are no longer in the delta export, so they are removed here
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM %s WHERE uuid NOT IN (SELECT %s FROM %s WHERE %s = %%s)' % (
+            qn(table_name), qn('uuid'), qn(RawSubmissions._meta.db_table), qn(RawSubmissions._meta.get_field('form').column)
+        ), [odk_form.id])
+
+
+def drop_table(sender, instance, **kwargs):
+    """
+    Drop the table of a materialized view once the view is deleted, eg along with its saved view
+    """
+    qn = connection.ops.quote_name
+    def drop():
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS %s' % qn(instance.table_name))
+    transaction.on_commit(drop)
+
+
+def claim_view(mat_view):
+    # only one refresh of a view runs at a time across all the processes, unless the running one has been abandoned
+    now = timezone.now()
+    timeout = datetime.timedelta(seconds=getattr(settings, 'MATERIALIZE_CLAIM_TIMEOUT', 3600))
+    is_free = Q(is_refreshing=False) | Q(refresh_started_at__isnull=True) | Q(refresh_started_at__lt=now - timeout)
+    return MaterializedView.objects.filter(is_free, id=mat_view.id).update(is_refreshing=True, refresh_started_at=now) == 1
+
+
+def count_rows(table_name):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM %s' % connection.ops.quote_name(table_name))
+        return cursor.fetchone()[0]
+
+
+def refresh_materialized_view(parser, form_view, full_rebuild=False):
+    """
+    Merge the submissions added or edited since the last refresh into the table of a saved view
+    :param parser: The OdkParser to use for merging the submissions
+    :param form_view: The FormViews to refresh
+    :param full_rebuild: Whether to empty the table and merge all the submissions again
+    :return: The refreshed MaterializedView, None when the view is already being refreshed
+    """
+    mat_view = materialized_view(form_view)
+    if not claim_view(mat_view):
+        return None
+
+    started = time.time()
+    no_merged = 0
+    try:
+        odk_form = ODKForm.objects.get(id=form_view.form_id)
+        ensure_table(mat_view.table_name)
+        pull_form_submissions(parser, odk_form.form_id)
+
+        if full_rebuild:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute('DELETE FROM %s' % connection.ops.quote_name(mat_view.table_name))
+                mat_view.cursor = None
+                MaterializedView.objects.filter(id=mat_view.id).update(cursor=None)
+        else:
+            remove_deleted_rows(mat_view.table_name, odk_form)
+
+        batch_size = getattr(settings, 'MATERIALIZE_BATCH_SIZE', 1000)
+        while True:
+            (uuids, next_cursor) = delta_submissions(odk_form.form_id, mat_view.cursor, batch_size)
+            if len(uuids) == 0:
+                break
+
+            # form_id, nodes, d_format, download_type, view_name, uuids=None, update_local_data=True, is_dry_run=True
+            # the vendor parser updates its own copy of the view data with the batch too, so it doesn't go stale
+            merged = parser.fetch_merge_data(odk_form.form_id, form_view.structure, 'json', 'submissions', form_view.view_name, uuids, True, settings.IS_DRY_RUN)
+            with transaction.atomic():
+                upsert_rows(mat_view.table_name, uuids, merged)
+                # the cursor is saved with each batch, so an interrupted refresh continues from where it stopped, and
+                # the claim is renewed so that a long refresh isn't taken as abandoned
+                mat_view.cursor = next_cursor
+                MaterializedView.objects.filter(id=mat_view.id).update(cursor=next_cursor, refresh_started_at=timezone.now())
+            no_merged += len(uuids)
+
+        mat_view.no_records = count_rows(mat_view.table_name)
+        mat_view.last_refresh_error = None
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        mat_view.last_refresh_error = str(e)
+    finally:
+        mat_view.is_refreshing = False
+        mat_view.last_refresh_at = timezone.now()
+        mat_view.last_refresh_seconds = round(time.time() - started, 2)
+        mat_view.last_refresh_records = no_merged
+        mat_view.save(update_fields=['no_records', 'is_refreshing', 'last_refresh_at', 'last_refresh_seconds', 'last_refresh_records', 'last_refresh_error'])
+
+    return mat_view
+
+
+def refresh_due_views(parser):
+    """
+    Refresh the materialized views whose refresh interval has passed since their last refresh
+    :param parser: The OdkParser to use for merging the submissions
+    :return: The number of refreshed views
+    """
+    now = timezone.now()
+    no_refreshed = 0
+    for mat_view in MaterializedView.objects.filter(refresh_interval__isnull=False).select_related('view'):
+        if mat_view.last_refresh_at is None or now - mat_view.last_refresh_at >= datetime.timedelta(seconds=mat_view.refresh_interval):
+            if refresh_materialized_view(parser, mat_view.view) is not None:
+                no_refreshed += 1
+    return no_refreshed
+
+
+def view_stats():
+    """
+    Get the stored statistics of the materialized views
+    :return: A dict of the view id to its statistics
+    """
+    stats = {}
+    for mat_view in MaterializedView.objects.all():
+        stats[mat_view.view_id] = {
+            'no_records': mat_view.no_records,
+            'is_refreshing': mat_view.is_refreshing,
+            'refresh_interval': mat_view.refresh_interval,
+            'last_refresh_at': mat_view.last_refresh_at.isoformat() if mat_view.last_refresh_at else None,
+            'last_refresh_seconds': mat_view.last_refresh_seconds,
+            'last_refresh_records': mat_view.last_refresh_records,
+            'last_refresh_error': mat_view.last_refresh_error
+        }
+    return stats
+
+
+def materialized_rows(parser, view_name, filters=None):
+    """
+    Get the merged submissions of a saved view from its table. The table is first brought up to date with the
+    submissions added or edited since its last refresh, and built when the view has not been materialized yet, so only
+    those submissions are merged
+    :param parser: The OdkParser to use for merging the submissions
+    :param view_name: The name of the saved view
+    :param filters: Any filters to apply to the rows of the view
+    :return: A generator of the merged submissions, None when there is no saved view with the name or its table has
+        not been built, eg while another process builds it
+    """
+    form_view = FormViews.objects.filter(view_name=view_name).first()
+    if form_view is None:
+        return None
+    mat_view = refresh_materialized_view(parser, form_view)
+    if mat_view is None:
+        # another process is refreshing the view, the table is read as it was last refreshed
+        mat_view = MaterializedView.objects.get(view=form_view)
+    if mat_view.cursor is None:
+        return None
+    return filter_rows(iter_table_rows(mat_view.table_name), filters)
+
+
+def filter_rows(rows, filters):
+    """
+    Filter the merged submissions of a view
+    :param rows: A generator of the merged submissions
+    :param filters: A dict of the column to the value, or the list of values, the rows must have
+    :return: A generator of the matching rows
+    """
+    if not filters:
+        return rows
+    allowed = dict((column, set(str(value) for value in (values if isinstance(values, list) else [values]))) for column, values in filters.items())
+    return (row for row in rows if all(str(row.get(column)) in values for column, values in allowed.items()))
+
+
+def iter_table_rows(table_name, batch_size=None):
+    # the rows are paged on the uuid so only one page is held in memory
+    batch_size = batch_size or getattr(settings, 'EXPORT_BATCH_SIZE', 500)
+    qn = connection.ops.quote_name
+    last_uuid = ''
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT uuid, data FROM %s WHERE uuid > %%s ORDER BY uuid LIMIT %d' % (qn(table_name), batch_size), [last_uuid])
+            rows = cursor.fetchall()
+        for (uuid, data) in rows:
+            yield json.loads(data)
+        if len(rows) < batch_size:
+            break
+        last_uuid = rows[-1][0]
@@ -0,0 +1,33 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # the trigram index is only available on postgres, other databases fall back to a plain scan
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    RawSubmissions = apps.get_model('vendor', 'RawSubmissions')
+    table = RawSubmissions._meta.db_table
+    column = RawSubmissions._meta.get_field('raw_data').column
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS raw_submissions_search_idx ON "%s" USING gin (("%s"::text) gin_trgm_ops)' % (table, column))
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    schema_editor.execute('DROP INDEX CONCURRENTLY IF EXISTS raw_submissions_search_idx')
+
+
+class Migration(migrations.Migration):
+    # the index is built concurrently so that the submissions table is not locked while it is created
+    atomic = False
+
+    dependencies = [
+        ('vendor', '__first__'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vendor', '__first__'),
+        ('odk_dashboard', '0001_submission_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_modified', models.CharField(blank=True, max_length=50, null=True)),
+                ('last_submission_id', models.BigIntegerField(default=0)),
+                ('last_raw_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('form', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='vendor.odkform')),
+                ('view', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='vendor.formviews')),
+            ],
+            options={
+                'unique_together': {('form', 'view')},
+            },
+        ),
+    ]
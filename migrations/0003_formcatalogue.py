@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('odk_dashboard', '0002_syncwatermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FormCatalogue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='default', max_length=50, unique=True)),
+                ('forms', models.JSONField(default=list)),
+                ('etag', models.CharField(blank=True, max_length=200, null=True)),
+                ('last_modified', models.CharField(blank=True, max_length=50, null=True)),
+                ('checked_at', models.DateTimeField(blank=True, null=True)),
+                ('refreshed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
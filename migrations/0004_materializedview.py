@@ -0,0 +1,29 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vendor', '__first__'),
+        ('odk_dashboard', '0003_formcatalogue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaterializedView',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table_name', models.CharField(max_length=100, unique=True)),
+                ('cursor', models.TextField(blank=True, null=True)),
+                ('refresh_interval', models.PositiveIntegerField(blank=True, null=True)),
+                ('no_records', models.BigIntegerField(default=0)),
+                ('is_refreshing', models.BooleanField(default=False)),
+                ('last_refresh_at', models.DateTimeField(blank=True, null=True)),
+                ('last_refresh_seconds', models.FloatField(blank=True, null=True)),
+                ('last_refresh_records', models.BigIntegerField(default=0)),
+                ('last_refresh_error', models.TextField(blank=True, null=True)),
+                ('view', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='vendor.formviews')),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('odk_dashboard', '0004_materializedview'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('key', models.CharField(db_index=True, max_length=40)),
+                ('kind', models.CharField(max_length=50)),
+                ('data', models.JSONField(default=dict)),
+                ('status', models.CharField(default='queued', max_length=20)),
+                ('message', models.TextField(blank=True, null=True)),
+                ('filename', models.CharField(blank=True, max_length=500, null=True)),
+                ('content_type', models.CharField(blank=True, max_length=200, null=True)),
+                ('rows_merged', models.BigIntegerField(default=0)),
+                ('bytes_written', models.BigIntegerField(default=0)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
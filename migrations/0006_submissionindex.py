@@ -0,0 +1,26 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vendor', '__first__'),
+        ('odk_dashboard', '0005_exportjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubmissionIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuid', models.CharField(max_length=100)),
+                ('modified', models.DateTimeField()),
+                ('form', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='vendor.odkform')),
+                ('submission', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='submission_index', to='vendor.rawsubmissions')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['form', 'modified', 'uuid'], name='odk_subm_index_delta_idx')],
+            },
+        ),
+    ]
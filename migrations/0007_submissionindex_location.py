@@ -0,0 +1,37 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('odk_dashboard', '0006_submissionindex'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submissionindex',
+            name='submitted',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='submissionindex',
+            name='lat',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='submissionindex',
+            name='lon',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='submissionindex',
+            name='geohash',
+            field=models.CharField(blank=True, max_length=12, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='submissionindex',
+            index=models.Index(fields=['form', 'geohash'], name='odk_subm_index_geohash_idx'),
+        ),
+        # the submissions indexed before the location was added are indexed again when they are next read
+        migrations.RunSQL('DELETE FROM odk_dashboard_submissionindex', migrations.RunSQL.noop),
+    ]
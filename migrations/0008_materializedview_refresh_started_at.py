@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('odk_dashboard', '0007_submissionindex_location'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='materializedview',
+            name='refresh_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
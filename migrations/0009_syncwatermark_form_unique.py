@@ -0,0 +1,43 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def remove_duplicate_watermarks(apps, schema_editor):
+    # the form watermarks had a null view, which the unique constraint didn't cover, so a form could get several
+    SyncWatermark = apps.get_model('odk_dashboard', 'SyncWatermark')
+    SyncWatermark.objects.filter(view__isnull=False).delete()
+    kept = set()
+    for watermark in SyncWatermark.objects.order_by('form_id', '-last_submission_id', '-updated_at'):
+        if watermark.form_id in kept:
+            watermark.delete()
+        else:
+            kept.add(watermark.form_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vendor', '__first__'),
+        ('odk_dashboard', '0008_materializedview_refresh_started_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_watermarks, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='syncwatermark',
+            unique_together=set(),
+        ),
+        migrations.RemoveField(
+            model_name='syncwatermark',
+            name='view',
+        ),
+        migrations.RemoveField(
+            model_name='syncwatermark',
+            name='last_raw_id',
+        ),
+        migrations.AlterField(
+            model_name='syncwatermark',
+            name='form',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='vendor.odkform'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations
+
+INDEXES = (
+    ('processing_errors_code_idx', ('err_code', 'id')),
+    ('processing_errors_uuid_idx', ('data_uuid', 'id')),
+)
+
+
+def create_grid_indexes(apps, schema_editor):
+    # the processing errors grid is sorted and paged on these columns and the id
+    ProcessingErrors = apps.get_model('vendor', 'ProcessingErrors')
+    table = ProcessingErrors._meta.db_table
+    qn = schema_editor.quote_name
+    if_not_exists = '' if schema_editor.connection.vendor == 'mysql' else 'IF NOT EXISTS '
+    for (name, fields) in INDEXES:
+        columns = ', '.join(qn(ProcessingErrors._meta.get_field(field).column) for field in fields)
+        schema_editor.execute('CREATE INDEX %s%s ON %s (%s)' % (if_not_exists, qn(name), qn(table), columns))
+
+
+def drop_grid_indexes(apps, schema_editor):
+    ProcessingErrors = apps.get_model('vendor', 'ProcessingErrors')
+    qn = schema_editor.quote_name
+    for (name, fields) in INDEXES:
+        if schema_editor.connection.vendor == 'mysql':
+            schema_editor.execute('DROP INDEX %s ON %s' % (qn(name), qn(ProcessingErrors._meta.db_table)))
+        else:
+            schema_editor.execute('DROP INDEX IF EXISTS %s' % qn(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vendor', '__first__'),
+        ('odk_dashboard', '0009_syncwatermark_form_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_grid_indexes, drop_grid_indexes),
+    ]
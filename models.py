@@ -0,0 +1,122 @@
+import time
+
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+
+class SyncWatermark(models.Model):
+    """
+    The high-water mark of the submissions synced for a form
+    """
+    form = models.OneToOneField('vendor.ODKForm', on_delete=models.CASCADE)
+    # the _date_modified and _id of the latest submission pulled from the ONA server
+    last_modified = models.CharField(max_length=50, null=True, blank=True)
+    last_submission_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class SubmissionIndex(models.Model):
+    """
+    The fields of a raw submission which are filtered and ordered on, copied out of its raw data when it is synced so
+    that they can be indexed
+    """
+    submission = models.OneToOneField('vendor.RawSubmissions', on_delete=models.CASCADE, related_name='submission_index')
+    form = models.ForeignKey('vendor.ODKForm', on_delete=models.CASCADE)
+    uuid = models.CharField(max_length=100)
+    # the time the submission was last edited on the ONA server, its submission time if it was never edited
+    modified = models.DateTimeField()
+    submitted = models.DateTimeField(null=True, blank=True)
+    # the gps point of the submission, with its geohash so that the points can be binned by a prefix of it
+    lat = models.FloatField(null=True, blank=True)
+    lon = models.FloatField(null=True, blank=True)
+    geohash = models.CharField(max_length=12, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['form', 'modified', 'uuid'], name='odk_subm_index_delta_idx'),
+            models.Index(fields=['form', 'geohash'], name='odk_subm_index_geohash_idx'),
+        ]
+
+
+class FormCatalogue(models.Model):
+    """
+    A local copy of the list of forms on the ONA server, with the validators of the last upstream response so that
+    the periodic refreshes can be made as conditional requests
+    """
+    name = models.CharField(max_length=50, unique=True, default='default')
+    forms = models.JSONField(default=list)
+    etag = models.CharField(max_length=200, null=True, blank=True)
+    last_modified = models.CharField(max_length=50, null=True, blank=True)
+    # when the upstream server was last asked for changes, and when the forms last changed
+    checked_at = models.DateTimeField(null=True, blank=True)
+    refreshed_at = models.DateTimeField(null=True, blank=True)
+
+
+class MaterializedView(models.Model):
+    """
+    The table holding the merged submissions of a saved view, with the statistics of its last refresh
+    """
+    view = models.OneToOneField('vendor.FormViews', on_delete=models.CASCADE)
+    table_name = models.CharField(max_length=100, unique=True)
+    # the delta export cursor of the last submission merged into the table
+    cursor = models.TextField(null=True, blank=True)
+    # the view is refreshed in the background every refresh_interval seconds, never when it is not set
+    refresh_interval = models.PositiveIntegerField(null=True, blank=True)
+    no_records = models.BigIntegerField(default=0)
+    is_refreshing = models.BooleanField(default=False)
+    # when the running refresh claimed the view, a claim older than MATERIALIZE_CLAIM_TIMEOUT is taken as abandoned
+    refresh_started_at = models.DateTimeField(null=True, blank=True)
+    last_refresh_at = models.DateTimeField(null=True, blank=True)
+    last_refresh_seconds = models.FloatField(null=True, blank=True)
+    last_refresh_records = models.BigIntegerField(default=0)
+    last_refresh_error = models.TextField(null=True, blank=True)
+
+
+class ExportJob(models.Model):
+    """
+    A job run in the background, eg an export or a processing run. The state of the job is kept in the database, so
+    that its progress and file can be served by any of the web workers
+    """
+    id = models.CharField(max_length=32, primary_key=True)
+    # the hash of the kind and request data, used to hand identical requests the job which is already in flight
+    key = models.CharField(max_length=40, db_index=True)
+    kind = models.CharField(max_length=50)
+    data = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, default='queued')
+    message = models.TextField(null=True, blank=True)
+    filename = models.CharField(max_length=500, null=True, blank=True)
+    content_type = models.CharField(max_length=200, null=True, blank=True)
+    rows_merged = models.BigIntegerField(default=0)
+    bytes_written = models.BigIntegerField(default=0)
+    result = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def is_in_flight(self):
+        return self.status in ('queued', 'running')
+
+    def progress(self):
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'message': self.message,
+            'rows_merged': self.rows_merged,
+            'bytes_written': self.bytes_written,
+            'is_downloadable': self.status == 'done' and self.filename is not None,
+            'elapsed': round(((self.finished_at or timezone.now()) - self.created_at).total_seconds(), 2),
+            'result': self.result
+        }
+
+    def save_progress(self, force=False):
+        """
+        Save the progress attributes, at most once every EXPORT_JOB_PROGRESS_INTERVAL seconds unless forced, so that
+        the row counters can be updated for every row without a query for each
+        """
+        now = time.time()
+        if not force and now - getattr(self, 'progress_saved_at', 0) < getattr(settings, 'EXPORT_JOB_PROGRESS_INTERVAL', 1):
+            return
+        self.progress_saved_at = now
+        self.save(update_fields=['message', 'rows_merged', 'bytes_written', 'result', 'updated_at'])
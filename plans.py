@@ -0,0 +1,388 @@
+import logging
+import threading
+import datetime
+
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.dateparse import parse_date, parse_datetime
+
+from vendor.models import ODKForm
+
+from odk_dashboard.caches import form_structures
+from odk_dashboard.schema import schema_catalogue
+
+
+def coerce_integer(value):
+    return int(float(value)) if isinstance(value, str) else int(value)
+
+
+def coerce_boolean(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 't', 'y')
+    return bool(value)
+
+
+def coerce_date(value):
+    if isinstance(value, datetime.date):
+        return value
+    parsed = parse_date(value[:10])
+    if parsed is None:
+        raise ValueError("'%s' is not a valid date" % value)
+    return parsed
+
+
+def coerce_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError("'%s' is not a valid date and time" % value)
+    return parsed
+
+
+def coerce_decimal(value):
+    try:
+        return Decimal(str(value))
+    except InvalidOperation:
+        raise ValueError("'%s' is not a valid number" % value)
+
+
+def coerce_string(value):
+    return value if isinstance(value, str) else str(value)
+
+
+# the coercers are matched against the start of the destination column type, the longer prefixes first
+TYPE_COERCERS = (
+    ('timestamp', coerce_datetime),
+    ('datetime', coerce_datetime),
+    ('date', coerce_date),
+    ('bigint', coerce_integer),
+    ('smallint', coerce_integer),
+    ('integer', coerce_integer),
+    ('int', coerce_integer),
+    ('serial', coerce_integer),
+    ('bool', coerce_boolean),
+    ('double', float),
+    ('real', float),
+    ('float', float),
+    ('numeric', coerce_decimal),
+    ('decimal', coerce_decimal),
+)
+
+
+def type_coercer(db_type):
+    """
+    Get the function which converts the submitted values to the type of a destination column
+    :param db_type: The type of the destination column, eg integer or character varying(50)
+    :return: A callable which takes a value and returns the converted value, raising a ValueError when it can't
+    """
+    db_type = (db_type or '').strip().lower()
+    coercer = coerce_string
+    for prefix, cur_coercer in TYPE_COERCERS:
+        if db_type.startswith(prefix):
+            coercer = cur_coercer
+            break
+
+    def coerce(value):
+        if value is None or value == '':
+            return None
+        return coercer(value)
+    return coerce
+
+
+def value_extractor(path):
+    """
+    Build the function which gets the values of a question from a submission. The possible repeat groups on the
+    path of the question are worked out once, so the extraction is only dictionary lookups
+    :param path: The full path of the question, eg group/repeat/question
+    :return: A callable which takes a submission and returns a list of the values of the question
+    """
+    parts = path.split('/')
+    prefixes = ['/'.join(parts[:i]) for i in range(len(parts) - 1, 0, -1)]
+
+    def extract(node):
+        if not isinstance(node, dict):
+            return []
+        if path in node:
+            return [node[path]]
+        for prefix in prefixes:
+            if isinstance(node.get(prefix), list):
+                values = []
+                for instance in node[prefix]:
+                    values.extend(extract(instance))
+                return values
+        return []
+    return extract
+
+
+class ColumnPlan(object):
+    def __init__(self, mapping):
+        self.name = mapping['dest_column_name']
+        self.question = mapping['form_question']
+        self.use_current_time = bool(mapping.get('use_current_time'))
+        self.is_record_identifier = bool(mapping.get('is_record_identifier'))
+        self.extract = None if self.use_current_time else value_extractor(mapping['form_question'])
+        self.coerce = type_coercer(mapping.get('db_question_type'))
+
+
+class ParentLink(object):
+    """
+    A foreign key from a table to another mapped table. The column holds the record identifier of the parent row until
+    the row is written, when it is replaced by the referenced key of the parent if that isn't the identifier itself
+    """
+    def __init__(self, column, parent, ref_column, is_mapped):
+        self.column = column
+        self.parent = parent
+        self.ref_column = ref_column
+        self.is_mapped = is_mapped
+        self.by_key = ref_column != parent.identifier
+
+
+class TablePlan(object):
+    def __init__(self, name):
+        self.name = name
+        self.columns = []
+        self.identifier = None
+        self.is_identifier_unique = False
+        self.parents = []
+        self.referenced_keys = set()
+
+    def add_column(self, mapping):
+        column = ColumnPlan(mapping)
+        self.columns.append(column)
+        if column.is_record_identifier:
+            self.identifier = column.name
+
+    def link(self, tables, table_keys):
+        """
+        Find the foreign keys to the other mapped tables which have a record identifier
+        :param tables: The TablePlans of all the mapped tables
+        :param table_keys: The unique and foreign keys of the table, from the schema catalogue
+        """
+        self.is_identifier_unique = self.identifier in table_keys.get('unique', [])
+        columns = dict((column.name, column) for column in self.columns)
+        for (column, (ref_table, ref_column)) in sorted(table_keys.get('foreign_keys', {}).items()):
+            parent = tables.get(ref_table)
+            if parent is None or parent is self or parent.identifier is None:
+                continue
+            link = ParentLink(column, parent, ref_column, column in columns)
+            self.parents.append(link)
+            if link.by_key:
+                parent.referenced_keys.add(ref_column)
+            if link.is_mapped:
+                # the mapped question gives the identifier of the parent, so it is converted like the identifier
+                columns[column].coerce = [cur_column for cur_column in parent.columns if cur_column.name == parent.identifier][0].coerce
+
+    def rows(self, submission, now):
+        """
+        Build the rows of the table from a submission. Questions in repeat groups give a row per repeat
+        :param submission: The raw submission
+        :param now: The time used for the columns which record the processing time
+        :return: A list of rows as dicts of column name to value
+        """
+        values = {}
+        no_rows = 0
+        for column in self.columns:
+            if column.extract is not None:
+                values[column.name] = column.extract(submission)
+                no_rows = max(no_rows, len(values[column.name]))
+
+        rows = []
+        for i in range(no_rows):
+            row = {}
+            for column in self.columns:
+                if column.use_current_time:
+                    row[column.name] = now
+                    continue
+                col_values = values[column.name]
+                # values outside the repeat are shared by all the rows of the repeat
+                value = col_values[i] if i < len(col_values) else (col_values[0] if len(col_values) == 1 else None)
+                row[column.name] = column.coerce(value)
+            rows.append(row)
+        return rows
+
+
+def topological_order(tables, relations):
+    """
+    Order the tables so that each table comes after the tables it references. Tables in a reference cycle are left in
+    their original order
+    """
+    ordered = []
+    visiting = set()
+
+    def visit(table):
+        if table in ordered or table in visiting:
+            return
+        visiting.add(table)
+        for parent in sorted(relations.get(table, ())):
+            if parent in tables:
+                visit(parent)
+        visiting.discard(table)
+        ordered.append(table)
+
+    for table in tables:
+        visit(table)
+    return ordered
+
+
+class MappingPlan(object):
+    """
+    The mappings compiled into the steps needed to load a submission: the destination tables in the order they should
+    be written, and for each table the functions which extract and convert the value of each column
+    """
+    def __init__(self, mappings, db_tables, tables_columns, relations, keys):
+        self.questions = set(mapping['form_question'] for mapping in mappings)
+        self.tables = {}
+        for mapping in mappings:
+            if mapping['dest_table_name'] not in self.tables:
+                self.tables[mapping['dest_table_name']] = TablePlan(mapping['dest_table_name'])
+            self.tables[mapping['dest_table_name']].add_column(mapping)
+        for table in self.tables.values():
+            table.link(self.tables, keys.get(table.name, {}))
+        self.table_order = topological_order(list(self.tables.keys()), relations)
+        self.comments = self.check(mappings, db_tables, tables_columns, keys)
+
+    def check(self, mappings, db_tables, tables_columns, keys):
+        # the structural problems of the mappings, worked out once when the plan is compiled
+        table_ids = dict((table['title'], table['id']) for table in db_tables)
+        columns = set((column['parent_id'], column['title']) for column in tables_columns)
+        comments = []
+        for mapping in mappings:
+            if mapping['dest_table_name'] not in table_ids:
+                comments.append({'type': 'danger', 'message': "The table '%s' mapped to '%s' does not exist in the database" % (mapping['dest_table_name'], mapping['form_question'])})
+            elif (table_ids[mapping['dest_table_name']], mapping['dest_column_name']) not in columns:
+                comments.append({'type': 'danger', 'message': "The column '%s.%s' mapped to '%s' does not exist in the database" % (mapping['dest_table_name'], mapping['dest_column_name'], mapping['form_question'])})
+
+        for table in self.tables.values():
+            if table.identifier is not None and not table.is_identifier_unique:
+                comments.append({'type': 'warning', 'message': "The record identifier '%s.%s' has no unique constraint, so the existing records are checked before each insert" % (table.name, table.identifier)})
+            for (column, (ref_table, ref_column)) in sorted(keys.get(table.name, {}).get('foreign_keys', {}).items()):
+                if ref_table in self.tables and self.tables[ref_table].identifier is None:
+                    comments.append({'type': 'warning', 'message': "The foreign key '%s.%s' can't be filled because '%s' has no record identifier" % (table.name, column, ref_table)})
+        return comments
+
+    def unmapped_questions(self, structure):
+        """
+        Get the questions of a form structure which are not mapped. The questions are the nodes without children, so
+        the groups and repeats are left out, and they are matched on their full path or, for the structures which only
+        have the name of the question, on the last part of the mapped path
+        :param structure: The form structure, a list of the nodes of the form linked to their parent by its id
+        :return: A tuple of the number of mapped questions of the form and the names of the unmapped ones
+        """
+        names = self.questions | set(question.split('/')[-1] for question in self.questions)
+        parent_ids = set(node.get('parent_id') for node in structure)
+        no_mapped = 0
+        unmapped = []
+        for node in structure:
+            if node['id'] in parent_ids:
+                continue
+            if node['name'] in names or node['name'].split('/')[-1] in names:
+                no_mapped += 1
+            else:
+                unmapped.append(node['name'])
+        return (no_mapped, unmapped)
+
+    def table_rows(self, submission, now):
+        """
+        Build the rows of all the destination tables from a submission. The foreign keys to the other tables which are
+        not mapped are given the identifier of the parent row of the same submission, the matching repeat instance
+        when the parent has as many rows
+        :return: A list of tuples of the table plan and its rows, in the order the tables should be written
+        """
+        table_rows = []
+        rows_by_table = {}
+        for table in self.table_order:
+            table_plan = self.tables[table]
+            rows = table_plan.rows(submission, now)
+            for link in table_plan.parents:
+                if link.is_mapped:
+                    continue
+                parent_rows = rows_by_table.get(link.parent.name, [])
+                for (i, row) in enumerate(rows):
+                    parent_row = parent_rows[i] if len(parent_rows) == len(rows) else (parent_rows[0] if len(parent_rows) == 1 else None)
+                    row[link.column] = None if parent_row is None else parent_row.get(link.parent.identifier)
+            rows_by_table[table] = rows
+            table_rows.append((table_plan, rows))
+        return table_rows
+
+
+class MappingPlanCache(object):
+    """
+    Keeps the compiled mapping plan and the validation of the mappings. The compiled plan can't be pickled so it is
+    kept in each process, while its version is kept in the shared cache so a change to the mappings in one process
+    recompiles the plan in all of them. The plan is used by the bulk loader, the partitioned processing and the error
+    reprocessing; the default processing, parser.manual_process_data, still reads the mappings itself
+    """
+    version_key = 'odk_dashboard:mapping_plan_version'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.plan = None
+        self.plan_version = None
+
+    def version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            version = 1
+            cache.add(self.version_key, version, None)
+        return version
+
+    def get(self, parser):
+        """
+        Get the compiled plan of the current mappings, compiling it if the mappings or the database schema changed since
+        it was last compiled
+        :param parser: The OdkParser to use for reading the mappings
+        :return: The MappingPlan
+        """
+        catalogue = schema_catalogue.get(parser)
+        version = (self.version(), catalogue['built_at'])
+        with self.lock:
+            if self.plan is None or self.plan_version != version:
+                mappings = parser.mapping_info()
+                relations = dict((table, set(referenced)) for table, referenced in catalogue['relations'].items())
+                self.plan = MappingPlan(mappings, catalogue['tables'], catalogue['columns'], relations, catalogue.get('keys', {}))
+                self.plan_version = version
+                logging.info('Compiled the mapping plan version %s with %d tables' % (version[0], len(self.plan.tables)))
+            return self.plan
+
+    def validation(self, parser):
+        """
+        Get the validation of the mappings from the compiled plan, reusing the last validation while the mappings and
+        the form structures are unchanged. The mappings are valid when all the mapped tables and columns exist, and
+        fully mapped when all the questions of the forms with mappings are mapped
+        :return: A tuple of whether all the questions are mapped, whether the mappings are valid and the comments
+        """
+        # refreshing the forms can add questions which are not mapped yet
+        key = 'odk_dashboard:mapping_validation:%s:%s' % (self.version(), form_structures.version())
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+        plan = self.get(parser)
+        comments = list(plan.comments)
+        is_fully_mapped = True
+        for odk_form in ODKForm.objects.order_by('form_name'):
+            (structure, etag) = form_structures.get(parser, odk_form.form_id)
+            (no_mapped, unmapped) = plan.unmapped_questions(structure)
+            # a form without any mapped questions isn't processed, so its questions don't need mappings
+            if no_mapped == 0 or len(unmapped) == 0:
+                continue
+            is_fully_mapped = False
+            comments.append({'type': 'warning', 'message': "%d questions of the form '%s' are not mapped: %s" % (len(unmapped), odk_form.form_name, ', '.join(unmapped))})
+
+        # the warnings of the plan don't stop the processing
+        is_mapping_valid = all(comment['type'] != 'danger' for comment in plan.comments)
+        validation = (is_fully_mapped, is_mapping_valid, comments)
+        cache.set(key, validation, getattr(settings, 'MAPPING_PLAN_CACHE_TIMEOUT', None))
+        return validation
+
+    def invalidate(self):
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.set(self.version_key, 2, None)
+
+
+mapping_plans = MappingPlanCache()
@@ -0,0 +1,161 @@
+import os
+import math
+import time
+import logging
+import traceback
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+
+from vendor.models import ProcessingErrors, RawSubmissions
+
+from odk_dashboard.bulk import BulkLoader, load_chunk
+from odk_dashboard.grid import processing_errors_grid
+from odk_dashboard.plans import mapping_plans
+
+
+def partition_submissions(form_ids=None, partition_size=None):
+    """
+    Split the raw submissions into partitions of a single form and a contiguous id range
+    :param form_ids: The database ids of the forms to process, all the forms when None
+    :param partition_size: The approximate number of submissions in each partition
+    :return: A list of dicts with the form and the first and last submission id of each partition
+    """
+    partition_size = partition_size or getattr(settings, 'PROCESSING_PARTITION_SIZE', 5000)
+    submissions = RawSubmissions.objects.all()
+    if form_ids is not None:
+        submissions = submissions.filter(form_id__in=form_ids)
+
+    partitions = []
+    for form in submissions.values('form_id').annotate(no_subms=Count('id'), min_id=Min('id'), max_id=Max('id')).order_by('form_id'):
+        # the ids are not dense, so the ranges are split evenly and the partitions are only roughly the same size
+        no_parts = int(math.ceil(form['no_subms'] / float(partition_size)))
+        step = int(math.ceil((form['max_id'] - form['min_id'] + 1) / float(no_parts)))
+        for start_id in range(form['min_id'], form['max_id'] + 1, step):
+            partitions.append({
+                'form_id': form['form_id'],
+                'min_id': start_id,
+                'max_id': min(start_id + step - 1, form['max_id']),
+                'status': 'queued'
+            })
+
+    return partitions
+
+
+def init_worker():
+    # the workers are spawned, so each sets up django and opens its own database connections
+    import django
+    django.setup()
+
+
+def process_partition(form_id, min_id, max_id, is_dry_run):
+    """
+    Process a single partition. Runs in a worker process
+    :return: A dict with the outcome of the partition
+    """
+    from odk_dashboard.bulk import bulk_process_submissions
+    from odk_dashboard.registry import get_parser
+
+    started = time.time()
+    try:
+        submissions = RawSubmissions.objects.filter(form_id=form_id, id__gte=min_id, id__lte=max_id)
+        (is_success, comments, stats) = bulk_process_submissions(get_parser(), is_dry_run, submissions)
+        return {
+            'status': 'done' if is_success else 'failed',
+            'rows': sum(table_stats['rows'] for table_stats in stats.values()),
+            'comments': comments,
+            'seconds': round(time.time() - started, 2)
+        }
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        return {'status': 'failed', 'rows': 0, 'comments': [{'type': 'danger', 'message': str(e)}], 'seconds': round(time.time() - started, 2)}
+    finally:
+        connections.close_all()
+
+
+def process_partitions(partitions, is_dry_run, max_workers=None, on_partition=None):
+    """
+    Process the partitions across a pool of worker processes
+    :param partitions: The partitions from partition_submissions, updated in place with the outcome of each
+    :param is_dry_run: Whether to roll back the inserts after checking them
+    :param max_workers: The number of worker processes, the number of cores when not set
+    :param on_partition: An optional callable called with each partition as it finishes
+    :return: Whether all the partitions were processed successfully
+    """
+    max_workers = max_workers or getattr(settings, 'PROCESSING_WORKERS', None) or os.cpu_count()
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=init_worker) as executor:
+        futures = {}
+        for partition in partitions:
+            future = executor.submit(process_partition, partition['form_id'], partition['min_id'], partition['max_id'], is_dry_run)
+            futures[future] = partition
+
+        for future in as_completed(futures):
+            partition = futures[future]
+            try:
+                partition.update(future.result())
+            except Exception as e:
+                # the worker process died, eg it was killed for using too much memory
+                logging.error(traceback.format_exc())
+                partition.update({'status': 'failed', 'rows': 0, 'comments': [{'type': 'danger', 'message': str(e)}]})
+            if on_partition is not None:
+                on_partition(partition)
+
+    return all(partition['status'] == 'done' for partition in partitions)
+
+
+def select_errors(queries=None, err_codes=None):
+    """
+    Get the ids of the unresolved processing errors which match a filter
+    :param queries: The filter, in the same format as the queries of the processing errors grid
+    :param err_codes: An optional list of the error codes to select
+    :return: A list of the error ids
+    """
+    errors = processing_errors_grid.filtered(queries).filter(is_resolved=False)
+    if err_codes is not None:
+        errors = errors.filter(err_code__in=err_codes)
+    return list(errors.order_by('id').values_list('id', flat=True))
+
+
+def reprocess_errors(parser, err_ids, batch_size=None, on_error=None):
+    """
+    Reprocess the submissions of the processing errors through the bulk loader. The mapping plan is compiled once for
+    all the errors, each batch of submissions is loaded with multi-row inserts in a single transaction, and the errors
+    are resolved, or updated with their new message, with bulk updates
+    :param parser: The OdkParser to use for compiling the mapping plan
+    :param err_ids: The ids of the errors to reprocess
+    :param batch_size: The number of submissions loaded together
+    :param on_error: An optional callable called with the error id, the error flag and message of each error
+    :return: A tuple of the number of resolved errors and a dict of the ids and messages of the errors which failed again
+    """
+    batch_size = batch_size or getattr(settings, 'ERROR_REPROCESS_BATCH_SIZE', 500)
+    plan = mapping_plans.get(parser)
+    loader = BulkLoader(plan)
+    now = timezone.now()
+    no_resolved = 0
+    failed = {}
+    for i in range(0, len(err_ids), batch_size):
+        errors = dict(ProcessingErrors.objects.filter(id__in=err_ids[i:i + batch_size]).values_list('id', 'data_uuid'))
+        chunk = list(RawSubmissions.objects.filter(uuid__in=set(errors.values())).values_list('id', 'uuid', 'raw_data'))
+        (no_loaded, load_errors) = load_chunk(plan, loader, chunk, now)
+
+        found = set(submission[1] for submission in chunk)
+        resolved = found - set(load_errors.keys())
+        ProcessingErrors.objects.filter(id__in=list(errors.keys()), data_uuid__in=resolved).update(is_resolved=True)
+
+        for err_id, uuid in errors.items():
+            if uuid in resolved:
+                (is_error, message) = (False, None)
+                no_resolved += 1
+            else:
+                (is_error, message) = (True, load_errors[uuid][1] if uuid in load_errors else "The submission '%s' was not found" % uuid)
+                failed[err_id] = message
+            if on_error is not None:
+                on_error(err_id, is_error, message)
+
+    return (no_resolved, failed)
@@ -0,0 +1,137 @@
+import sys
+import logging
+import threading
+import traceback
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+from django.db import connection
+
+from vendor.models import ODKForm
+from vendor.odk_parser import OdkParser
+
+from odk_dashboard.caches import form_structures
+from odk_dashboard.instrumentation import record_ona_response
+
+
+class SessionRequests(object):
+    """
+    Stands in for the requests module in the parser module, so that the parser's calls to the ONA server go through the
+    pooled keep-alive session. Everything else, eg the exceptions, is read from the requests module
+    """
+    def __init__(self, session):
+        self.session = session
+
+    def request(self, method, url, **kwargs):
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, params=None, **kwargs):
+        return self.session.get(url, params=params, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.session.post(url, data=data, json=json, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.session.put(url, data=data, **kwargs)
+
+    def patch(self, url, data=None, **kwargs):
+        return self.session.patch(url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.session.delete(url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.session.head(url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+class ParserRegistry(object):
+    """
+    Hands out long lived OdkParser instances so that the settings, form structures and connections a parser builds up
+    are reused across requests. OdkParser keeps per call state, so each thread gets its own instance per token. The
+    parsers share the pooled keep-alive session for their calls to the ONA server
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.http_session = None
+        self.is_warming = False
+
+    def setup(self):
+        """
+        Create the pooled keep-alive HTTP session used for calls to the ONA server
+        """
+        with self.lock:
+            if self.http_session is not None:
+                return
+
+            pool_size = getattr(settings, 'ONA_HTTP_POOL_SIZE', 10)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=getattr(settings, 'ONA_HTTP_RETRIES', 2))
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.hooks['response'].append(record_ona_response)
+            self.http_session = session
+
+            # the parser calls the requests module directly, so its module is pointed at the session
+            parser_module = sys.modules[OdkParser.__module__]
+            if getattr(parser_module, 'requests', None) is requests:
+                parser_module.requests = SessionRequests(session)
+
+    def get(self, token=None):
+        """
+        Get the parser of the current thread for the token, creating it if need be
+        :param token: The ONA token to use, None for the token in the saved settings
+        :return: An OdkParser
+        """
+        if getattr(self.local, 'generation', None) != self.generation:
+            self.local.parsers = {}
+            self.local.generation = self.generation
+
+        if token not in self.local.parsers:
+            self.local.parsers[token] = OdkParser(None, None, token)
+            self.warm_caches()
+        return self.local.parsers[token]
+
+    def warm_caches(self):
+        """
+        Build the cached structures of the forms in a background thread, once per process on the first use of a parser,
+        so the first requests for each form don't have to build them
+        """
+        with self.lock:
+            if self.is_warming or not getattr(settings, 'WARM_FORM_STRUCTURES', True):
+                return
+            self.is_warming = True
+
+        threading.Thread(target=self.run_warm_caches, name='warm_caches', daemon=True).start()
+
+    def run_warm_caches(self):
+        try:
+            parser = self.get()
+            for form_id in ODKForm.objects.values_list('form_id', flat=True):
+                if form_structures.etag(form_id) is None:
+                    form_structures.get(parser, form_id)
+        except Exception:
+            logging.error(traceback.format_exc())
+        finally:
+            connection.close()
+
+    def reset(self):
+        """
+        Discard all the parsers, eg when the ONA settings change. Each thread rebuilds its parsers on their next use
+        """
+        with self.lock:
+            self.generation += 1
+
+
+parser_registry = ParserRegistry()
+
+
+def get_parser(token=None):
+    return parser_registry.get(token)
@@ -0,0 +1,86 @@
+import time
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+
+def table_constraints(using, tables):
+    """
+    Get the keys of the destination tables
+    :param using: The database alias of the destination database
+    :param tables: The names of the tables
+    :return: A dict of each table name to a dict with its single column unique keys and its foreign keys as a dict of
+        the column to the referenced table and column
+    """
+    connection = connections[using]
+    keys = {}
+    with connection.cursor() as cursor:
+        for table in tables:
+            table_keys = {'unique': [], 'foreign_keys': {}}
+            try:
+                constraints = connection.introspection.get_constraints(cursor, table)
+            except NotImplementedError:
+                constraints = {}
+            for constraint in constraints.values():
+                columns = constraint.get('columns') or []
+                if (constraint.get('unique') or constraint.get('primary_key')) and len(columns) == 1 and columns[0] not in table_keys['unique']:
+                    table_keys['unique'].append(columns[0])
+                if constraint.get('foreign_key') and len(columns) == 1:
+                    table_keys['foreign_keys'][columns[0]] = list(constraint['foreign_key'])
+            keys[table] = table_keys
+    return keys
+
+
+class SchemaCatalogue(object):
+    """
+    Caches the tables, columns, column types and foreign keys of the destination database. Introspecting the database
+    is slow on large schemas, so the catalogue is rebuilt only when it expires or is refreshed
+    """
+    key = 'odk_dashboard:schema_catalogue'
+
+    def __init__(self):
+        self.timeout = getattr(settings, 'SCHEMA_CATALOGUE_TIMEOUT', 3600)
+
+    def get(self, parser, refresh=False):
+        """
+        Get the catalogue, introspecting the database if it is not cached
+        :param parser: The OdkParser to use for reading the database tables
+        :param refresh: Whether to rebuild the catalogue even if it is cached
+        :return: A dict with the tables, columns, the referenced tables and keys of each table and when it was built
+        """
+        catalogue = None if refresh else cache.get(self.key)
+        if catalogue is not None:
+            return catalogue
+
+        started = time.time()
+        (db_tables, tables_columns) = parser.get_db_tables()
+        keys = table_constraints(getattr(settings, 'DEST_DB_ALIAS', 'default'), [table['title'] for table in db_tables])
+        catalogue = {
+            'tables': db_tables,
+            'columns': tables_columns,
+            'relations': dict((table, sorted(set(ref[0] for ref in table_keys['foreign_keys'].values()))) for table, table_keys in keys.items()),
+            'keys': keys,
+            'built_at': time.time()
+        }
+        cache.set(self.key, catalogue, self.timeout)
+        logging.info('Built the schema catalogue of %d tables in %.2fs' % (len(db_tables), time.time() - started))
+
+        return catalogue
+
+    def table_columns(self, parser, table_id):
+        """
+        Get the columns of a single table
+        :param parser: The OdkParser to use if the catalogue has to be built
+        :param table_id: The id of the table, as given in the catalogue tables
+        :return: A list of the columns of the table
+        """
+        catalogue = self.get(parser)
+        return [column for column in catalogue['columns'] if str(column['parent_id']) == str(table_id)]
+
+    def invalidate(self):
+        cache.delete(self.key)
+
+
+schema_catalogue = SchemaCatalogue()
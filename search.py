@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import BooleanField, Func, TextField, Value
+from django.db.models.functions import Cast
+
+try:
+    from django.contrib.postgres.search import TrigramWordSimilarity
+except ImportError:
+    TrigramWordSimilarity = None
+
+from vendor.models import RawSubmissions
+
+
+class WordSimilar(Func):
+    """
+    The pg_trgm operator which is true when the query is similar to a word of the text, above the word similarity
+    threshold. Unlike the word_similarity function it is served by the trigram index
+    """
+    arg_joiner = ' <%% '
+    template = '(%(expressions)s)'
+    output_field = BooleanField()
+
+
+def search_submissions(s_query, limit=None):
+    """
+    Search the raw submissions for the query. On postgres the matches are found through the trigram index on the raw
+    data and only the matches above the similarity threshold are ranked by how well they match the query
+    :param s_query: The text to search for
+    :param limit: The maximum number of submissions to return
+    :return: A list of dicts with the id, submission time and form name of the matching submissions
+    """
+    limit = limit or getattr(settings, 'SUBMISSION_SEARCH_LIMIT', 10)
+    if s_query is None or len(s_query.strip()) < getattr(settings, 'SUBMISSION_SEARCH_MIN_LENGTH', 3):
+        return []
+
+    submissions = RawSubmissions.objects.select_related('form')
+    if connection.vendor == 'postgresql' and TrigramWordSimilarity is not None:
+        raw_text = Cast('raw_data', TextField())
+        submissions = submissions.filter(WordSimilar(Value(s_query), raw_text)).annotate(rank=TrigramWordSimilarity(s_query, raw_text))
+        submissions = submissions.order_by('-rank', '-submission_time').values('submission_time', 'form__form_name', 'id', 'rank')
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # the threshold only applies to this transaction
+                cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)", [str(getattr(settings, 'SUBMISSION_SEARCH_THRESHOLD', 0.6))])
+            return list(submissions[:limit])
+
+    submissions = submissions.filter(raw_data__icontains=s_query).order_by('-submission_time')
+    return list(submissions.values('submission_time', 'form__form_name', 'id')[:limit])
@@ -0,0 +1,382 @@
+import os
+import re
+import json
+import math
+import logging
+import zipfile
+import tempfile
+import traceback
+
+from datetime import datetime
+from xml.sax.saxutils import escape, quoteattr
+
+from django.conf import settings
+
+from odk_dashboard.caches import form_structures
+from odk_dashboard.columnar import split_repeats
+from odk_dashboard.exports import flatten_value, iter_merged_rows
+from odk_dashboard.registry import parser_registry
+from odk_dashboard.sync import ona_api_settings, ona_timeout
+
+# the maximum number of rows in an excel sheet, including the header, and of characters in a cell
+MAX_SHEET_ROWS = 1048576
+MAX_CELL_CHARS = 32767
+INVALID_TITLE_CHARS = re.compile(r'[\[\]\:\*\?\/\\]')
+# the characters which can't be written in xml 1.0
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+SPREADSHEET_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+RELATIONSHIPS_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+
+def column_letter(index):
+    # the excel name of a column from its 0 based index, A to XFD
+    letters = ''
+    index += 1
+    while index > 0:
+        (index, remainder) = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def xml_text(value):
+    return escape(INVALID_XML_CHARS.sub('', value[:MAX_CELL_CHARS]))
+
+
+class SheetWriter(object):
+    """
+    Writes the rows of a worksheet straight into its part of the workbook zip file. The cells are plain values without
+    any styles, and the strings are written as references to the shared strings of the workbook
+    """
+    def __init__(self, workbook, part):
+        self.workbook = workbook
+        self.out_file = workbook.zip_file.open(part, 'w', force_zip64=True)
+        self.out_file.write(('%s<worksheet xmlns="%s"><sheetData>' % (XML_DECLARATION, SPREADSHEET_NS)).encode('utf-8'))
+        self.no_rows = 0
+
+    def append(self, values):
+        self.no_rows += 1
+        cells = []
+        for (index, value) in enumerate(values):
+            cell = self.workbook.cell_xml('%s%d' % (column_letter(index), self.no_rows), value)
+            if cell is not None:
+                cells.append(cell)
+        self.out_file.write(('<row r="%d">%s</row>' % (self.no_rows, ''.join(cells))).encode('utf-8'))
+
+    def close(self):
+        self.out_file.write(b'</sheetData></worksheet>')
+        self.out_file.close()
+
+
+class StreamingSheet(object):
+    """
+    The rows of a sheet, spooled to a temporary file until the workbook is saved so that the header has the columns
+    of all the rows. A sheet which reaches the excel row limit is continued on a new sheet
+    """
+    def __init__(self, name):
+        self.name = name
+        self.header = {}
+        self.spool = tempfile.TemporaryFile(mode='w+', dir=getattr(settings, 'EXPORT_JOB_DIR', tempfile.gettempdir()))
+
+    def add(self, row):
+        for key in row.keys():
+            self.header.setdefault(key, None)
+        self.spool.write(json.dumps(row, default=str) + '\n')
+
+    def write(self, workbook):
+        header = list(self.header.keys())
+        sheet = None
+        no_parts = 0
+        try:
+            self.spool.seek(0)
+            for line in self.spool:
+                if sheet is None or sheet.no_rows == MAX_SHEET_ROWS:
+                    if sheet is not None:
+                        sheet.close()
+                    no_parts += 1
+                    sheet = workbook.create_sheet(self.name if no_parts == 1 else '%s (%d)' % (self.name, no_parts))
+                    sheet.append(header)
+                row = json.loads(line)
+                sheet.append([flatten_value(row.get(col)) for col in header])
+
+            if sheet is None:
+                # a sheet without any rows still gets its header
+                sheet = workbook.create_sheet(self.name)
+                sheet.append(header)
+            sheet.close()
+        finally:
+            self.spool.close()
+
+
+class StreamingWorkbook(object):
+    """
+    A workbook written in constant memory. The rows of each sheet are spooled to disk and streamed into the xlsx zip
+    file when the workbook is saved, in the order of the form. The strings are deduplicated in the shared strings table,
+    which is the only part held in memory; once it has XLSX_MAX_SHARED_STRINGS distinct strings the new ones are
+    written inline, so free text answers can't grow it without bound
+    """
+    def __init__(self):
+        self.sheets = {}
+        self.titles = set()
+        self.sheet_titles = []
+        self.shared_strings = {}
+        self.no_string_refs = 0
+        self.max_shared_strings = getattr(settings, 'XLSX_MAX_SHARED_STRINGS', 500000)
+        self.zip_file = None
+
+    def unique_title(self, name):
+        # excel sheet titles are at most 31 characters, unique and can't have some characters
+        base = INVALID_TITLE_CHARS.sub('_', name)[:31]
+        title = base
+        no = 1
+        while title.lower() in self.titles:
+            no += 1
+            suffix = '~%d' % no
+            title = base[:31 - len(suffix)] + suffix
+        self.titles.add(title.lower())
+        return title
+
+    def sheet(self, name):
+        if name not in self.sheets:
+            self.sheets[name] = StreamingSheet(name)
+        return self.sheets[name]
+
+    def create_sheet(self, name):
+        self.sheet_titles.append(self.unique_title(name))
+        return SheetWriter(self, 'xl/worksheets/sheet%d.xml' % len(self.sheet_titles))
+
+    def cell_xml(self, ref, value):
+        if value is None or value == '':
+            return None
+        if isinstance(value, bool):
+            return '<c r="%s" t="b"><v>%d</v></c>' % (ref, value)
+        if isinstance(value, int) or (isinstance(value, float) and math.isfinite(value)):
+            return '<c r="%s"><v>%r</v></c>' % (ref, value)
+
+        value = str(value)
+        index = self.shared_strings.get(value)
+        if index is None and len(self.shared_strings) < self.max_shared_strings:
+            index = self.shared_strings[value] = len(self.shared_strings)
+        if index is None:
+            return '<c r="%s" t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (ref, xml_text(value))
+        self.no_string_refs += 1
+        return '<c r="%s" t="s"><v>%d</v></c>' % (ref, index)
+
+    def save(self, filename, order=None):
+        """
+        Write the sheets and save the workbook
+        :param filename: The name of the file to save the workbook to
+        :param order: The names of the sheets in the order they should be written, the sheets which are not in it
+            follow in the order they were first used
+        :return: The name of the saved file
+        """
+        order = order or []
+        names = [name for name in order if name in self.sheets] + [name for name in self.sheets.keys() if name not in order]
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as self.zip_file:
+            for name in names:
+                self.sheets[name].write(self)
+            self.write_shared_strings()
+            self.write_package()
+        self.zip_file = None
+        return filename
+
+    def write_shared_strings(self):
+        with self.zip_file.open('xl/sharedStrings.xml', 'w', force_zip64=True) as out_file:
+            out_file.write(('%s<sst xmlns="%s" count="%d" uniqueCount="%d">' % (XML_DECLARATION, SPREADSHEET_NS, self.no_string_refs, len(self.shared_strings))).encode('utf-8'))
+            # the dict keeps the order the strings were added, which is their index
+            for value in self.shared_strings.keys():
+                out_file.write(('<si><t xml:space="preserve">%s</t></si>' % xml_text(value)).encode('utf-8'))
+            out_file.write(b'</sst>')
+
+    def write_package(self):
+        # the parts which tie the sheets together, with a single default style so the cells need no style objects
+        sheet_nos = range(1, len(self.sheet_titles) + 1)
+        self.zip_file.writestr('[Content_Types].xml', XML_DECLARATION + (
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            '<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>'
+            '%s</Types>'
+        ) % ''.join('<Override PartName="/xl/worksheets/sheet%d.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>' % no for no in sheet_nos))
+        self.zip_file.writestr('_rels/.rels', XML_DECLARATION + (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="%s/officeDocument" Target="xl/workbook.xml"/></Relationships>'
+        ) % RELATIONSHIPS_NS)
+        self.zip_file.writestr('xl/workbook.xml', XML_DECLARATION + '<workbook xmlns="%s" xmlns:r="%s"><sheets>%s</sheets></workbook>' % (
+            SPREADSHEET_NS, RELATIONSHIPS_NS,
+            ''.join('<sheet name=%s sheetId="%d" r:id="rId%d"/>' % (quoteattr(title), no, no) for (no, title) in zip(sheet_nos, self.sheet_titles))
+        ))
+        self.zip_file.writestr('xl/_rels/workbook.xml.rels', XML_DECLARATION + (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">%s'
+            '<Relationship Id="rId%d" Type="%s/styles" Target="styles.xml"/>'
+            '<Relationship Id="rId%d" Type="%s/sharedStrings" Target="sharedStrings.xml"/></Relationships>'
+        ) % (
+            ''.join('<Relationship Id="rId%d" Type="%s/worksheet" Target="worksheets/sheet%d.xml"/>' % (no, RELATIONSHIPS_NS, no) for no in sheet_nos),
+            len(self.sheet_titles) + 1, RELATIONSHIPS_NS, len(self.sheet_titles) + 2, RELATIONSHIPS_NS
+        ))
+        self.zip_file.writestr('xl/styles.xml', XML_DECLARATION + (
+            '<styleSheet xmlns="%s"><fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+            '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+            '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+            '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+            '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+            '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles></styleSheet>'
+        ) % SPREADSHEET_NS)
+
+
+def export_filename(prefix, form_id):
+    export_dir = getattr(settings, 'EXPORT_JOB_DIR', tempfile.gettempdir())
+    return os.path.join(export_dir, '%s%s_%s.xlsx' % (prefix, form_id, datetime.now().strftime('%Y%m%d_%H%M%S')))
+
+
+def write_xlsx_export(parser, form_id, nodes, filters=None, on_row=None, rows=None):
+    """
+    Write the submissions of a form to an excel workbook, with a sheet for the submissions and a sheet for each level
+    of repeat groups linked to the submissions by their uuid
+    :param parser: The OdkParser to use for merging the submissions
+    :param form_id: The ONA id of the form
+    :param nodes: The selected nodes to include in the export
+    :param filters: Any filters to apply to the submissions
+    :param on_row: An optional callback called with each merged submission
+    :param rows: The already merged submissions to write, eg from a materialized view, merged from the raw submissions
+        when None
+    :return: The name of the written file
+    """
+    if rows is None:
+        rows = iter_merged_rows(parser, form_id, nodes, filters, on_row=on_row)
+    workbook = StreamingWorkbook()
+    workbook.sheet('submissions')
+    row_ids = {}
+    for row in rows:
+        child_rows = []
+        workbook.sheet('submissions').add(split_repeats(row, 'submissions', row.get('_uuid'), None, child_rows, row_ids))
+        for (child_name, child_row) in child_rows:
+            workbook.sheet(child_name[len('submissions.'):]).add(child_row)
+
+    return workbook.save(export_filename('Form', form_id), sheet_order(parser, form_id))
+
+
+def sheet_order(parser, form_id):
+    """
+    Get the names of the sheets of an export in the order of the form: the submissions and then each repeat, nested
+    repeats following their parent
+    :return: A list of the sheet names, only the submissions when the form structure can't be built
+    """
+    try:
+        (structure, etag) = form_structures.get(parser, form_id)
+    except Exception:
+        logging.error(traceback.format_exc())
+        return ['submissions']
+    return ['submissions'] + list(repeat_sheets(structure))
+
+
+def repeat_sheets(structure):
+    """
+    Get the names of the sheets of the repeats of a form structure. The sheets are named the same way split_repeats
+    names their tables, from the names of the repeat and its parent repeats, groups are not part of the name
+    :param structure: The form structure, a list of the nodes of the form linked to their parent by its id
+    :return: A generator of the sheet names, in the order of the structure
+    """
+    nodes = dict((node['id'], node) for node in structure)
+    for node in structure:
+        if node.get('type') != 'repeat':
+            continue
+        names = []
+        seen = set()
+        cur_node = node
+        while cur_node is not None and cur_node['id'] not in seen:
+            seen.add(cur_node['id'])
+            if cur_node.get('type') == 'repeat':
+                names.insert(0, cur_node['name'].split('/')[-1])
+            cur_node = nodes.get(cur_node.get('parent_id'))
+        yield '.'.join(names)
+
+
+def write_form_structure(parser, form_id):
+    """
+    Write the structure of a form, one row for each node with the path of the node in the form
+    :param parser: The OdkParser to use for building the structure
+    :param form_id: The ONA id of the form
+    :return: The name of the written file
+    """
+    (structure, etag) = form_structures.get(parser, form_id)
+    nodes = dict((node['id'], node) for node in structure)
+    workbook = StreamingWorkbook()
+    sheet = workbook.sheet('structure')
+    for node in structure:
+        path = [node['name']]
+        parent = nodes.get(node.get('parent_id'))
+        while parent is not None and len(path) < len(nodes):
+            path.insert(0, parent['name'])
+            parent = nodes.get(parent.get('parent_id'))
+        sheet.add({'id': node['id'], 'parent_id': node.get('parent_id'), 'name': node['name'], 'type': node.get('type'), 'label': node.get('label'), 'path': '/'.join(path)})
+
+    return workbook.save(export_filename('Structure', form_id))
+
+
+def fetch_form_definition(parser, form_id):
+    """
+    Get the json definition of a form from the ONA server
+    :param parser: The OdkParser to use for reading the ONA settings
+    :param form_id: The ONA id of the form
+    :return: The form definition, as returned by the form.json endpoint
+    """
+    (ona_url, ona_token) = ona_api_settings(parser)
+    response = parser_registry.http_session.get('%s/api/v1/forms/%s/form.json' % (ona_url, form_id), headers={'Authorization': 'Token %s' % ona_token}, timeout=ona_timeout())
+    response.raise_for_status()
+    return response.json()
+
+
+def label_text(label):
+    # multi-language labels are dicts of the language to the label
+    if isinstance(label, dict):
+        return ' / '.join('%s: %s' % (lang, text) for lang, text in label.items())
+    return label
+
+
+def iter_questions(children, path=''):
+    """
+    Walk the questions of a form definition
+    :return: A generator of tuples of the full path of each question and its definition
+    """
+    for child in children:
+        cur_path = '%s/%s' % (path, child['name']) if path else child['name']
+        yield (cur_path, child)
+        if child.get('type') in ('group', 'repeat') and 'children' in child:
+            for question in iter_questions(child['children'], cur_path):
+                yield question
+
+
+def write_form_dictionary(parser, form_id):
+    """
+    Write the dictionary of a form, with a sheet of the questions and a sheet of the choices of the select questions.
+    The choices are only in the form definition, so it is fetched from the server
+    :param parser: The OdkParser to use for reading the ONA settings
+    :param form_id: The ONA id of the form
+    :return: The name of the written file
+    """
+    definition = fetch_form_definition(parser, form_id)
+    workbook = StreamingWorkbook()
+    survey = workbook.sheet('survey')
+    choices = workbook.sheet('choices')
+    for (path, question) in iter_questions(definition.get('children', [])):
+        bind = question.get('bind', {})
+        survey.add({
+            'type': question.get('type'),
+            'name': question.get('name'),
+            'path': path,
+            'label': label_text(question.get('label')),
+            'hint': label_text(question.get('hint')),
+            'required': bind.get('required'),
+            'relevant': bind.get('relevant'),
+            'constraint': bind.get('constraint'),
+            'calculation': bind.get('calculate')
+        })
+        if question.get('type', '').startswith('select') and 'children' in question:
+            for choice in question['children']:
+                choices.add({'question': path, 'name': choice.get('name'), 'label': label_text(choice.get('label'))})
+
+    return workbook.save(export_filename('Dictionary', form_id))
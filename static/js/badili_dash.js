@@ -155,6 +155,7 @@ function BadiliDash() {
     $(document).on('click', '#confirm_save_edits', this.saveEditedJson);
     $(document).on('click', '#test_mappings', this.validateMappings);
     $(document).on('click', '.edit_record', this.viewRawSubmission);
+    $(document).on('click', '#confirm_reprocess_errors', this.reprocessErrors);
     $(document).on('click', '#form_settings_table .edit_form', this.editFormSettings);
     $(document).on('click', '#save_form_details', this.saveFormSettings);
     $(document).on('click', '#save_group_details', this.saveGroupDetails);
@@ -223,7 +224,7 @@ BadiliDash.prototype.formStructure = function (form_id) {
 
     dash.showLoadingSpinner('Refreshing the form structure');
     $.ajax({
-        type: "POST", url: "/form_structure/", dataType: 'json', data: data,
+        type: "GET", url: "/form_structure/", dataType: 'json', data: data,
         error: dash.communicationError,
         success: function (data) {
             dash.destroyLoadingSpinner();
@@ -373,8 +374,8 @@ BadiliDash.prototype.processButtonAction = function(event){
         break;
 
         case 'refresh_btn':
-            action = '/refresh_forms/';
-            loading_text = 'Refreshing forms...';
+            dash.refreshFormsStream();
+            return;
         break;
 
         case 'dict_btn':
@@ -427,7 +428,8 @@ BadiliDash.prototype.processDownloadChoice = function(){
 };
 
 /**
- * Initiate the download process for the data
+ * Initiate the download process for the data. The export runs as a background job on the server, whose progress is
+ * polled until the file is ready
  * 
  * @param {string}  action The action selected by the user
  * @param {string}  view_name   The name of the view that the user wants to save
@@ -436,9 +438,61 @@ BadiliDash.prototype.processDownloadChoice = function(){
 BadiliDash.prototype.downloadData = function(user_action, view_name, action='/get_data/', filename=undefined, form_id=undefined){
     view_name = (view_name == undefined) ? '' : view_name;
     form_id = form_id == undefined ? $('#odk_forms').val() : form_id;
-    var data = {'nodes[]': dash.selected_node_ids, action: user_action, 'form_id': form_id, 'format': 'xlsx', 'view_name': view_name, 'filter_by': dash.data.filter_by};
+    var data = {'nodes[]': dash.selected_node_ids, action: user_action, 'form_id': form_id, 'format': 'xlsx', 'view_name': view_name, 'filter_by': dash.data.filter_by, 'async': true};
     dash.cur_filename = filename;
 
+    dash.showLoadingSpinner('Please wait while we process your data for download...');
+    $.ajax({
+        type: "POST", url: action, dataType: 'json', contentType: 'application/json', data: JSON.stringify(data),
+        headers: {'X-CSRFToken': dash.csrftoken},
+        error: dash.communicationError,
+        success: function (data) {
+            if (data.error) {
+                dash.destroyLoadingSpinner();
+                swal({ title: "Error!", text: data.message, imageUrl: "/static/img/error-icon.png", html: true });
+                return;
+            }
+            dash.pollExportJob(data.job_id);
+        }
+    });
+};
+
+/**
+ * Poll the progress of an export job, fetching its file once it is done
+ *
+ * @param {string}  job_id  The id of the export job
+ * @return {none}
+ */
+BadiliDash.prototype.pollExportJob = function(job_id){
+    $.ajax({
+        type: "GET", url: "/export_job_status/", dataType: 'json', data: {'job_id': job_id},
+        error: dash.communicationError,
+        success: function (data) {
+            if (data.error) {
+                dash.destroyLoadingSpinner();
+                var message = data.progress === undefined ? data.message : data.progress.message;
+                swal({ title: "Error!", text: message, imageUrl: "/static/img/error-icon.png", html: true });
+                return;
+            }
+            if (data.progress.status == 'done') {
+                dash.fetchExportJob(job_id);
+                return;
+            }
+            if (data.progress.rows_merged > 0) {
+                dash.showNotification(sprintf('Processed %d records', data.progress.rows_merged), 'info', true);
+            }
+            setTimeout(function(){ dash.pollExportJob(job_id); }, 2000);
+        }
+    });
+};
+
+/**
+ * Download the file of a finished export job
+ *
+ * @param {string}  job_id  The id of the export job
+ * @return {none}
+ */
+BadiliDash.prototype.fetchExportJob = function(job_id){
     var xhttp = new XMLHttpRequest();
 
     xhttp.onreadystatechange = function() {
@@ -465,7 +519,6 @@ BadiliDash.prototype.downloadData = function(user_action, view_name, action='/ge
             // Trick for making downloadable link
             a = document.createElement('a');
             a.href = window.URL.createObjectURL(xhttp.response);
-            console.log(dash.cur_filename);
             if(dash.cur_filename == undefined){
                 // Give filename you wish to download
                 var d = new Date();
@@ -487,15 +540,69 @@ BadiliDash.prototype.downloadData = function(user_action, view_name, action='/ge
         }
     };
 
-    dash.showLoadingSpinner('Please wait while we process your data for download...');
-    // Post data to URL which handles post request
-    xhttp.open("POST", action);
-    xhttp.setRequestHeader("X-CSRFToken", dash.csrftoken);
-    xhttp.setRequestHeader("Content-Type", "application/json");
-
+    xhttp.open("GET", '/export_job_download/?job_id=' + encodeURIComponent(job_id));
     // You should set responseType as blob for binary responses
     xhttp.responseType = 'blob';
-    xhttp.send(JSON.stringify(data));
+    xhttp.send();
+};
+
+/**
+ * Refresh the forms from the server. The server sends a json line with the number of forms, a line for each form as
+ * its metadata and structure are refreshed, and a last line with the refreshed forms
+ *
+ * @return {none}
+ */
+BadiliDash.prototype.refreshFormsStream = function(){
+    var no_forms = 0, no_done = 0, buffer = '';
+
+    var processLine = function(line){
+        if (line.trim() == '') { return; }
+        var data = JSON.parse(line);
+        if (data.error && data.form_id === undefined){
+            // the form list itself couldn't be refreshed
+            Notification.show({create: true, hide: true, updateText: false, text: data.message, error: true});
+            return;
+        }
+        if (data.all_forms !== undefined){
+            dash.data.all_forms = data.all_forms;
+            dash.initiateAllForms();
+            return;
+        }
+        if (data.form_id === undefined){
+            no_forms = data.no_forms;
+            return;
+        }
+        no_done++;
+        if (data.error) {
+            console.log(sprintf('Error while refreshing the form %s: %s', data.form_id, data.message));
+        }
+        dash.showNotification(sprintf('Refreshed %d of %d forms', no_done, no_forms), 'info', true);
+    };
+
+    dash.showLoadingSpinner('Refreshing forms...');
+    fetch('/refresh_forms/?stream=true', {method: 'POST', headers: {'X-CSRFToken': dash.csrftoken}, credentials: 'same-origin'})
+        .then(function(response){
+            var reader = response.body.getReader(), decoder = new TextDecoder();
+            var read = function(){
+                return reader.read().then(function(result){
+                    if (result.done){
+                        processLine(buffer);
+                        dash.destroyLoadingSpinner();
+                        return;
+                    }
+                    buffer += decoder.decode(result.value, {stream: true});
+                    var lines = buffer.split('\n');
+                    buffer = lines.pop();
+                    $.each(lines, function(i, line){ processLine(line); });
+                    return read();
+                });
+            };
+            return read();
+        })
+        .catch(function(){
+            dash.destroyLoadingSpinner();
+            Notification.show({create: true, hide: true, updateText: false, text: 'There was an error while communicating with the server', error: true});
+        });
 };
 
 BadiliDash.prototype.getFormStructure = function(){
@@ -577,6 +684,8 @@ BadiliDash.prototype.initiateViewsManagement = function(){
         {'name': 'date_created', 'title': 'Date Created', 'type': 'date'},
         {'name': 'no_sub_tables', 'title': 'Sub Tables'},
         {'name': 'auto_process', 'title': 'Auto Process'},
+        {'name': 'no_records', 'title': 'Records'},
+        {'name': 'last_refresh_at', 'title': 'Last Refreshed'},
         {'name': 'actions', 'title': 'Actions'}
     ];
 
@@ -759,12 +868,25 @@ BadiliDash.prototype.initiateTablesCombo = function(){
 };
 
 BadiliDash.prototype.showTableStructure = function(table_id){
-    var table_fields = [];
-    $.each(dash.data.all_columns, function(){
-        if(this.parent_id == table_id){
-            table_fields[table_fields.length] = this;
-        }
-    });
+    // the columns are fetched the first time a table is selected
+    if(dash.data.table_columns[table_id] === undefined){
+        dash.showLoadingSpinner('Fetching the table columns');
+        $.ajax({
+            type: "GET", url: "/table_columns/", dataType: 'json', data: {'table_id': table_id},
+            error: dash.communicationError,
+            success: function (data) {
+                dash.destroyLoadingSpinner();
+                if (data.error) {
+                    swal({title: "Error!", text: data.message, imageUrl: "/static/img/error-icon.png"});
+                    return;
+                }
+                dash.data.table_columns[table_id] = data.columns;
+                dash.showTableStructure(table_id);
+            }
+        });
+        return;
+    }
+    var table_fields = dash.data.table_columns[table_id];
 
     var source ={
         datatype: "json",
@@ -1127,10 +1249,78 @@ BadiliDash.prototype.initiateProcessingErrorsPage = function(){
         records: []
       }
     });
+    dash.initKeysetPaging(dash.error_table);
 
     dash.initJSONEditor()
 };
 
+/**
+ * Reprocess all the unresolved errors matching the current filter of the processing errors grid in the background,
+ * reloading the grid once they are done
+ *
+ * @return {none}
+ */
+BadiliDash.prototype.reprocessErrors = function(){
+    $('#reprocessErrorsModal').modal('hide');
+    var queries = dash.error_table.data('dynatable').settings.dataset.queries;
+    dash.showLoadingSpinner('Please wait while we reprocess the errors...');
+    $.ajax({
+        type: "POST", url: "/reprocess_errors/", dataType: 'json', data: {'queries': JSON.stringify(queries || {})},
+        error: dash.communicationError,
+        success: function (data) {
+            if (data.error) {
+                dash.destroyLoadingSpinner();
+                dash.showNotification(data.message, 'error', true);
+                return;
+            }
+            dash.pollReprocessJob(data.job_id);
+        }
+    });
+};
+
+BadiliDash.prototype.pollReprocessJob = function(job_id){
+    $.ajax({
+        type: "GET", url: "/export_job_status/", dataType: 'json', data: {'job_id': job_id},
+        error: dash.communicationError,
+        success: function (data) {
+            if (data.error || data.progress.status == 'done') {
+                dash.destroyLoadingSpinner();
+                var message = data.progress === undefined ? data.message : data.progress.message;
+                dash.showNotification(message, data.error ? 'error' : 'success', true);
+                dash.error_table.data('dynatable').process();
+                return;
+            }
+            if (data.progress.result) {
+                dash.showNotification(sprintf('Reprocessed %d of %d errors', data.progress.rows_merged, data.progress.result.no_errors), 'info', true);
+            }
+            setTimeout(function(){ dash.pollReprocessJob(job_id); }, 2000);
+        }
+    });
+};
+
+BadiliDash.prototype.initKeysetPaging = function(table){
+    // the key of the last row of each page is sent back with the request for the next page, so the server seeks to
+    // the page instead of reading past all the rows before it
+    var dynatable = table.data('dynatable');
+    var page_keys = {};
+    var signature = undefined;
+    table.on('dynatable:beforeProcess', function(e, data){
+        var dataset = dynatable.settings.dataset;
+        var cur_signature = JSON.stringify([dataset.sorts, dataset.queries, dataset.perPage]);
+        if (cur_signature !== signature){
+            page_keys = {};
+            signature = cur_signature;
+        }
+        dynatable.requested_page = dataset.page;
+        dataset.ajaxData = page_keys[dataset.page - 1] ? {after: JSON.stringify(page_keys[dataset.page - 1])} : {};
+    });
+    table.on('dynatable:ajax:success', function(e, response){
+        if (response.last_key){
+            page_keys[dynatable.requested_page] = response.last_key;
+        }
+    });
+};
+
 BadiliDash.prototype.viewRawSubmission = function(){
     var rec_id = $(this).data("identifier");
     dash.cur_error_id = rec_id;
@@ -1234,11 +1424,18 @@ BadiliDash.prototype.initiateMap = function(lat, lon, zoom, include_overlay = tr
 
 BadiliDash.prototype.loadFirstLevel = function(c_code){
     dash.showLoadingSpinner('Please wait while we load the first level...');
-    $.get('/first_level_geojson?c_code='+c_code, function(response){
+    // the server simplifies the polygons for the current zoom level, so reload them when the zoom changes
+    if (dash.first_level_code === undefined){
+        dash.map.on('zoomend', function(){ dash.loadFirstLevel(dash.first_level_code); });
+    }
+    dash.first_level_code = c_code;
+    $.get('/first_level_geojson?c_code='+c_code+'&zoom='+dash.map.getZoom(), function(response){
         // console.log(response);
+        $.each(dash.layersData || [], function(i, o_layer){ dash.map.removeLayer(o_layer); });
         dash.layersData = [];
         $.each(response, function(i, that){
             var n_layer = L.geoJSON(that.polygon, {style: dash.base_color, county_code: that.c_code}).addTo(dash.map);
+            dash.layersData.push(n_layer);
 
             n_layer.on('mouseover', function(){
                 setTimeout(function() { dash.updateInfoDiv(that); }, 200);
@@ -1267,6 +1464,38 @@ BadiliDash.prototype.initiateMapVisualization = function(center_lat, center_lon,
     dash.loadFirstLevel(54);
 };
 
+BadiliDash.prototype.loadSubmissionAggregates = function(form_id){
+    // the cells are binned for the current zoom level, so reload them when the zoom changes
+    if (dash.aggregate_form_id === undefined){
+        dash.map.on('zoomend', function(){ dash.loadSubmissionAggregates(dash.aggregate_form_id); });
+    }
+    dash.aggregate_form_id = form_id;
+    $.each(dash.aggregateLayers || [], function(i, o_layer){ dash.map.removeLayer(o_layer); });
+    dash.aggregateLayers = [];
+    if (!form_id){
+        $('#aggregate_info').html('');
+        return;
+    }
+
+    $.get('/map_aggregates/?form_id='+form_id+'&zoom='+dash.map.getZoom(), function(response){
+        if (response.error){
+            dash.showNotification(response.message, 'error', true);
+            return;
+        }
+        // the layers of an earlier response may have been drawn while this one was loading
+        $.each(dash.aggregateLayers, function(i, o_layer){ dash.map.removeLayer(o_layer); });
+        dash.aggregateLayers = [];
+        var total = 0;
+        $.each(response.cells, function(i, cell){
+            total += cell.count;
+            var n_layer = L.circleMarker([cell.lat, cell.lng], {radius: Math.min(4 + Math.sqrt(cell.count) * 2, 40), color: '#1ab394', fillOpacity: 0.5, weight: 1}).addTo(dash.map);
+            n_layer.bindPopup(sprintf('<b>%s</b> submissions<br />First: %s<br />Last: %s', cell.count, cell.first_submission, cell.last_submission));
+            dash.aggregateLayers.push(n_layer);
+        });
+        $('#aggregate_info').html(sprintf('%s submissions in %s cells', total, response.cells.length));
+    });
+};
+
 BadiliDash.prototype.saveEditedJson = function(){
     var edited_json = dash.json_editor.getValue();
 
@@ -1317,6 +1546,40 @@ BadiliDash.prototype.initiateProcessingStatus = function(){
         records: []
       }
     });
+    $('#processing_status').on('dynatable:ajax:success', function(e, response){
+        dash.showProcessingRun(response.processing_run);
+    });
+};
+
+/**
+ * Show the progress of the latest partitioned processing run above the processing status, refreshing the status
+ * while the run is in progress
+ *
+ * @param {object}  run The progress of the processing run job, null when there hasn't been a run
+ * @return {none}
+ */
+BadiliDash.prototype.showProcessingRun = function(run){
+    var panel = $('#processing_run');
+    if (run == undefined || run == null){
+        panel.hide();
+        return;
+    }
+
+    var result = run.result || {};
+    var status_class = {'queued': 'alert-info', 'running': 'alert-info', 'done': 'alert-success', 'failed': 'alert-danger'}[run.status] || 'alert-info';
+    var message = sprintf('<strong>Latest processing run: %s</strong>', run.status);
+    if (result.no_partitions !== undefined){
+        message += sprintf(' &mdash; %d of %d partitions done, %d failed, %d submissions processed in %ss', result.no_done, result.no_partitions, result.no_failed, run.rows_merged, run.elapsed);
+    }
+    if (run.message){
+        message += '<br />' + $('<div>').text(run.message).html();
+    }
+    panel.removeClass('alert-info alert-success alert-danger').addClass(status_class).html(message).show();
+
+    clearTimeout(dash.processing_run_timer);
+    if (run.status == 'queued' || run.status == 'running'){
+        dash.processing_run_timer = setTimeout(function(){ $('#processing_status').data('dynatable').process(); }, 5000);
+    }
 };
 
 BadiliDash.prototype.initiate_adgg_dash = function(){
@@ -0,0 +1,344 @@
+import json
+import time
+import logging
+import datetime
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from vendor.models import ODKForm, RawSubmissions
+
+from odk_dashboard.caches import form_structures
+from odk_dashboard.geo import GEOHASH_PRECISION, geohash_encode, submission_location
+from odk_dashboard.models import SubmissionIndex, SyncWatermark
+from odk_dashboard.registry import get_parser, parser_registry
+
+
+class HostRateLimiter(object):
+    """
+    Spaces out the requests made to each host so that at most the set number of requests are started per second
+    """
+    def __init__(self, requests_per_second=None):
+        self.interval = 1.0 / (requests_per_second or getattr(settings, 'ONA_REQUESTS_PER_SECOND', 5))
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, host):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+rate_limiter = HostRateLimiter()
+
+
+def ona_api_settings(parser):
+    """
+    Get the url and token of the ONA server, from the saved settings when USE_DB_SETTINGS is enabled
+    :param parser: The OdkParser to use for reading the saved settings
+    :return: A tuple of the server url and API token
+    """
+    if settings.USE_DB_SETTINGS:
+        all_settings = parser.get_all_settings()
+        return (all_settings['ona_url'].rstrip('/'), all_settings['ona_api_token'])
+
+    return (settings.ONADATA_URL.rstrip('/'), settings.ONADATA_TOKEN)
+
+
+def ona_timeout():
+    # the connect and read timeout of the requests to the ONA server, so a hung server doesn't hold up a worker
+    return getattr(settings, 'ONA_HTTP_TIMEOUT', 30)
+
+
+def submission_time(value):
+    # a time out of the raw data as an aware datetime, None when it is missing or not valid
+    value = parse_datetime(value) if isinstance(value, str) else None
+    if value is None:
+        return None
+    # ONA gives the times in UTC, without the offset
+    return timezone.make_aware(value, datetime.timezone.utc) if timezone.is_naive(value) else value
+
+
+def submission_modified(raw_data):
+    """
+    Get the time a submission was last edited on the ONA server, which is its submission time if it was never edited
+    :param raw_data: The raw data of the submission
+    :return: The time as an aware datetime, the start of the epoch when the submission has no valid time
+    """
+    if isinstance(raw_data, str):
+        raw_data = json.loads(raw_data)
+    modified = submission_time(raw_data.get('_date_modified') or raw_data.get('_submission_time'))
+    if modified is None:
+        return datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    return modified
+
+
+def submission_index_row(subm):
+    raw_data = json.loads(subm.raw_data) if isinstance(subm.raw_data, str) else subm.raw_data
+    location = submission_location(raw_data)
+    return SubmissionIndex(
+        submission_id=subm.id, form_id=subm.form_id, uuid=subm.uuid, modified=submission_modified(raw_data),
+        submitted=submission_time(raw_data.get('_submission_time')),
+        lat=location[0] if location else None, lon=location[1] if location else None,
+        geohash=geohash_encode(location[0], location[1], GEOHASH_PRECISION) if location else None
+    )
+
+
+def index_submissions(submissions):
+    """
+    Save the indexed fields of raw submissions, replacing their previous values
+    :param submissions: A list of RawSubmissions
+    """
+    SubmissionIndex.objects.filter(submission__in=[subm.id for subm in submissions]).delete()
+    SubmissionIndex.objects.bulk_create([submission_index_row(subm) for subm in submissions])
+
+
+def index_missing_submissions(form_id, batch_size=None):
+    """
+    Index the submissions of a form which were saved without their index, eg by the parser or before the index existed
+    :param form_id: The ONA id of the form
+    """
+    batch_size = batch_size or getattr(settings, 'SYNC_PAGE_SIZE', 1000)
+    while True:
+        submissions = list(RawSubmissions.objects.filter(form__form_id=form_id, submission_index__isnull=True).only('id', 'form_id', 'uuid', 'raw_data')[:batch_size])
+        if len(submissions) == 0:
+            return
+        with transaction.atomic():
+            index_submissions(submissions)
+
+
+def reindex_submissions(form_id, batch_size=None):
+    """
+    Index all the submissions of a form again, eg after the parser re-pulled them in place
+    :param form_id: The ONA id of the form
+    """
+    batch_size = batch_size or getattr(settings, 'SYNC_PAGE_SIZE', 1000)
+    last_id = 0
+    while True:
+        submissions = list(RawSubmissions.objects.filter(form__form_id=form_id, id__gt=last_id).order_by('id').only('id', 'form_id', 'uuid', 'raw_data')[:batch_size])
+        if len(submissions) == 0:
+            return
+        with transaction.atomic():
+            index_submissions(submissions)
+        last_id = submissions[-1].id
+
+
+def index_saved_submission(sender, instance, created=False, update_fields=None, **kwargs):
+    """
+    Index a raw submission whenever it is saved, eg edited by the parser, so the index never lags behind the raw data.
+    A save of other fields only, eg marking the submission processed, leaves the index as it is
+    """
+    if update_fields is not None and 'raw_data' not in update_fields:
+        return
+    index_submissions([instance])
+
+
+def get_watermark(odk_form):
+    (watermark, is_created) = SyncWatermark.objects.get_or_create(form=odk_form)
+    return watermark
+
+
+def save_submissions(odk_form, submissions):
+    """
+    Add or replace the raw submissions of a page of synced submissions, with a query for the existing submissions and
+    a bulk update and a bulk insert instead of a query for each
+    :param odk_form: The ODKForm of the submissions
+    :param submissions: The submissions as returned by the ONA server
+    """
+    # a submission edited while the pages were being fetched can be in a page twice, the last copy is kept
+    submissions = dict((subm['_uuid'], subm) for subm in submissions)
+    existing = RawSubmissions.objects.filter(uuid__in=list(submissions.keys())).only('id', 'uuid')
+    existing = dict((raw_subm.uuid, raw_subm) for raw_subm in existing)
+
+    updated = []
+    created = []
+    for uuid, subm in submissions.items():
+        raw_subm = existing.get(uuid) or RawSubmissions(uuid=uuid)
+        raw_subm.form = odk_form
+        raw_subm.submission_time = subm['_submission_time']
+        raw_subm.raw_data = subm
+        (updated if raw_subm.id is not None else created).append(raw_subm)
+
+    RawSubmissions.objects.bulk_update(updated, ['form', 'submission_time', 'raw_data'])
+    RawSubmissions.objects.bulk_create(created)
+    # the ids of the inserted submissions aren't set on all the databases, so the submissions are read back to be indexed
+    index_submissions(list(RawSubmissions.objects.filter(uuid__in=list(submissions.keys())).only('id', 'form_id', 'uuid', 'raw_data')))
+
+
+def reset_watermark(odk_form):
+    """
+    Set the watermark of a form to its latest local submission, eg after the submissions were re-pulled by the parser
+    :param odk_form: The ODKForm whose watermark is reset
+    """
+    # the re-pulled submissions can have been saved without the model signals, so all of them are indexed again
+    reindex_submissions(odk_form.form_id)
+    watermark = get_watermark(odk_form)
+    latest = SubmissionIndex.objects.filter(form=odk_form).select_related('submission').order_by('-modified', '-id').first()
+    if latest is None:
+        watermark.last_modified = None
+        watermark.last_submission_id = 0
+    else:
+        raw_data = latest.submission.raw_data
+        raw_data = json.loads(raw_data) if isinstance(raw_data, str) else raw_data
+        watermark.last_modified = raw_data.get('_date_modified', raw_data.get('_submission_time'))
+        watermark.last_submission_id = max(watermark.last_submission_id, raw_data.get('_id') or 0)
+    watermark.save()
+
+
+def pull_new_submissions(parser, odk_form):
+    """
+    Fetch the submissions of a form which were added or edited on the ONA server since the last sync and save them as
+    raw submissions
+    :param parser: The OdkParser to use for reading the ONA settings
+    :param odk_form: The ODKForm to sync
+    :return: A list of the uuids of the added or edited submissions
+    """
+    (ona_url, ona_token) = ona_api_settings(parser)
+    watermark = get_watermark(odk_form)
+    page_size = getattr(settings, 'SYNC_PAGE_SIZE', 1000)
+
+    params = {'sort': json.dumps({'_date_modified': 1}), 'page_size': page_size}
+    if watermark.last_modified is not None:
+        # submissions modified in the same instant as the watermark are fetched again and just overwritten
+        params['query'] = json.dumps({'_date_modified': {'$gte': watermark.last_modified}})
+
+    previous_mark = watermark.last_modified
+    uuids = []
+    page = 1
+    while True:
+        params['page'] = page
+        response = parser_registry.http_session.get('%s/api/v1/data/%s' % (ona_url, odk_form.form_id), params=params, headers={'Authorization': 'Token %s' % ona_token}, timeout=ona_timeout())
+        if response.status_code == 404:
+            # ONA returns a 404 for a page past the last one
+            break
+        response.raise_for_status()
+        submissions = response.json()
+        if len(submissions) == 0:
+            break
+
+        with transaction.atomic():
+            save_submissions(odk_form, submissions)
+            uuids.extend(subm['_uuid'] for subm in submissions if subm.get('_date_modified') != previous_mark)
+
+            last = submissions[-1]
+            watermark.last_modified = last.get('_date_modified', last['_submission_time'])
+            watermark.last_submission_id = max(watermark.last_submission_id, max(subm['_id'] for subm in submissions))
+            watermark.save()
+
+        if len(submissions) < page_size:
+            break
+        page += 1
+
+    logging.info("Synced %d new or edited submissions for the form '%s'" % (len(uuids), odk_form.form_id))
+    return uuids
+
+
+def pull_form_submissions(parser, form_id):
+    """
+    Bring the local submissions of a single form up to date, logging rather than failing when the server can't be reached
+    :param parser: The OdkParser to use
+    :param form_id: The ONA id of the form
+    :return: The uuids of the added or edited submissions, None if the sync failed
+    """
+    try:
+        return pull_new_submissions(parser, ODKForm.objects.get(form_id=form_id))
+    except Exception:
+        logging.error(traceback.format_exc())
+        return None
+
+
+def sync_all_forms(parser, full_rebuild=False):
+    """
+    Bring the local raw submissions up to date with the ONA server
+    :param parser: The OdkParser to use
+    :param full_rebuild: Whether to re-pull the full history of all the forms instead of the changes since the last sync
+    :return: A tuple of the number of added or edited submissions, None for a full rebuild, and the ids of the forms
+        which could not be synced
+    """
+    if full_rebuild is True:
+        # the parser re-pulls and processes all the submissions, then the incremental syncs continue from them
+        parser.update_sdss_db()
+        for odk_form in ODKForm.objects.all():
+            reset_watermark(odk_form)
+        return (None, [])
+
+    no_synced = 0
+    failed_forms = []
+    for odk_form in ODKForm.objects.all():
+        # a form which fails to sync is logged and left for the next sync, without holding up the other forms
+        try:
+            no_synced += len(pull_new_submissions(parser, odk_form))
+        except Exception:
+            logging.error(traceback.format_exc())
+            failed_forms.append(odk_form.form_id)
+
+    return (no_synced, failed_forms)
+
+
+def ona_get(ona_url, ona_token, path):
+    # a json GET to the ONA API through the pooled session
+    response = parser_registry.http_session.get('%s%s' % (ona_url, path), headers={'Authorization': 'Token %s' % ona_token}, timeout=ona_timeout())
+    response.raise_for_status()
+    return response.json()
+
+
+def list_ona_forms(parser):
+    """
+    Get the ids of the forms on the ONA server, with a single request to the forms API
+    :param parser: The OdkParser to use for reading the ONA settings
+    :return: A list of the ONA ids of the forms
+    """
+    (ona_url, ona_token) = ona_api_settings(parser)
+    return [form['formid'] for form in ona_get(ona_url, ona_token, '/api/v1/forms')]
+
+
+def refresh_form(form_id, ona_url, ona_token):
+    """
+    Fetch the metadata and structure of a single form from the ONA server, saving the form and caching its structure.
+    Runs in a worker thread with its own parser and database connection
+    :param form_id: The ONA id of the form
+    :return: A dict with the outcome of the refresh
+    """
+    started = time.time()
+    ona_host = urlparse(ona_url).netloc
+    try:
+        rate_limiter.wait(ona_host)
+        metadata = ona_get(ona_url, ona_token, '/api/v1/forms/%s' % form_id)
+        ODKForm.objects.update_or_create(form_id=form_id, defaults={'form_name': metadata['title']})
+
+        # the parser fetches the structure of the form and defines it locally while building the cached tree
+        rate_limiter.wait(ona_host)
+        form_structures.rebuild(get_parser(), form_id)
+        return {'form_id': form_id, 'form_name': metadata['title'], 'error': False, 'seconds': round(time.time() - started, 2)}
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        return {'form_id': form_id, 'error': True, 'message': str(e), 'seconds': round(time.time() - started, 2)}
+    finally:
+        connection.close()
+
+
+def refresh_ona_forms(parser, form_ids, concurrency=None):
+    """
+    Refresh the forms from the ONA server in parallel, yielding the outcome of each form as it finishes
+    :param parser: The OdkParser to use for reading the ONA settings
+    :param form_ids: The ONA ids of the forms to refresh
+    :param concurrency: The maximum number of forms to refresh at the same time
+    :return: A generator of dicts with the outcome of each form
+    """
+    concurrency = concurrency or getattr(settings, 'REFRESH_FORMS_CONCURRENCY', 4)
+    (ona_url, ona_token) = ona_api_settings(parser)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='refresh_forms') as executor:
+        futures = [executor.submit(refresh_form, form_id, ona_url, ona_token) for form_id in form_ids]
+        for future in as_completed(futures):
+            yield future.result()
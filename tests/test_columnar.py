@@ -0,0 +1,95 @@
+import unittest
+
+from django.test import SimpleTestCase
+
+from odk_dashboard.columnar import ColumnType, pa, split_repeats, value_kind
+
+
+class ValueKindTest(SimpleTestCase):
+    def test_kinds(self):
+        self.assertEqual(value_kind(True), 'bool')
+        self.assertEqual(value_kind(3), 'int')
+        self.assertEqual(value_kind(3.5), 'float')
+        self.assertEqual(value_kind('3'), 'string')
+        self.assertEqual(value_kind({'a': 1}), 'string')
+
+    def test_ints_outside_int64_are_text(self):
+        self.assertEqual(value_kind(2 ** 63 - 1), 'int')
+        self.assertEqual(value_kind(2 ** 63), 'string')
+        self.assertEqual(value_kind(-2 ** 63 - 1), 'string')
+
+
+class ColumnTypeTest(SimpleTestCase):
+    def kind(self, *values):
+        column = ColumnType(10)
+        for value in values:
+            column.add(value)
+        return column.kind
+
+    def test_widening(self):
+        self.assertEqual(self.kind(1, 2), 'int')
+        self.assertEqual(self.kind(1, 2.5), 'float')
+        self.assertEqual(self.kind(2.5, 1), 'float')
+        self.assertEqual(self.kind(1, 'a'), 'string')
+        self.assertEqual(self.kind(True, 1), 'string')
+        self.assertEqual(self.kind(1, 2.5, 'a', 3), 'string')
+
+    def test_empty_values_are_ignored(self):
+        self.assertIsNone(self.kind(None, ''))
+        self.assertEqual(self.kind(None, 1, ''), 'int')
+
+    def test_distinct_values_are_counted_up_to_the_limit(self):
+        column = ColumnType(2)
+        for value in ('a', 'b', 'c', 'd', 'a'):
+            column.add(value)
+        self.assertEqual(len(column.distinct), 3)
+
+    @unittest.skipIf(pa is None, 'pyarrow is not installed')
+    def test_fields(self):
+        column = ColumnType(10)
+        for value in ('yes', 'no') * 10:
+            column.add(value)
+        self.assertTrue(pa.types.is_dictionary(column.field('answer', 20).type))
+        self.assertTrue(pa.types.is_string(column.field('answer', 19).type))
+        self.assertTrue(pa.types.is_string(ColumnType(10).field('empty', 20).type))
+
+        column = ColumnType(10)
+        column.add(1)
+        column.add(2.5)
+        self.assertTrue(pa.types.is_floating(column.field('weight', 2).type))
+
+
+class SplitRepeatsTest(SimpleTestCase):
+    def test_rows_without_repeats(self):
+        tables = []
+        row = {'_uuid': 'u1', 'name': 'a', 'tags': ['x', 'y'], 'empty': []}
+        self.assertEqual(split_repeats(row, 'submissions', 'u1', None, tables, {}), row)
+        self.assertEqual(tables, [])
+
+    def test_nested_repeats(self):
+        tables = []
+        row_ids = {}
+        row = {
+            '_uuid': 'u1',
+            'name': 'a',
+            'animals': [
+                {'animals/breed': 'boran', 'animals/calves': [{'animals/calves/sex': 'm'}, {'animals/calves/sex': 'f'}]},
+                {'animals/breed': 'sahiwal', 'animals/calves': [{'animals/calves/sex': 'f'}]},
+            ]
+        }
+        self.assertEqual(split_repeats(row, 'submissions', 'u1', None, tables, row_ids), {'_uuid': 'u1', 'name': 'a'})
+        self.assertEqual(tables, [
+            ('submissions.animals.calves', {'_submission_uuid': 'u1', '_row_id': 1, '_parent_row_id': 1, 'animals/calves/sex': 'm'}),
+            ('submissions.animals.calves', {'_submission_uuid': 'u1', '_row_id': 2, '_parent_row_id': 1, 'animals/calves/sex': 'f'}),
+            ('submissions.animals', {'_submission_uuid': 'u1', '_row_id': 1, '_parent_row_id': None, 'animals/breed': 'boran'}),
+            ('submissions.animals.calves', {'_submission_uuid': 'u1', '_row_id': 3, '_parent_row_id': 2, 'animals/calves/sex': 'f'}),
+            ('submissions.animals', {'_submission_uuid': 'u1', '_row_id': 2, '_parent_row_id': None, 'animals/breed': 'sahiwal'}),
+        ])
+        self.assertEqual(row_ids, {'submissions.animals': 2, 'submissions.animals.calves': 3})
+
+    def test_row_ids_continue_across_submissions(self):
+        tables = []
+        row_ids = {}
+        split_repeats({'animals': [{'animals/breed': 'boran'}]}, 'submissions', 'u1', None, tables, row_ids)
+        split_repeats({'animals': [{'animals/breed': 'sahiwal'}]}, 'submissions', 'u2', None, tables, row_ids)
+        self.assertEqual([(child_row['_submission_uuid'], child_row['_row_id']) for (name, child_row) in tables], [('u1', 1), ('u2', 2)])
@@ -0,0 +1,117 @@
+import csv
+import base64
+import datetime
+
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from odk_dashboard.exports import csv_stream, decode_cursor, encode_cursor, export_columns, ndjson_stream
+from odk_dashboard.sync import submission_modified, submission_time
+
+UTC = datetime.timezone.utc
+
+
+class CursorTest(SimpleTestCase):
+    def test_round_trip(self):
+        modified = datetime.datetime(2021, 3, 4, 5, 6, 7, 890000, tzinfo=UTC)
+        self.assertEqual(decode_cursor(encode_cursor(modified, 'uuid-1')), (modified, 'uuid-1'))
+
+    def test_keeps_the_offset(self):
+        modified = datetime.datetime(2021, 3, 4, 8, 6, 7, tzinfo=datetime.timezone(datetime.timedelta(hours=3)))
+        (decoded, uuid) = decode_cursor(encode_cursor(modified, 'uuid-1'))
+        self.assertEqual(decoded, modified)
+        self.assertEqual(decoded.astimezone(UTC).hour, 5)
+
+    def test_empty_cursor_starts_from_the_beginning(self):
+        self.assertIsNone(decode_cursor(None))
+        self.assertIsNone(decode_cursor(''))
+
+    def test_naive_times_are_utc(self):
+        cursor = base64.urlsafe_b64encode(b'{"modified": "2021-03-04T05:06:07", "uuid": "uuid-1"}').decode('ascii')
+        self.assertEqual(decode_cursor(cursor), (datetime.datetime(2021, 3, 4, 5, 6, 7, tzinfo=UTC), 'uuid-1'))
+
+    def test_invalid_cursors_are_rejected(self):
+        for cursor in ('not a cursor', base64.urlsafe_b64encode(b'{"uuid": "uuid-1"}').decode('ascii'),
+                       base64.urlsafe_b64encode(b'{"modified": "yesterday", "uuid": "uuid-1"}').decode('ascii')):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+
+class SubmissionTimeTest(SimpleTestCase):
+    def test_ona_times_are_utc(self):
+        self.assertEqual(submission_time('2021-03-04T05:06:07'), datetime.datetime(2021, 3, 4, 5, 6, 7, tzinfo=UTC))
+
+    def test_invalid_times(self):
+        self.assertIsNone(submission_time(None))
+        self.assertIsNone(submission_time('yesterday'))
+
+    def test_modified_falls_back_to_the_submission_time(self):
+        self.assertEqual(submission_modified({'_submission_time': '2021-03-04T05:06:07'}), datetime.datetime(2021, 3, 4, 5, 6, 7, tzinfo=UTC))
+        self.assertEqual(submission_modified('{"_date_modified": "2021-03-05T00:00:00", "_submission_time": "2021-03-04T05:06:07"}'), datetime.datetime(2021, 3, 5, tzinfo=UTC))
+        self.assertEqual(submission_modified({}), datetime.datetime(1970, 1, 1, tzinfo=UTC))
+
+    def test_times_with_and_without_fractions_are_ordered(self):
+        # the ONA times have microseconds only when they aren't 0, which would sort wrongly as text
+        times = ['2021-03-04T05:06:07.5', '2021-03-04T05:06:07', '2021-03-04T05:06:08', '2021-03-04T05:06:07.25']
+        ordered = sorted(times, key=lambda s_time: submission_modified({'_date_modified': s_time}))
+        self.assertEqual(ordered, ['2021-03-04T05:06:07', '2021-03-04T05:06:07.25', '2021-03-04T05:06:07.5', '2021-03-04T05:06:08'])
+
+
+STRUCTURE = [
+    {'id': 1, 'parent_id': None, 'name': 'respondent', 'type': 'text', 'label': 'Respondent'},
+    {'id': 2, 'parent_id': None, 'name': 'household', 'type': 'group', 'label': 'Household'},
+    {'id': 3, 'parent_id': 2, 'name': 'size', 'type': 'integer', 'label': 'Size'},
+    {'id': 4, 'parent_id': None, 'name': 'animals', 'type': 'repeat', 'label': 'Animals'},
+    {'id': 5, 'parent_id': 4, 'name': 'breed', 'type': 'text', 'label': 'Breed'},
+]
+
+
+def read_csv(lines):
+    return list(csv.reader(''.join(lines).splitlines()))
+
+
+class CsvStreamTest(SimpleTestCase):
+    def test_header_has_the_known_columns_then_the_first_row(self):
+        rows = [{'_uuid': 'a', 'size': 3, 'animals': [{'animals/breed': 'boran'}]}]
+        self.assertEqual(read_csv(csv_stream(iter(rows), ['respondent', 'size', 'animals'])), [
+            ['respondent', 'size', 'animals', '_uuid', '_extra'],
+            ['', '3', '[{"animals/breed": "boran"}]', 'a', ''],
+        ])
+
+    def test_later_columns_go_to_the_extra_column(self):
+        rows = [{'_uuid': 'a'}, {'_uuid': 'b', 'late': 1}]
+        self.assertEqual(read_csv(csv_stream(iter(rows))), [['_uuid', '_extra'], ['a', ''], ['b', '{"late": 1}']])
+
+    def test_rows_are_written_as_they_come(self):
+        def rows():
+            yield {'_uuid': 'a'}
+            raise AssertionError('the second row was read before the first was written')
+        lines = csv_stream(rows())
+        self.assertEqual(next(lines), '_uuid,_extra\r\n')
+        self.assertEqual(next(lines), 'a,\r\n')
+
+    def test_no_rows_still_writes_the_header(self):
+        self.assertEqual(read_csv(csv_stream(iter([]), ['respondent'])), [['respondent', '_extra']])
+
+    def test_ndjson(self):
+        self.assertEqual(list(ndjson_stream(iter([{'a': 1}]))), ['{"a": 1}\n'])
+
+
+class ExportColumnsTest(SimpleTestCase):
+    def columns(self, nodes=None):
+        with mock.patch('odk_dashboard.exports.form_structures') as form_structures:
+            form_structures.get.return_value = (STRUCTURE, '"etag"')
+            return export_columns(None, 1, nodes)
+
+    def test_questions_and_repeats_in_form_order(self):
+        # the groups are left out and the questions of a repeat are in the repeat's column
+        self.assertEqual(self.columns(), ['respondent', 'size', 'animals'])
+
+    def test_only_the_selected_nodes(self):
+        self.assertEqual(self.columns(['size', 'breed', 'animals']), ['size', 'animals'])
+
+    def test_no_columns_without_a_structure(self):
+        with mock.patch('odk_dashboard.exports.form_structures') as form_structures:
+            form_structures.get.side_effect = Exception('The form was not found')
+            self.assertEqual(export_columns(None, 1), [])
@@ -0,0 +1,73 @@
+from django.test import SimpleTestCase
+
+from odk_dashboard import geo
+
+
+class DouglasPeuckerTest(SimpleTestCase):
+    def test_drops_points_within_the_tolerance(self):
+        line = [[0, 0], [1, 0.01], [2, -0.01], [3, 0]]
+        self.assertEqual(geo.douglas_peucker(line, 0.1), [[0, 0], [3, 0]])
+
+    def test_keeps_points_beyond_the_tolerance(self):
+        line = [[0, 0], [1, 1], [2, 0]]
+        self.assertEqual(geo.douglas_peucker(line, 0.5), line)
+
+    def test_short_lines_are_kept(self):
+        self.assertEqual(geo.douglas_peucker([[0, 0], [1, 1]], 10), [[0, 0], [1, 1]])
+
+    def test_keeps_the_end_points(self):
+        line = [[float(i), (i % 2) * 0.001] for i in range(50)]
+        simplified = geo.douglas_peucker(line, 0.01)
+        self.assertEqual(simplified[0], line[0])
+        self.assertEqual(simplified[-1], line[-1])
+
+    def test_perpendicular_distance(self):
+        self.assertAlmostEqual(geo.perpendicular_distance([1, 1], [0, 0], [2, 0]), 1.0)
+        # a degenerate segment is measured from its point
+        self.assertAlmostEqual(geo.perpendicular_distance([3, 4], [0, 0], [0, 0]), 5.0)
+
+
+class SimplifyPolygonTest(SimpleTestCase):
+    def test_tiny_outer_rings_are_kept(self):
+        ring = [[0, 0], [0.0001, 0], [0.0001, 0.0001], [0, 0]]
+        self.assertEqual(geo.simplify_polygon([ring], 1.0, 4), [ring])
+
+    def test_tiny_holes_are_dropped(self):
+        outer = [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]
+        hole = [[5, 5], [5.0001, 5], [5.0001, 5.0001], [5, 5]]
+        self.assertEqual(geo.simplify_polygon([outer, hole], 0.5, 4), [outer])
+
+    def test_zoom_precision_grows_with_the_zoom(self):
+        self.assertLess(geo.zoom_precision(2), geo.zoom_precision(12))
+
+
+class GeohashTest(SimpleTestCase):
+    def test_encodes_known_points(self):
+        self.assertEqual(geo.geohash_encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(geo.geohash_encode(-1.286389, 36.817223, 5), 'kzf0t')
+
+    def test_shorter_precisions_are_prefixes(self):
+        geohash = geo.geohash_encode(-1.286389, 36.817223, geo.GEOHASH_PRECISION)
+        self.assertEqual(len(geohash), geo.GEOHASH_PRECISION)
+        self.assertTrue(geohash.startswith(geo.geohash_encode(-1.286389, 36.817223, 4)))
+
+    def test_zoom_precision_is_bounded(self):
+        self.assertEqual(geo.zoom_geohash_precision(0), 1)
+        self.assertEqual(geo.zoom_geohash_precision(30), geo.GEOHASH_PRECISION)
+        self.assertLessEqual(geo.zoom_geohash_precision(6), geo.zoom_geohash_precision(10))
+
+
+class SubmissionLocationTest(SimpleTestCase):
+    def test_reads_the_geolocation_list(self):
+        self.assertEqual(geo.submission_location({'_geolocation': [-1.5, 36.8]}), (-1.5, 36.8))
+
+    def test_reads_an_odk_geopoint_string(self):
+        with self.settings(SUBMISSION_GEO_FIELD='location'):
+            self.assertEqual(geo.submission_location({'location': '-1.5 36.8 1700 5'}), (-1.5, 36.8))
+
+    def test_invalid_points_are_skipped(self):
+        self.assertIsNone(geo.submission_location({}))
+        self.assertIsNone(geo.submission_location({'_geolocation': [None, None]}))
+        self.assertIsNone(geo.submission_location({'_geolocation': ['nan', 36.8]}))
+        self.assertIsNone(geo.submission_location({'_geolocation': [91, 36.8]}))
+        self.assertIsNone(geo.submission_location({'_geolocation': [1.0]}))
@@ -0,0 +1,43 @@
+import json
+
+from django.test import RequestFactory, SimpleTestCase
+
+from odk_dashboard.grid import GridParams
+
+
+def grid_params(**params):
+    query = dict((key, value if isinstance(value, str) else json.dumps(value)) for (key, value) in params.items())
+    query.setdefault('perPage', '10')
+    query.setdefault('offset', '0')
+    return GridParams(RequestFactory().get('/', query))
+
+
+class GridParamsTest(SimpleTestCase):
+    def test_paging(self):
+        params = grid_params(perPage=10, offset=20)
+        self.assertEqual((params.per_page, params.offset, params.cur_page), (10, 20, 3))
+        self.assertEqual(params.as_args(), (3, 10, 20, None, None))
+
+    def test_page_size_is_capped(self):
+        with self.settings(GRID_MAX_PER_PAGE=50):
+            self.assertEqual(grid_params(perPage=1000).per_page, 50)
+        self.assertEqual(grid_params(perPage=1000).per_page, 100)
+        self.assertEqual(grid_params(perPage=0).per_page, 1)
+        self.assertEqual(grid_params(offset=-5).offset, 0)
+
+    def test_sorts_and_queries(self):
+        params = grid_params(sorts={'err_code': -1}, queries={'search': 'abc'})
+        self.assertEqual(params.sorts, {'err_code': -1})
+        self.assertEqual(params.queries, {'search': 'abc'})
+
+    def test_sort(self):
+        self.assertEqual(grid_params(sorts={'err_code': -1}).sort(('id', 'err_code')), ('err_code', True))
+        self.assertEqual(grid_params(sorts={'err_code': 1}).sort(('id', 'err_code')), ('err_code', False))
+        # only the indexed columns can be sorted on
+        self.assertEqual(grid_params(sorts={'err_message': 1}).sort(('id', 'err_code')), ('id', False))
+        self.assertEqual(grid_params().sort(('id', 'err_code')), ('id', False))
+
+    def test_after(self):
+        self.assertEqual(grid_params(after=['E01', 42]).after, ['E01', 42])
+        self.assertIsNone(grid_params(after='').after)
+        self.assertIsNone(grid_params().after)
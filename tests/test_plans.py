@@ -0,0 +1,126 @@
+import datetime
+
+from decimal import Decimal
+
+from django.test import SimpleTestCase
+
+from odk_dashboard.plans import MappingPlan, TablePlan, topological_order, type_coercer, value_extractor
+
+
+def mapping(table, column, question, db_type='character varying(100)', **kwargs):
+    return dict({'dest_table_name': table, 'dest_column_name': column, 'form_question': question, 'db_question_type': db_type}, **kwargs)
+
+
+class TypeCoercerTest(SimpleTestCase):
+    def test_coerces_to_the_column_type(self):
+        self.assertEqual(type_coercer('integer')('12'), 12)
+        self.assertEqual(type_coercer('bigint')('12.0'), 12)
+        self.assertEqual(type_coercer('double precision')('1.5'), 1.5)
+        self.assertEqual(type_coercer('numeric(10,2)')('1.25'), Decimal('1.25'))
+        self.assertEqual(type_coercer('boolean')('Yes'), True)
+        self.assertEqual(type_coercer('boolean')('0'), False)
+        self.assertEqual(type_coercer('date')('2021-03-04T05:06:07'), datetime.date(2021, 3, 4))
+        self.assertEqual(type_coercer('timestamp with time zone')('2021-03-04T05:06:07').hour, 5)
+        self.assertEqual(type_coercer('character varying(50)')(12), '12')
+
+    def test_longer_prefixes_win(self):
+        # datetime starts with date, and bigint with int
+        self.assertIsInstance(type_coercer('datetime')('2021-03-04T05:06:07'), datetime.datetime)
+        self.assertEqual(type_coercer('smallint')('3'), 3)
+
+    def test_unknown_types_are_text(self):
+        self.assertEqual(type_coercer(None)(1), '1')
+        self.assertEqual(type_coercer('jsonb')(1), '1')
+
+    def test_empty_values_are_null(self):
+        self.assertIsNone(type_coercer('integer')(''))
+        self.assertIsNone(type_coercer('integer')(None))
+
+    def test_invalid_values_raise_a_value_error(self):
+        for (db_type, value) in (('integer', 'twelve'), ('numeric', 'abc'), ('date', 'yesterday'), ('timestamp', 'yesterday')):
+            with self.assertRaises(ValueError):
+                type_coercer(db_type)(value)
+
+
+class ValueExtractorTest(SimpleTestCase):
+    def test_top_level_question(self):
+        self.assertEqual(value_extractor('age')({'age': 5}), [5])
+
+    def test_missing_question(self):
+        self.assertEqual(value_extractor('age')({}), [])
+        self.assertEqual(value_extractor('age')(None), [])
+
+    def test_question_in_a_group(self):
+        self.assertEqual(value_extractor('household/size')({'household/size': 4}), [4])
+
+    def test_question_in_nested_repeats(self):
+        submission = {'animals': [
+            {'animals/breed': 'boran', 'animals/calves': [{'animals/calves/sex': 'm'}, {'animals/calves/sex': 'f'}]},
+            {'animals/breed': 'sahiwal', 'animals/calves': [{'animals/calves/sex': 'f'}]},
+        ]}
+        self.assertEqual(value_extractor('animals/breed')(submission), ['boran', 'sahiwal'])
+        self.assertEqual(value_extractor('animals/calves/sex')(submission), ['m', 'f', 'f'])
+
+
+class TablePlanTest(SimpleTestCase):
+    def test_repeat_rows_share_the_values_outside_the_repeat(self):
+        table = TablePlan('animals')
+        table.add_column(mapping('animals', 'farmer', 'farmer'))
+        table.add_column(mapping('animals', 'breed', 'animals/breed'))
+        table.add_column(mapping('animals', 'weight', 'animals/weight', 'integer'))
+        rows = table.rows({'farmer': 'f1', 'animals': [{'animals/breed': 'boran', 'animals/weight': '300'}, {'animals/breed': 'sahiwal', 'animals/weight': ''}]}, None)
+        self.assertEqual(rows, [
+            {'farmer': 'f1', 'breed': 'boran', 'weight': 300},
+            {'farmer': 'f1', 'breed': 'sahiwal', 'weight': None},
+        ])
+
+    def test_current_time_columns(self):
+        now = datetime.datetime(2021, 3, 4)
+        table = TablePlan('farmers')
+        table.add_column(mapping('farmers', 'name', 'name'))
+        table.add_column(mapping('farmers', 'processed_at', 'name', use_current_time=True))
+        self.assertEqual(table.rows({'name': 'a'}, now), [{'name': 'a', 'processed_at': now}])
+
+
+class MappingPlanTest(SimpleTestCase):
+    def plan(self, mappings, keys=None):
+        db_tables = [{'id': 1, 'title': 'farmers'}, {'id': 2, 'title': 'animals'}]
+        tables_columns = [{'parent_id': 1, 'title': 'code'}, {'parent_id': 2, 'title': 'farmer'}, {'parent_id': 2, 'title': 'breed'}]
+        return MappingPlan(mappings, db_tables, tables_columns, {'animals': {'farmers'}}, keys or {})
+
+    def test_parents_are_written_first(self):
+        plan = self.plan([mapping('animals', 'breed', 'animals/breed'), mapping('farmers', 'code', 'code', is_record_identifier=True)])
+        self.assertEqual(plan.table_order, ['farmers', 'animals'])
+
+    def test_missing_tables_and_columns_are_errors(self):
+        plan = self.plan([mapping('cows', 'breed', 'breed'), mapping('animals', 'colour', 'colour')])
+        self.assertEqual([comment['type'] for comment in plan.comments], ['danger', 'danger'])
+
+    def test_foreign_keys_get_the_parent_identifier(self):
+        keys = {'farmers': {'unique': ['code']}, 'animals': {'foreign_keys': {'farmer': ['farmers', 'code']}}}
+        plan = self.plan([mapping('farmers', 'code', 'code', is_record_identifier=True), mapping('animals', 'breed', 'animals/breed')], keys)
+        table_rows = plan.table_rows({'code': 'F1', 'animals': [{'animals/breed': 'boran'}, {'animals/breed': 'sahiwal'}]}, None)
+        self.assertEqual([(table.name, rows) for (table, rows) in table_rows], [
+            ('farmers', [{'code': 'F1'}]),
+            ('animals', [{'breed': 'boran', 'farmer': 'F1'}, {'breed': 'sahiwal', 'farmer': 'F1'}]),
+        ])
+        self.assertEqual(plan.comments, [])
+
+    def test_unmapped_questions(self):
+        plan = self.plan([mapping('farmers', 'code', 'code'), mapping('animals', 'breed', 'animals/breed')])
+        structure = [
+            {'id': 1, 'parent_id': None, 'name': 'code', 'type': 'text'},
+            {'id': 2, 'parent_id': None, 'name': 'animals', 'type': 'repeat'},
+            {'id': 3, 'parent_id': 2, 'name': 'breed', 'type': 'text'},
+            {'id': 4, 'parent_id': 2, 'name': 'colour', 'type': 'text'},
+        ]
+        self.assertEqual(plan.unmapped_questions(structure), (2, ['colour']))
+
+
+class TopologicalOrderTest(SimpleTestCase):
+    def test_referenced_tables_come_first(self):
+        self.assertEqual(topological_order(['c', 'a', 'b'], {'c': {'b'}, 'b': {'a'}}), ['a', 'b', 'c'])
+        self.assertEqual(topological_order(['a', 'b'], {'a': {'b', 'x'}}), ['b', 'a'])
+
+    def test_cycles_terminate(self):
+        self.assertEqual(sorted(topological_order(['a', 'b'], {'a': {'b'}, 'b': {'a'}})), ['a', 'b'])
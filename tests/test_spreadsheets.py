@@ -0,0 +1,91 @@
+import os
+import re
+import shutil
+import zipfile
+import tempfile
+
+from django.test import SimpleTestCase
+
+from odk_dashboard.spreadsheets import StreamingWorkbook, column_letter, iter_questions, label_text, repeat_sheets
+
+
+class ColumnLetterTest(SimpleTestCase):
+    def test_letters(self):
+        self.assertEqual([column_letter(index) for index in (0, 25, 26, 701, 702, 16383)], ['A', 'Z', 'AA', 'ZZ', 'AAA', 'XFD'])
+
+
+class RepeatSheetsTest(SimpleTestCase):
+    def test_sheets_are_named_from_the_repeats(self):
+        structure = [
+            {'id': 1, 'parent_id': None, 'name': 'farmer', 'type': 'group'},
+            {'id': 2, 'parent_id': 1, 'name': 'farmer/animals', 'type': 'repeat'},
+            {'id': 3, 'parent_id': 2, 'name': 'breed', 'type': 'text'},
+            {'id': 4, 'parent_id': 2, 'name': 'calves', 'type': 'repeat'},
+            {'id': 5, 'parent_id': None, 'name': 'visits', 'type': 'repeat'},
+        ]
+        self.assertEqual(list(repeat_sheets(structure)), ['animals', 'animals.calves', 'visits'])
+
+
+class FormDefinitionTest(SimpleTestCase):
+    def test_label_text(self):
+        self.assertEqual(label_text('Name'), 'Name')
+        self.assertEqual(label_text({'English': 'Name', 'Swahili': 'Jina'}), 'English: Name / Swahili: Jina')
+
+    def test_iter_questions(self):
+        children = [
+            {'name': 'name', 'type': 'text'},
+            {'name': 'animals', 'type': 'repeat', 'children': [{'name': 'breed', 'type': 'select one'}]},
+        ]
+        self.assertEqual([path for (path, question) in iter_questions(children)], ['name', 'animals', 'animals/breed'])
+
+
+class StreamingWorkbookTest(SimpleTestCase):
+    def setUp(self):
+        self.export_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.export_dir)
+
+    def save(self, sheets, order=None, **settings):
+        with self.settings(EXPORT_JOB_DIR=self.export_dir, **settings):
+            workbook = StreamingWorkbook()
+            for (name, rows) in sheets:
+                for row in rows:
+                    workbook.sheet(name).add(row)
+            filename = workbook.save(os.path.join(self.export_dir, 'export.xlsx'), order)
+        with zipfile.ZipFile(filename) as zip_file:
+            return dict((name, zip_file.read(name).decode('utf-8')) for name in zip_file.namelist())
+
+    def test_sheets_follow_the_order(self):
+        parts = self.save([('submissions.animals', [{'breed': 'boran'}]), ('submissions', [{'name': 'a'}]), ('extra', [{'x': 1}])], ['submissions', 'submissions.animals'])
+        self.assertEqual(re.findall(r'<sheet name="([^"]+)"', parts['xl/workbook.xml']), ['submissions', 'submissions.animals', 'extra'])
+        self.assertIn('xl/worksheets/sheet3.xml', parts)
+
+    def test_titles_are_valid_and_unique(self):
+        name = 'a' * 40
+        parts = self.save([(name + '/1', [{'x': 1}]), (name + '/2', [{'x': 2}])])
+        self.assertEqual(re.findall(r'<sheet name="([^"]+)"', parts['xl/workbook.xml']), ['a' * 31, 'a' * 29 + '~2'])
+
+    def test_cells(self):
+        parts = self.save([('submissions', [{'name': 'a', 'age': 3, 'weight': 2.5, 'alive': True, 'tags': ['x'], 'note': ''}])])
+        sheet = parts['xl/worksheets/sheet1.xml']
+        self.assertIn('<c r="B2"><v>3</v></c>', sheet)
+        self.assertIn('<c r="C2"><v>2.5</v></c>', sheet)
+        self.assertIn('<c r="D2" t="b"><v>1</v></c>', sheet)
+        self.assertIn('<c r="E2" t="s">', sheet)
+        # empty values have no cell
+        self.assertNotIn('r="F2"', sheet)
+        self.assertIn('<t xml:space="preserve">["x"]</t>', parts['xl/sharedStrings.xml'])
+
+    def test_strings_are_shared(self):
+        parts = self.save([('submissions', [{'breed': 'boran'}, {'breed': 'boran'}, {'breed': 'sahiwal'}])])
+        self.assertIn('count="4" uniqueCount="3"', parts['xl/sharedStrings.xml'])
+        self.assertEqual(re.findall(r'<t xml:space="preserve">([^<]*)</t>', parts['xl/sharedStrings.xml']), ['breed', 'boran', 'sahiwal'])
+
+    def test_strings_past_the_cap_are_inline(self):
+        parts = self.save([('submissions', [{'breed': 'boran'}, {'breed': 'sahiwal'}, {'breed': 'boran'}])], XLSX_MAX_SHARED_STRINGS=2)
+        self.assertIn('uniqueCount="2"', parts['xl/sharedStrings.xml'])
+        self.assertIn('<c r="A3" t="inlineStr"><is><t xml:space="preserve">sahiwal</t></is></c>', parts['xl/worksheets/sheet1.xml'])
+        self.assertIn('<c r="A4" t="s"><v>1</v></c>', parts['xl/worksheets/sheet1.xml'])
+
+    def test_invalid_xml_characters_are_removed(self):
+        parts = self.save([('submissions', [{'note': 'a\x00b <c>'}])], XLSX_MAX_SHARED_STRINGS=1)
+        self.assertIn('<t xml:space="preserve">ab &lt;c&gt;</t>', parts['xl/worksheets/sheet1.xml'])
@@ -0,0 +1,63 @@
+import gzip
+import json
+import unittest
+
+from django.test import RequestFactory, SimpleTestCase
+
+from odk_dashboard.utilities import accepted_encoding, brotli, json_response
+
+DATA = {'rows': [{'id': i, 'name': 'row %d' % i} for i in range(50)]}
+
+
+class AcceptedEncodingTest(SimpleTestCase):
+    def request(self, accept_encoding):
+        return RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+
+    def test_no_request(self):
+        self.assertIsNone(accepted_encoding(None))
+
+    def test_gzip(self):
+        self.assertEqual(accepted_encoding(self.request('gzip, deflate')), 'gzip')
+        self.assertEqual(accepted_encoding(self.request('deflate;q=1.0, gzip;q=0.5')), 'gzip')
+
+    def test_no_accepted_encoding(self):
+        self.assertIsNone(accepted_encoding(RequestFactory().get('/')))
+        self.assertIsNone(accepted_encoding(self.request('deflate')))
+
+    def test_brotli_only_when_installed(self):
+        self.assertEqual(accepted_encoding(self.request('gzip, br')), 'gzip' if brotli is None else 'br')
+        self.assertEqual(accepted_encoding(self.request('br')), None if brotli is None else 'br')
+
+
+class JsonResponseTest(SimpleTestCase):
+    def test_gzip(self):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip')
+        with self.settings(JSON_COMPRESS_MIN_SIZE=0):
+            response = json_response(DATA, request)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertEqual(json.loads(gzip.decompress(response.content)), DATA)
+
+    @unittest.skipIf(brotli is None, 'brotli is not installed')
+    def test_brotli(self):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip, br')
+        with self.settings(JSON_COMPRESS_MIN_SIZE=0):
+            response = json_response(DATA, request)
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(brotli.decompress(response.content)), DATA)
+
+    def test_small_payloads_are_not_compressed(self):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip')
+        with self.settings(JSON_COMPRESS_MIN_SIZE=10 ** 6):
+            response = json_response(DATA, request)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(json.loads(response.content), DATA)
+
+    def test_without_a_request(self):
+        with self.settings(JSON_COMPRESS_MIN_SIZE=0):
+            response = json_response(DATA)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Content-Type'], 'text/json')
+        self.assertEqual(json.loads(response.content), DATA)
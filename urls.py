@@ -10,12 +10,17 @@ urlpatterns = [
     re_path(r'^download/$', views.download_page, name='download_page'),
     re_path(r'^manage_views/$', views.manage_views, name='manage_views'),
     re_path(r'^manage_mappings/$', views.manage_mappings, name='manage_mappings'),
+    re_path(r'^table_columns/$', views.table_columns, name='table_columns'),
+    re_path(r'^refresh_schema/$', views.refresh_schema, name='refresh_schema'),
     re_path(r'^edit_view/$', views.modify_view, name='modify_view'),
     re_path(r'^delete_view/$', views.modify_view, name='modify_view'),
     re_path(r'^get_data/$', views.download_data, name='download_data'),
     re_path(r'^get_dictionary/$', views.download_dictionary, name='download_dictionary'),
     re_path(r'^get_structure/$', views.download_structure, name='download_structure'),
     re_path(r'^get_xls_form/$', views.download_xlsform, name='download_xlsform'),
+    re_path(r'^export_job_status/$', views.export_job_status, name='export_job_status'),
+    re_path(r'^export_job_download/$', views.export_job_download, name='export_job_download'),
+    re_path(r'^export_manifest/$', views.export_manifest, name='export_manifest'),
     re_path(r'^refresh_forms/$', views.refresh_forms, name='refresh_forms'),
     re_path(r'^create_mapping/$', views.create_mapping, name='create_mapping'),
     re_path(r'^edit_mapping/$', views.edit_mapping, name='edit_mapping'),
@@ -29,8 +34,10 @@ urlpatterns = [
     re_path(r'^fetch_single_error/$', views.fetch_single_error, name='fetch_single_error'),
     re_path(r'^map_visualization/$', views.map_visualization, name='map_visualization'),
     re_path(r'^first_level_geojson/$', views.first_level_geojson, name='first_level_geojson'),
+    re_path(r'^map_aggregates/$', views.map_aggregates, name='map_aggregates'),
     re_path(r'^save_json_edits/$', views.save_json_edits, name='save_json_edits'),
     re_path(r'^process_single_submission/$', views.process_single_submission, name='process_single_submission'),
+    re_path(r'^reprocess_errors/$', views.reprocess_errors, name='reprocess_errors'),
     re_path(r'^processing_status/$', views.processing_status, name='processing_status'),
     re_path(r'^fetch_processing_status/$', views.fetch_processing_status, name='fetch_processing_status'),
     re_path(r'^system_settings/$', views.system_settings, name='system_settings'),
@@ -42,7 +49,9 @@ urlpatterns = [
     re_path(r'^form_groups_info/$', views.form_groups_info, name='form_groups_info'),
     re_path(r'^save_group_details/$', views.save_group_details, name='save_group_details'),
     re_path(r'^refresh_view_data/$', views.refresh_view_data, name='refresh_view_data'),
+    re_path(r'^save_view_schedule/$', views.save_view_schedule, name='save_view_schedule'),
 
+    re_path(r'^metrics/$', views.metrics, name='metrics'),
     re_path(r'^record_viewer/$', views.record_viewer, name='record_viewer'),
     re_path(r'^submissions_search/$', views.submissions_search, name='submissions_search'),
     re_path(r'^raw_submission/$', views.fetch_submission, name='fetch_submission'),
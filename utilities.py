@@ -1,23 +1,125 @@
-import gzip
 import os
+import gzip
+import json
 import magic
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 from io import BytesIO as IO
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.conf import settings
 
+from odk_dashboard.instrumentation import timed_serialisation
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def json_dumps(data):
+    """
+    Serialise the data to json bytes, using orjson when it is installed
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=str).encode('utf-8')
 
-def zip_response(json_data):
-    gzip_buffer = IO()
-    gzip_file = gzip.GzipFile(mode='w', compresslevel=6, fileobj=gzip_buffer)
-    gzip_file.write(json_data)
-    gzip_file.close()
 
-    response = HttpResponse(gzip_buffer.getvalue())
-    response['Content-Encoding'] = 'gzip'
+def accepted_encoding(request):
+    """
+    Get the best compression accepted by the client
+    :param request: The current request
+    :return: 'br', 'gzip' or None
+    """
+    if request is None:
+        return None
+
+    accepted = [enc.split(';')[0].strip() for enc in request.META.get('HTTP_ACCEPT_ENCODING', '').split(',')]
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def json_response(data, request=None, content_type='text/json'):
+    """
+    Create a json response, compressed with brotli or gzip when the client accepts it and the payload is large enough
+    :param data: The data to send
+    :param request: The current request, used for negotiating the compression
+    :param content_type: The content type of the response
+    :return: An HttpResponse
+    """
+    with timed_serialisation():
+        return compressed_response(json_dumps(data), request, content_type)
+
+
+def compressed_response(body, request=None, content_type='text/json'):
+    """
+    Create a response from an already serialised body, compressed as negotiated with the client
+    :param body: The bytes to send
+    :param request: The current request, used for negotiating the compression
+    :param content_type: The content type of the response
+    :return: An HttpResponse
+    """
+    encoding = accepted_encoding(request) if len(body) >= getattr(settings, 'JSON_COMPRESS_MIN_SIZE', 1024) else None
+
+    if encoding == 'br':
+        body = brotli.compress(body, quality=getattr(settings, 'BROTLI_QUALITY', 4))
+    elif encoding == 'gzip':
+        gzip_buffer = IO()
+        with gzip.GzipFile(mode='wb', compresslevel=6, fileobj=gzip_buffer) as gzip_file:
+            gzip_file.write(body)
+        body = gzip_buffer.getvalue()
+
+    response = HttpResponse(body, content_type=content_type)
     response['Vary'] = 'Accept-Encoding'
-    response['Content-Type'] = 'application/json'
-    response['Content-Length'] = len(gzip_buffer.getvalue())
+    response['Content-Length'] = len(body)
+    if encoding is not None:
+        response['Content-Encoding'] = encoding
+
+    return response
+
+
+def iter_file_chunks(filename, chunk_size=None, delete=True):
+    """
+    Read a file in fixed size chunks, optionally deleting it once the last chunk has been sent
+    :param filename: The full path of the file to read
+    :param chunk_size: The number of bytes to read at a time
+    :param delete: Whether to remove the file once it has been read or the client disconnects
+    :return: A generator of byte chunks
+    """
+    chunk_size = chunk_size or getattr(settings, 'EXPORT_CHUNK_SIZE', 64 * 1024)
+    try:
+        with open(filename, 'rb') as in_file:
+            while True:
+                chunk = in_file.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        if delete and os.path.exists(filename):
+            os.remove(filename)
+
+
+def stream_file_response(filename, content_type=XLSX_CONTENT_TYPE, delete=True):
+    """
+    Send a file on disk to the client without loading it in memory
+    :param filename: The full path of the file to send
+    :param content_type: The mime type of the file
+    :param delete: Whether to remove the file after the last chunk has been sent
+    :return: A StreamingHttpResponse with the file as an attachment
+    """
+    file_size = os.path.getsize(filename)
+    response = StreamingHttpResponse(iter_file_chunks(filename, delete=delete), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename=%s' % os.path.basename(filename)
+    response['Content-Length'] = file_size
 
     return response
 
@@ -4,9 +4,7 @@ import os
 import json
 import logging
 import traceback
-import gzip
 
-from io import StringIO as IO
 from django.contrib.auth.tokens import PasswordResetTokenGenerator
 from django.conf import settings
 from django.contrib.auth import authenticate, login, logout, get_user_model
@@ -14,7 +12,7 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.hashers import make_password
 from django.contrib.sites.shortcuts import get_current_site
 from django.core.exceptions import ValidationError
-from django.http.response import HttpResponse, HttpResponseRedirect
+from django.http.response import HttpResponse, HttpResponseNotModified, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.middleware import csrf
 from django_registration.exceptions import ActivationError
@@ -30,11 +28,29 @@ from django.urls import reverse
 
 from wsgiref.util import FileWrapper
 
-from vendor.odk_parser import OdkParser
 from vendor.terminal_output import Terminal
 from vendor.models import ODKForm, FormViews, Profile, RawSubmissions
 from vendor.notifications import Notification
 
+from odk_dashboard import geo
+from odk_dashboard.bulk import bulk_process_submissions
+from odk_dashboard.caches import form_structures, submissions_cache
+from odk_dashboard.catalogue import form_catalogue
+from odk_dashboard.columnar import COLUMNAR_FORMATS, write_columnar_export
+from odk_dashboard.decorators import ona_settings_required, invalidate_settings_gate
+from odk_dashboard.exports import STREAMING_FORMATS, delta_export, get_manifest, save_manifest, stream_export
+from odk_dashboard.grid import GridParams, fetch_grid_page, invalidate_grid, processing_errors_grid
+from odk_dashboard.instrumentation import view_metrics
+from odk_dashboard.jobs import export_jobs
+from odk_dashboard.materialize import materialized_rows, materialized_view, refresh_materialized_view, view_stats
+from odk_dashboard.plans import mapping_plans
+from odk_dashboard.registry import get_parser, parser_registry
+from odk_dashboard.schema import schema_catalogue
+from odk_dashboard.search import search_submissions
+from odk_dashboard.spreadsheets import write_form_dictionary, write_form_structure, write_xlsx_export
+from odk_dashboard.sync import index_missing_submissions, index_submissions, list_ona_forms, pull_form_submissions, refresh_ona_forms, sync_all_forms
+from odk_dashboard.utilities import compressed_response, json_response, stream_file_response
+
 from raven import Client
 from sentry_sdk import init as sentry_init, capture_exception as sentry_ce
 
@@ -294,18 +310,13 @@ def recover_password(request):
 
 
 # @login_required(login_url='/login')
+@ona_settings_required(db_settings_only=True)
 def download_page(request):
     csrf_token = get_or_create_csrf_token(request)
 
     # get all the data to be used to construct the tree
-    parser = OdkParser()
-    is_first_login = parser.is_first_login()
-    if settings.USE_DB_SETTINGS:
-        are_ona_settings_saved = parser.are_ona_settings_saved()
-        if is_first_login is True or are_ona_settings_saved is False:
-            return system_settings(request)
-
-    all_forms = parser.get_all_forms()
+    parser = get_parser()
+    all_forms = form_catalogue.get_all_forms(parser)
     page_settings = {
         'page_title': "%s | Downloads" % settings.SITE_NAME,
         'csrf_token': csrf_token,
@@ -317,13 +328,9 @@ def download_page(request):
 
 
 # @login_required(login_url='/login')
+@ona_settings_required
 def modify_view(request):
-
-    parser = OdkParser()
-    is_first_login = parser.is_first_login()
-    are_ona_settings_saved = parser.are_ona_settings_saved()
-    if is_first_login is True or are_ona_settings_saved is False:
-        return system_settings(request)
+    parser = get_parser()
 
     if (request.get_full_path() == '/edit_view/'):
         response = parser.edit_view(request)
@@ -334,17 +341,17 @@ def modify_view(request):
 
 
 # @login_required(login_url='/login')
+@ona_settings_required
 def manage_views(request):
     csrf_token = get_or_create_csrf_token(request)
 
     # get all the data to be used to construct the tree
-    parser = OdkParser()
-    is_first_login = parser.is_first_login()
-    are_ona_settings_saved = parser.are_ona_settings_saved()
-    if is_first_login is True or are_ona_settings_saved is False:
-        return system_settings(request)
-
+    parser = get_parser()
     all_data = parser.get_views_info()
+    # the record counts and refresh times are read from the stored statistics of the materialized views
+    stats = view_stats()
+    for view in all_data.get('views', []):
+        view.update(stats.get(view['view_id'], {'no_records': None, 'last_refresh_at': None}))
 
     page_settings = {
         'page_title': "%s | Manage Generated Views" % settings.SITE_NAME,
@@ -357,39 +364,45 @@ def manage_views(request):
 
 
 # @login_required(login_url='/login')
+@ona_settings_required
 def update_db(request):
-    parser = OdkParser()
-    is_first_login = parser.is_first_login()
-    are_ona_settings_saved = parser.are_ona_settings_saved()
-    if is_first_login is True or are_ona_settings_saved is False:
-        return system_settings(request)
+    parser = get_parser()
 
     try:
-        parser.update_sdss_db()
+        # only the submissions added or edited since the last sync are pulled, unless a full rebuild is asked for
+        full_rebuild = request.POST.get('full_rebuild') == 'true'
+        (no_synced, failed_forms) = sync_all_forms(parser, full_rebuild)
     except Exception as e:
         logging.error(traceback.format_exc())
         if settings.DEBUG: print(str(e))
         return HttpResponse(traceback.format_exc())
 
-    return HttpResponse(json.dumps({'error': False, 'message': 'Database updated'}))
+    if no_synced is None:
+        return HttpResponse(json.dumps({'error': False, 'message': 'Database updated'}))
+    message = 'Database updated. %d new or edited submissions' % no_synced
+    if failed_forms:
+        message += '. The forms %s could not be synced' % ', '.join(str(form_id) for form_id in failed_forms)
+    return HttpResponse(json.dumps({'error': False, 'message': message, 'failed_forms': failed_forms}))
 
 
 # @login_required(login_url='/login')
 def form_structure(request):
     # given a form id, get the structure for the form
-    parser = OdkParser()
-
-    is_first_login = parser.is_first_login()
-    if settings.USE_DB_SETTINGS:
-        are_ona_settings_saved = parser.are_ona_settings_saved()
-    # if is_first_login is True or are_ona_settings_saved is False:
-    #     return system_settings(request)
+    parser = get_parser()
 
     try:
-        form_id = int(request.POST['form_id'])
+        # the tree is fetched with GET so that the browser can revalidate its cached copy using the ETag
+        form_id = int(request.GET['form_id'] if 'form_id' in request.GET else request.POST['form_id'])
         if form_id == -1:
             return HttpResponse(json.dumps({'error': True, 'message': 'Please select a form to get the structure from'}))
-        structure = parser.get_form_structure_as_json(form_id)
+
+        etag = form_structures.etag(form_id)
+        if etag is not None and etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+        (structure, etag) = form_structures.get(parser, form_id)
     except KeyError as e:
         logging.error(traceback.format_exc())
         return HttpResponse(json.dumps({'error': True, 'message': str(e)}))
@@ -398,19 +411,17 @@ def form_structure(request):
         logging.debug(traceback.format_exc())
         return HttpResponse(json.dumps({'error': True, 'message': str(e)}))
 
-    return HttpResponse(json.dumps({'error': False, 'structure': structure}))
+    response = json_response({'error': False, 'structure': structure}, request, 'application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 # @login_required(login_url='/login')
+@ona_settings_required(db_settings_only=True)
 def download_data(request):
     # given the nodes, download the associated data
-    parser = OdkParser(None, None, settings.ONADATA_TOKEN)
-    is_first_login = parser.is_first_login()
-    
-    if settings.USE_DB_SETTINGS:
-        are_ona_settings_saved = parser.are_ona_settings_saved()
-        if is_first_login is True or are_ona_settings_saved is False:
-            return system_settings(request)
+    parser = get_parser(settings.ONADATA_TOKEN)
 
     try:
         data = json.loads(request.body)
@@ -418,16 +429,45 @@ def download_data(request):
         # data['filter'] = {}
         filters = data['filter_by'] if 'filter_by' in data else None
         nodes = data['nodes[]'] if 'nodes[]' in data else None
+        if data.get('async') is True:
+            return queue_export_job('get_data', data)
+
+        if 'since' in data:
+            # only the submissions added or edited after the cursor are exported. The manifest, with the next cursor, is
+            # fetched from export_manifest since it can be too large for a header
+            if data['format'] not in STREAMING_FORMATS:
+                raise Exception("The delta exports are only available as %s" % ', '.join(STREAMING_FORMATS.keys()))
+            pull_form_submissions(parser, data['form_id'])
+            (rows, filename, manifest) = delta_export(parser, data['form_id'], nodes, data['format'], data['since'], filters)
+            response = StreamingHttpResponse(rows, content_type=STREAMING_FORMATS[data['format']])
+            response['Content-Disposition'] = 'attachment; filename=%s' % filename
+            manifest_id = save_manifest(manifest)
+            response['X-Export-Manifest-Id'] = manifest_id
+            response['Link'] = '<%s?manifest_id=%s>; rel="manifest"' % (reverse('export_manifest'), manifest_id)
+            return response
+
+        # the downloads of a saved view are read from its materialized table, brought up to date first
+        rows = materialized_rows(parser, data['view_name'], filters) if data.get('view_name') else None
+
+        if data['format'] in STREAMING_FORMATS:
+            # the rows are written as they are merged, so nothing is saved or refreshed from the server
+            (rows, filename) = stream_export(parser, data['form_id'], nodes, data['format'], filters, rows=rows)
+            response = StreamingHttpResponse(rows, content_type=STREAMING_FORMATS[data['format']])
+            response['Content-Disposition'] = 'attachment; filename=%s' % filename
+            return response
+
+        if data['format'] in COLUMNAR_FORMATS:
+            (filename, content_type) = write_columnar_export(parser, data['form_id'], nodes, data['format'], filters, rows=rows)
+            return stream_file_response(filename, content_type)
+
+        if data['format'] == 'xlsx' and (rows is not None or data.get('action') != 'download_save'):
+            # saving a new view is left to the vendor parser, which saves it along with the export
+            return stream_file_response(write_xlsx_export(parser, data['form_id'], nodes, filters, rows=rows))
+
         res = parser.fetch_merge_data(data['form_id'], nodes, data['format'], data['action'], data['view_name'], None, True, settings.IS_DRY_RUN, filters)
 
         if res['is_downloadable'] is True:
-            filename = res['filename']
-            excel_file = open(filename, 'rb')
-            
-            response = HttpResponse(excel_file.read(), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-            response['Content-Disposition'] = 'attachment; filename=%s' % os.path.basename(filename)
-            response['Content-Length'] = os.path.getsize(filename)
-            os.remove(filename)
+            response = stream_file_response(res['filename'])
         else:
             response = HttpResponse(json.dumps({'error': False, 'message': res['message']}), content_type='text/json')
             response['Content-Message'] = json.dumps({'error': False, 'message': res['message']})
@@ -452,18 +492,11 @@ def download_dictionary(request):
     try:
         #download the dictionary
         data = json.loads(request.body)
-        parser = OdkParser(None, None, settings.ONADATA_TOKEN)
-        # make sure we have the structure defined
-        parser.get_form_structure_as_json(data['form_id'])
-        filename = parser.process_write_dictionary(data['form_id'])
-        excel_file = open(filename, 'rb')
+        if data.get('async') is True:
+            return queue_export_job('get_dictionary', data)
 
-        response = HttpResponse(excel_file.read(), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        response['Content-Disposition'] = 'attachment; filename=%s' % os.path.basename(filename)
-        response['Content-Length'] = os.path.getsize(filename)
-        os.remove(filename)
-
-        return response
+        parser = get_parser(settings.ONADATA_TOKEN)
+        return stream_file_response(write_form_dictionary(parser, data['form_id']))
 
     except Exception as e:
         sentry_ce()
@@ -471,33 +504,17 @@ def download_dictionary(request):
         response['Content-Message'] = json.dumps({'error': True, 'message': str(e)})
         return response
 
+@ona_settings_required(db_settings_only=True)
 def download_structure(request):
     # given the nodes, download the associated data
-    parser = OdkParser(None, None, settings.ONADATA_TOKEN)
-    is_first_login = parser.is_first_login()
-
-    if settings.USE_DB_SETTINGS:
-        are_ona_settings_saved = parser.are_ona_settings_saved()
-        if is_first_login is True or are_ona_settings_saved is False:
-            return system_settings(request)
+    parser = get_parser(settings.ONADATA_TOKEN)
 
     try:
         data = json.loads(request.body)
-        res = parser.get_form_structure_from_server(data['form_id'])
+        if data.get('async') is True:
+            return queue_export_job('get_structure', data)
 
-        if res['is_downloadable'] is True:
-            filename = res['filename']
-            excel_file = open(filename, 'rb')
-            
-            response = HttpResponse(excel_file.read(), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-            response['Content-Disposition'] = 'attachment; filename=%s' % os.path.basename(filename)
-            response['Content-Length'] = os.path.getsize(filename)
-            os.remove(filename)
-        else:
-            response = HttpResponse(json.dumps({'error': False, 'message': res['message']}), content_type='text/json')
-            response['Content-Message'] = json.dumps({'error': False, 'message': res['message']})
-
-        return response
+        return stream_file_response(write_form_structure(parser, data['form_id']))
     except KeyError as e:
         terminal.tprint(traceback.format_exc(), 'fail')
         terminal.tprint(str(e), 'fail')
@@ -511,29 +528,21 @@ def download_structure(request):
         response['Content-Message'] = json.dumps({'error': True, 'message': str(e)})
         return response
 
+@ona_settings_required(db_settings_only=True)
 def download_xlsform(request):
     # given the nodes, download the associated data
-    parser = OdkParser(None, None, settings.ONADATA_TOKEN)
-    is_first_login = parser.is_first_login()
-
-    if settings.USE_DB_SETTINGS:
-        are_ona_settings_saved = parser.are_ona_settings_saved()
-        if is_first_login is True or are_ona_settings_saved is False:
-            return system_settings(request)
+    parser = get_parser(settings.ONADATA_TOKEN)
 
     try:
         data = json.loads(request.body)
+        if data.get('async') is True:
+            return queue_export_job('get_xls_form', data)
+
         res = parser.get_form_structure_from_server(data['form_id'])
 
 
         if res['is_downloadable'] is True:
-            filename = res['filename']
-            excel_file = open(filename, 'rb')
-            
-            response = HttpResponse(excel_file.read(), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-            response['Content-Disposition'] = 'attachment; filename=%s' % os.path.basename(filename)
-            response['Content-Length'] = os.path.getsize(filename)
-            os.remove(filename)
+            response = stream_file_response(res['filename'])
         else:
             response = HttpResponse(json.dumps({'error': False, 'message': res['message']}), content_type='text/json')
             response['Content-Message'] = json.dumps({'error': False, 'message': res['message']})
@@ -552,16 +561,49 @@ def download_xlsform(request):
         response['Content-Message'] = json.dumps({'error': True, 'message': str(e)})
         return response
 
+def queue_export_job(kind, data):
+    # the export runs in the background, the client polls for its progress using the job id
+    job = export_jobs.submit(kind, data)
+    return return_json({'error': False, 'job_id': job.id, 'progress': job.progress()})
+
+
+def export_job_status(request):
+    job = export_jobs.get(request.GET.get('job_id'))
+    if job is None:
+        return return_json({'error': True, 'message': "The export job '%s' was not found!" % request.GET.get('job_id')}, request)
+
+    return return_json({'error': job.status == 'failed', 'progress': job.progress()}, request)
+
+
+def export_manifest(request):
+    manifest = get_manifest(request.GET.get('manifest_id'))
+    if manifest is None:
+        return return_json({'error': True, 'message': 'The export manifest was not found or has expired'}, request)
+
+    return return_json({'error': False, 'manifest': manifest}, request)
+
+
+def export_job_download(request):
+    job = export_jobs.get(request.GET.get('job_id'))
+    if job is None or job.status != 'done':
+        return return_json({'error': True, 'message': 'The export is not ready for download'}, request)
+
+    if job.filename is None:
+        return return_json({'error': False, 'message': job.message}, request)
+
+    # the file is kept until the job expires, so every client sharing the job can download it
+    if not os.path.exists(job.filename):
+        return return_json({'error': True, 'message': 'The export has expired, please export the data again'}, request)
+    if job.content_type is not None:
+        return stream_file_response(job.filename, job.content_type, delete=False)
+    return stream_file_response(job.filename, delete=False)
+
+
 # @login_required(login_url='/login')
+@ona_settings_required(db_settings_only=True)
 def download(request):
     # given the nodes, download the associated data
-    parser = OdkParser()
-    is_first_login = parser.is_first_login()
-
-    if settings.USE_DB_SETTINGS:
-        are_ona_settings_saved = parser.are_ona_settings_saved()
-        if is_first_login is True or are_ona_settings_saved is False:
-            return system_settings(request)
+    parser = get_parser()
 
     try:
         data = json.loads(request.body)
@@ -581,25 +623,37 @@ def download(request):
 
 
 # @login_required(login_url='/login')
+@ona_settings_required(db_settings_only=True)
 def refresh_forms(request):
     """
     Refresh the database with any new forms
     """
-    parser = OdkParser()
-    is_first_login = parser.is_first_login()
-
-    if settings.USE_DB_SETTINGS:
-        are_ona_settings_saved = parser.are_ona_settings_saved()
-        if is_first_login is True or are_ona_settings_saved is False:
-            return system_settings(request)
+    parser = get_parser()
 
     try:
-        # when refreshing the forms, dont process the groups but auto-create the form groups
-        all_forms = parser.refresh_forms(False, True)
-    except Exception:
+        # the form list is fetched with a single request, then the metadata and structure of each form are fetched in
+        # parallel
+        form_ids = list_ona_forms(parser)
+        form_structures.invalidate()
+    except Exception as e:
         logging.error(traceback.format_exc())
+        return HttpResponse(json.dumps({'error': True, 'message': 'There was an error while refreshing the forms: %s' % str(e)}))
+
+    if request.GET.get('stream') == 'true':
+        # send each form's outcome as a json line as soon as it finishes
+        return StreamingHttpResponse(refresh_forms_stream(parser, form_ids), content_type='application/x-ndjson')
+
+    results = list(refresh_ona_forms(parser, form_ids))
+    # the local form catalogue read by the download and mappings pages is rebuilt before the page reloads the forms
+    all_forms = form_catalogue.refresh(parser, True).forms
+    return HttpResponse(json.dumps({'error': False, 'all_forms': all_forms, 'failed_forms': [result for result in results if result['error']]}))
 
-    return HttpResponse(json.dumps({'error': False, 'all_forms': all_forms}))
+
+def refresh_forms_stream(parser, form_ids):
+    yield json.dumps({'error': False, 'no_forms': len(form_ids)}) + '\n'
+    for result in refresh_ona_forms(parser, form_ids):
+        yield json.dumps(result) + '\n'
+    yield json.dumps({'error': False, 'all_forms': form_catalogue.refresh(parser, True).forms, 'no_forms': len(form_ids)}) + '\n'
 
 
 @login_required(login_url='/login')
@@ -712,25 +766,22 @@ def get_or_create_csrf_token(request):
     return token
 
 
+@ona_settings_required
 def manage_mappings(request):
     csrf_token = get_or_create_csrf_token(request)
 
-    parser = OdkParser()
-    is_first_login = parser.is_first_login()
-    are_ona_settings_saved = parser.are_ona_settings_saved()
-    if is_first_login is True or are_ona_settings_saved is False:
-        return system_settings(request)
-
-    all_forms = parser.get_all_forms()
-    (db_tables, tables_columns) = parser.get_db_tables()
+    parser = get_parser()
+    all_forms = form_catalogue.get_all_forms(parser)
+    # only the tables are sent with the page, the columns of a table are fetched when it is selected
+    catalogue = schema_catalogue.get(parser, request.GET.get('refresh_schema') == 'true')
     mappings = parser.mapping_info()
 
     page_settings = {
         'page_title': "%s | Home" % settings.SITE_NAME,
         'csrf_token': csrf_token,
         'section_title': 'Manage ODK and Database Mappings',
-        'db_tables': json.dumps(db_tables),
-        'tables_columns': json.dumps(tables_columns),
+        'db_tables': json.dumps(catalogue['tables']),
+        'schema_built_at': catalogue['built_at'],
         'all_forms': json.dumps(all_forms),
         'site_name': settings.SITE_NAME,
         'mappings': json.dumps(mappings)
@@ -738,79 +789,107 @@ def manage_mappings(request):
     return render(request, 'manage_mappings.html', page_settings)
 
 
+def table_columns(request):
+    parser = get_parser()
+    table_id = request.GET['table_id']
+    columns = schema_catalogue.table_columns(parser, table_id)
+
+    return return_json({'error': False, 'table_id': table_id, 'columns': columns}, request)
+
+
+def refresh_schema(request):
+    parser = get_parser()
+    catalogue = schema_catalogue.get(parser, True)
+    mapping_plans.invalidate()
+
+    return return_json({'error': False, 'tables': catalogue['tables'], 'built_at': catalogue['built_at']}, request)
+
+
 def edit_mapping(request):
-    parser = OdkParser()
+    parser = get_parser()
     if (request.get_full_path() == '/edit_mapping/'):
         response = parser.edit_mapping(request)
+        mapping_plans.invalidate()
 
     return HttpResponse(json.dumps(response))
 
 
 def create_mapping(request):
-    parser = OdkParser()
+    parser = get_parser()
     mappings = parser.save_mapping(request)
-    return return_json(mappings)
+    mapping_plans.invalidate()
+    return return_json(mappings, request)
 
 
 def delete_mapping(request):
-    parser = OdkParser()
+    parser = get_parser()
     mappings = parser.delete_mapping(request)
-    return return_json(mappings)
+    mapping_plans.invalidate()
+    return return_json(mappings, request)
 
 
 def clear_mappings(request):
-    parser = OdkParser()
+    parser = get_parser()
     mappings = parser.clear_mappings()
-    return return_json(mappings)
+    mapping_plans.invalidate()
+    return return_json(mappings, request)
 
 
-def return_json(mappings):
-    to_return = json.dumps(mappings)
-    response = HttpResponse(to_return, content_type='text/json')
-    response['Content-Message'] = to_return
-    return response
+def return_json(mappings, request=None):
+    return json_response(mappings, request)
 
 
-def return_polygons(mappings):
-    to_return = json.dumps(mappings)
-    response = HttpResponse(to_return)
-    response['Content-Type'] = 'application/json'
-    response['Content-Message'] = to_return
-    return response
+def return_polygons(mappings, request=None):
+    return json_response(mappings, request, 'application/json')
 
 
 def validate_mappings(request):
-    parser = OdkParser()
-    (is_fully_mapped, is_mapping_valid, comments) = parser.validate_mappings()
+    parser = get_parser()
+    (is_fully_mapped, is_mapping_valid, comments) = mapping_plans.validation(parser)
 
     to_return = {'error': False, 'is_fully_mapped': is_fully_mapped, 'is_mapping_valid': is_mapping_valid, 'comments': comments}
-    return return_json(to_return)
+    return return_json(to_return, request)
 
 
 def manual_data_process(request):
-    parser = OdkParser()
+    parser = get_parser()
     is_dry_run = json.loads(request.POST['is_dry_run'])
-    (is_success, comments) = parser.manual_process_data(is_dry_run)
-
-    to_return = {'error': is_success, 'comments': comments}
-    return return_json(to_return)
+    use_bulk_loader = json.loads(request.POST['bulk_load']) if 'bulk_load' in request.POST else getattr(settings, 'USE_BULK_LOADER', False)
+
+    if 'parallel' in request.POST and json.loads(request.POST['parallel']):
+        # the job is queued for the process_submissions command, which processes the submissions in partitions across
+        # a pool of worker processes. The progress of the partitions is shown in the processing status
+        form_ids = json.loads(request.POST['form_ids']) if 'form_ids' in request.POST else None
+        job = export_jobs.submit('process_submissions', {'is_dry_run': is_dry_run, 'form_ids': form_ids})
+        return return_json({'error': False, 'job_id': job.id, 'progress': job.progress()}, request)
+
+    load_stats = None
+    if use_bulk_loader:
+        form_ids = json.loads(request.POST['form_ids']) if 'form_ids' in request.POST else None
+        submissions = RawSubmissions.objects.filter(form_id__in=form_ids) if form_ids is not None else None
+        (is_success, comments, load_stats) = bulk_process_submissions(parser, is_dry_run, submissions)
+    else:
+        # only the bulk loader uses the compiled mapping plan, the parser reads the mappings itself
+        (is_success, comments) = parser.manual_process_data(is_dry_run)
+    invalidate_grid('processing_errors')
+    invalidate_grid('processing_status')
+
+    to_return = {'error': is_success, 'comments': comments, 'load_stats': load_stats}
+    return return_json(to_return, request)
 
 
 def delete_processed_data(request):
-    parser = OdkParser()
+    parser = get_parser()
     (is_success, comments) = parser.delete_processed_data()
+    invalidate_grid('processing_errors')
+    invalidate_grid('processing_status')
 
     to_return = {'error': is_success, 'comments': comments}
-    return return_json(to_return)
+    return return_json(to_return, request)
 
 
+@ona_settings_required
 def processing_errors(request):
-    parser = OdkParser()
-    is_first_login = parser.is_first_login()
-    are_ona_settings_saved = parser.are_ona_settings_saved()
-    if is_first_login is True or are_ona_settings_saved is False:
-        return system_settings(request)
-
     csrf_token = get_or_create_csrf_token(request)
     page_settings = {
         'page_title': "%s | Processing Errors" % settings.SITE_NAME,
@@ -822,82 +901,106 @@ def processing_errors(request):
 
 
 def fetch_processing_errors(request):
-    cur_page = json.loads(request.GET['page'])
-    per_page = json.loads(request.GET['perPage'])
-    offset = json.loads(request.GET['offset'])
-    sorts = json.loads(request.GET['sorts']) if 'sorts' in request.GET else None
-    queries = json.loads(request.GET['queries']) if 'queries' in request.GET else None
-
-    parser = OdkParser()
-    (is_success, proc_errors) = parser.processing_errors(cur_page, per_page, offset, sorts, queries)
-    to_return = json.dumps(proc_errors)
-
-    response = HttpResponse(to_return, content_type='text/json')
-    response['Content-Message'] = to_return
-    return response
+    # the errors are read from their table with seek pagination instead of paging through the parser
+    proc_errors = processing_errors_grid.fetch(GridParams(request))
+    return return_json(proc_errors, request)
 
 
 def fetch_single_error(request):
     err_id = json.loads(request.POST['err_id'])
-    parser = OdkParser()
+    parser = get_parser()
     (is_success, cur_error, r_sub) = parser.fetch_single_error(err_id)
 
     to_return = {'error': is_success, 'err_json': cur_error, 'raw_submission': r_sub}
-    return return_json(to_return)
+    return return_json(to_return, request)
 
 
+@ona_settings_required
 def map_visualization(request):
     csrf_token = get_or_create_csrf_token(request)
-    parser = OdkParser()
-    is_first_login = parser.is_first_login()
-    are_ona_settings_saved = parser.are_ona_settings_saved()
-    if is_first_login is True or are_ona_settings_saved is False:
-        return system_settings(request)
-
+    parser = get_parser()
     map_settings = parser.fetch_base_map_settings()
     page_settings = {
         'page_title': "%s | Map Based Visualizations" % settings.SITE_NAME,
         'csrf_token': csrf_token,
         'map_title': 'Map Based Visualization',
         'section_title': 'Map Based Visualization',
-        'map_settings': json.dumps(map_settings)
+        'map_settings': json.dumps(map_settings),
+        'forms': list(ODKForm.objects.order_by('form_name').values('form_id', 'form_name'))
     }
     return render(request, 'map_visualizations.html', page_settings)
 
 
 def first_level_geojson(request):
-    parser = OdkParser()
+    parser = get_parser()
     c_code = json.loads(request.GET['c_code'])
+    if 'zoom' in request.GET:
+        # geometries simplified for the map's zoom level, precomputed and cached on disk
+        return compressed_response(geo.first_level_geojson(parser, int(c_code), request.GET['zoom']), request, 'application/json')
+
     cur_polygons = parser.first_level_geojson(int(c_code))
+    return return_polygons(cur_polygons, request)
+
 
-    return HttpResponse(json.dumps(cur_polygons), content_type='application/json')
+def map_aggregates(request):
+    try:
+        parser = get_parser()
+        form_id = json.loads(request.GET['form_id'])
+        by = request.GET.get('by', 'geohash')
+        c_code = int(request.GET['c_code']) if 'c_code' in request.GET else None
+        # the map asks for the cells fitting its zoom level, other callers can give the precision itself
+        precision = geo.zoom_geohash_precision(request.GET['zoom']) if 'zoom' in request.GET else request.GET.get('precision', 5)
+        # the submissions saved by the parser are indexed before their points are aggregated
+        index_missing_submissions(form_id)
+        cells = geo.submission_aggregates(parser, form_id, by, precision, c_code)
+
+        return return_json({'error': False, 'by': by, 'cells': cells}, request)
+    except KeyError as e:
+        return return_json({'error': True, 'message': 'Missing parameter %s' % str(e)}, request)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        return return_json({'error': True, 'message': 'There was an error while aggregating the submissions. %s' % str(e)}, request)
 
 
 def save_json_edits(request):
     err_id = json.loads(request.POST['err_id'])
-    parser = OdkParser()
-    (is_error, cur_error) = parser.save_json_edits(err_id, json.loads(request.POST['json_data']))
+    parser = get_parser()
+    json_data = json.loads(request.POST['json_data'])
+    (is_error, cur_error) = parser.save_json_edits(err_id, json_data)
+    invalidate_grid('processing_errors')
+    # the edited submission is merged again the next time it is viewed, and indexed again in case the parser saved
+    # it without the model signals
+    uuid = json_data.get('_uuid') if isinstance(json_data, dict) else None
+    submissions_cache.invalidate(uuid)
+    if uuid is not None:
+        index_submissions(list(RawSubmissions.objects.filter(uuid=uuid).only('id', 'form_id', 'uuid', 'raw_data')))
 
     to_return = {'error': is_error, 'message': cur_error}
-    return return_json(to_return)
+    return return_json(to_return, request)
 
 
 def process_single_submission(request):
     err_id = json.loads(request.POST['err_id'])
-    parser = OdkParser()
+    parser = get_parser()
     (is_error, cur_error) = parser.process_single_submission(err_id)
+    invalidate_grid('processing_errors')
+    invalidate_grid('processing_status')
 
     to_return = {'error': is_error, 'message': cur_error}
-    return return_json(to_return)
+    return return_json(to_return, request)
 
 
-def processing_status(request):
-    parser = OdkParser()
-    is_first_login = parser.is_first_login()
-    are_ona_settings_saved = parser.are_ona_settings_saved()
-    if is_first_login is True or are_ona_settings_saved is False:
-        return system_settings(request)
+def reprocess_errors(request):
+    # reprocesses all the errors matching the filter in the background, the client polls for the progress of the job
+    queries = json.loads(request.POST['queries']) if 'queries' in request.POST else None
+    err_codes = json.loads(request.POST['err_codes']) if 'err_codes' in request.POST else None
+    job = export_jobs.submit('reprocess_errors', {'queries': queries, 'err_codes': err_codes})
+
+    return return_json({'error': False, 'job_id': job.id, 'progress': job.progress()}, request)
+
 
+@ona_settings_required
+def processing_status(request):
     csrf_token = get_or_create_csrf_token(request)
     page_settings = {
         'page_title': "%s | Processing Status" % settings.SITE_NAME,
@@ -909,25 +1012,20 @@ def processing_status(request):
 
 
 def fetch_processing_status(request):
-    cur_page = json.loads(request.GET['page'])
-    per_page = json.loads(request.GET['perPage'])
-    offset = json.loads(request.GET['offset'])
-    sorts = json.loads(request.GET['sorts']) if 'sorts' in request.GET else None
-    queries = json.loads(request.GET['queries']) if 'queries' in request.GET else None
-
-    parser = OdkParser()
-    (is_success, proc_errors) = parser.fetch_processing_status(cur_page, per_page, offset, sorts, queries)
-    to_return = json.dumps(proc_errors)
-
-    response = HttpResponse(to_return, content_type='text/json')
-    response['Content-Message'] = to_return
-    return response
+    parser = get_parser()
+    proc_status = fetch_grid_page('processing_status', GridParams(request), parser.fetch_processing_status)
+
+    # the progress of the latest partitioned run changes while it runs, so it is added after the cached page
+    job = export_jobs.latest('process_submissions')
+    if isinstance(proc_status, dict):
+        proc_status = dict(proc_status, processing_run=None if job is None else job.progress())
+    return return_json(proc_status, request)
 
 
 def system_settings(request):
     csrf_token = get_or_create_csrf_token(request)
 
-    parser = OdkParser()
+    parser = get_parser()
     all_settings = parser.get_all_settings()
 
     page_settings = {
@@ -944,19 +1042,17 @@ def save_settings(request):
     # saves the settings as pased from the front end
     csrf_token = get_or_create_csrf_token(request)
 
-    parser = OdkParser()
+    parser = get_parser()
     result = parser.save_settings(request)
+    # the settings gate is rechecked and the parsers rebuilt with the new settings on the next request
+    invalidate_settings_gate()
+    parser_registry.reset()
 
-    return return_json(result)
+    return return_json(result, request)
 
 
+@ona_settings_required
 def forms_settings(request):
-    parser = OdkParser()
-    is_first_login = parser.is_first_login()
-    are_ona_settings_saved = parser.are_ona_settings_saved()
-    if is_first_login is True or are_ona_settings_saved is False:
-        return system_settings(request)
-
     csrf_token = get_or_create_csrf_token(request)
 
     page_settings = {
@@ -969,107 +1065,97 @@ def forms_settings(request):
 
 
 def forms_settings_info(request):
-    cur_page = json.loads(request.GET['page'])
-    per_page = json.loads(request.GET['perPage'])
-    offset = json.loads(request.GET['offset'])
-    sorts = json.loads(request.GET['sorts']) if 'sorts' in request.GET else None
-    queries = json.loads(request.GET['queries']) if 'queries' in request.GET else None
-
-    parser = OdkParser()
-    (is_success, proc_errors) = parser.get_odk_forms_info(cur_page, per_page, offset, sorts, queries)
-    to_return = json.dumps(proc_errors)
-
-    response = HttpResponse(to_return, content_type='text/json')
-    response['Content-Message'] = to_return
-    return response
+    parser = get_parser()
+    proc_errors = fetch_grid_page('forms_settings', GridParams(request), parser.get_odk_forms_info)
+    return return_json(proc_errors, request)
 
 
 def fetch_form_details(request):
     form_id = json.loads(request.POST['form_id'])
-    parser = OdkParser()
+    parser = get_parser()
     (is_error, cur_form) = parser.fetch_form_details(form_id)
     (is_error1, all_groups) = parser.fetch_form_groups()
 
     if is_error is True or is_error1 is True:
-        return return_json({'error': True, 'message': 'There was an error while fetching data from the database.'})
+        return return_json({'error': True, 'message': 'There was an error while fetching data from the database.'}, request)
 
     to_return = {'error': False, 'form_details': cur_form, 'form_groups': all_groups}
-    return return_json(to_return)
+    return return_json(to_return, request)
 
 
 def save_form_details(request):
-    parser = OdkParser()
+    parser = get_parser()
     (is_error, cur_form) = parser.save_form_details(request)
+    invalidate_grid('forms_settings')
+    form_catalogue.invalidate()
 
     if is_error is True:
-        return return_json({'error': True, 'message': 'There was an error while fetching data from the database.'})
+        return return_json({'error': True, 'message': 'There was an error while fetching data from the database.'}, request)
 
     (is_success, form_settings) = parser.get_odk_forms_info(1, 10, 0, None, None)
 
-    return return_json({'error': False, 'form_settings': form_settings})
+    return return_json({'error': False, 'form_settings': form_settings}, request)
 
 
 def form_groups_info(request):
-    cur_page = json.loads(request.GET['page'])
-    per_page = json.loads(request.GET['perPage'])
-    offset = json.loads(request.GET['offset'])
-    sorts = json.loads(request.GET['sorts']) if 'sorts' in request.GET else None
-    queries = json.loads(request.GET['queries']) if 'queries' in request.GET else None
-
-    parser = OdkParser()
-    (is_success, proc_errors) = parser.get_form_groups_info(cur_page, per_page, offset, sorts, queries)
-    to_return = json.dumps(proc_errors)
-
-    response = HttpResponse(to_return, content_type='text/json')
-    response['Content-Message'] = to_return
-    return response
+    parser = get_parser()
+    proc_errors = fetch_grid_page('form_groups', GridParams(request), parser.get_form_groups_info)
+    return return_json(proc_errors, request)
 
 
 def save_group_details(request):
-    parser = OdkParser()
+    parser = get_parser()
     (is_error, cur_group) = parser.save_group_details(request)
+    invalidate_grid('form_groups')
+    form_catalogue.invalidate()
 
     if is_error is True:
-        return return_json({'error': True, 'message': 'There was an error while fetching data from the database.'})
+        return return_json({'error': True, 'message': 'There was an error while fetching data from the database.'}, request)
 
     (is_success, group_settings) = parser.get_form_groups_info(1, 10, 0, None, None)
 
-    return return_json({'error': False, 'group_settings': group_settings})
+    return return_json({'error': False, 'group_settings': group_settings}, request)
 
 
 def refresh_view_data(request):
-    parser = OdkParser()
+    parser = get_parser()
 
     try:
         form_view = FormViews.objects.filter(id=request.POST['view_id'])
-        # form_view = FormViews.objects.filter(id='265')
         if form_view.count() == 0:
-            return return_json({'error': True, 'message': "The view with the id '%s' was not found!" % request.POST['view_id']})
+            return return_json({'error': True, 'message': "The view with the id '%s' was not found!" % request.POST['view_id']}, request)
 
         form_view = form_view[0]
-        odk_form = ODKForm.objects.get(id=form_view.form_id)
-        # form_id, nodes, d_format, download_type, view_name, uuids=None, update_local_data=True, is_dry_run=True
-        res = parser.fetch_merge_data(odk_form.form_id, form_view.structure, None, 'submissions', form_view.view_name, None, True, settings.IS_DRY_RUN)
-
-        return return_json({'error': False, 'message': "The view '%s' has been updated successfully. Current total records %d" % (form_view.view_name, len(res))})
+        full_rebuild = request.POST.get('full_rebuild') == 'true'
+        if request.POST.get('async') == 'true':
+            job = export_jobs.submit('refresh_view', {'view_id': form_view.id, 'full_rebuild': full_rebuild})
+            return return_json({'error': False, 'job_id': job.id, 'progress': job.progress()}, request)
+
+        mat_view = refresh_materialized_view(parser, form_view, full_rebuild)
+        if mat_view is None:
+            return return_json({'error': True, 'message': "The view '%s' is already being refreshed" % form_view.view_name}, request)
+        if mat_view.last_refresh_error is not None:
+            return return_json({'error': True, 'message': "There was an error while refreshing the saved views data. '%s'" % mat_view.last_refresh_error}, request)
+
+        if full_rebuild:
+            return return_json({'error': False, 'message': "The view '%s' has been rebuilt successfully. Current total records %d" % (form_view.view_name, mat_view.no_records)}, request)
+        return return_json({'error': False, 'message': "The view '%s' has been updated successfully. %d new or edited records, %d records in total" % (form_view.view_name, mat_view.last_refresh_records, mat_view.no_records)}, request)
     except Exception as e:
-        return return_json({'error': True, 'message': "There was an error while refreshing the saved views data. '%s'" % str(e)})
+        return return_json({'error': True, 'message': "There was an error while refreshing the saved views data. '%s'" % str(e)}, request)
 
 
-def zip_response(json_data):
-    gzip_buffer = IO()
-    gzip_file = gzip.GzipFile(mode='wb', fileobj=gzip_buffer)
-    gzip_file.write(json_data)
-    gzip_file.close()
+def save_view_schedule(request):
+    # sets how often a saved view is refreshed in the background, an empty interval stops the scheduled refreshes
+    form_view = FormViews.objects.filter(id=request.POST['view_id']).first()
+    if form_view is None:
+        return return_json({'error': True, 'message': "The view with the id '%s' was not found!" % request.POST['view_id']}, request)
 
-    response = HttpResponse(content_type='application/json')
+    mat_view = materialized_view(form_view)
+    mat_view.refresh_interval = int(request.POST['refresh_interval']) if request.POST.get('refresh_interval') else None
+    mat_view.save(update_fields=['refresh_interval'])
 
-    response.data = gzip_buffer.getvalue()
-    response.headers['Content-Encoding'] = 'gzip'
-    response.headers['Vary'] = 'Accept-Encoding'
-    response.headers['Content-Length'] = len(response.data)
+    return return_json({'error': False, 'message': "The refresh schedule of the view '%s' has been saved" % form_view.view_name}, request)
 
-    return response
 
 def record_viewer(request):
     csrf_token = get_or_create_csrf_token(request)
@@ -1082,45 +1168,62 @@ def record_viewer(request):
     return render(request, 'record_viewer.html', page_settings)
 
 
+def metrics(request):
+    # the per view totals of this process in the prometheus text format, for the scraper with the bearer token or for
+    # staff users. Without a token set only staff users can read them
+    metrics_token = getattr(settings, 'METRICS_TOKEN', None)
+    has_token = metrics_token is not None and request.META.get('HTTP_AUTHORIZATION') == 'Bearer %s' % metrics_token
+    if not has_token and not (request.user.is_authenticated and request.user.is_staff):
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+
+    return HttpResponse(view_metrics.prometheus_text(), content_type='text/plain; version=0.0.4')
+
+
 def submissions_search(request):
     try:
         s_query = request.GET.get('query')
-        submissions = RawSubmissions.objects.select_related('form').filter(raw_data__icontains=s_query).values('submission_time', 'form__form_name', 'id').all()
+        submissions = search_submissions(s_query)
 
         to_return = []
-        upper_limit = 10
-        i = 0
         for subm in submissions:
-            i += 1
             to_return.append({'data': subm['id'], 'value': "%s - %s" % (subm['form__form_name'], subm['submission_time']) })
 
-            if i == upper_limit: break
-
-        return return_json({'error': False, 'query': s_query, 'suggestions': to_return})
+        return return_json({'error': False, 'query': s_query, 'suggestions': to_return}, request)
 
     except Exception as e:
-        return return_json( {'error': True, 'message': 'There was an error while fetching the searching the submissions. %s' % str(e)} )
+        return return_json( {'error': True, 'message': 'There was an error while fetching the searching the submissions. %s' % str(e)}, request)
 
 
 def fetch_submission(request):
     try:
         subm_id= request.POST.get('subm_id')
-        odk_parser = OdkParser(None, None, None)
-        cur_submission = RawSubmissions.objects.select_related('form').values('form__form_id', 'uuid', 'raw_data').get(id=subm_id)
+        odk_parser = get_parser()
+        cur_submission = RawSubmissions.objects.select_related('form').values('id', 'form_id', 'form__form_id', 'uuid', 'raw_data').get(id=subm_id)
         # this_submissions = self.odk_parser.fetch_merge_data(form_id, None, 'json', 'submissions', None, None, True, True, None)
         # this_submissions = self.get_form_submissions_as_json(int(form_id), nodes, uuids, update_local_data, is_dry_run, submission_filters)
         
         # this_submission = odk_parser.get_form_submissions_as_json(cur_submission['form__form_id'], None, [cur_submission['uuid']], False, True, None)
 
-        this_submission = odk_parser.fetch_merge_data(cur_submission['form__form_id'], None, 'json', 'submissions', None, [cur_submission['uuid']], False, False, None)
+        # clicking back and forth through the records reuses the submissions merged before, and once the user is
+        # clicking through them the records either side of the submission are merged along with it
+        no_neighbours = getattr(settings, 'RECORD_VIEWER_PREFETCH', 5)
+        form_submissions = RawSubmissions.objects.filter(form_id=cur_submission['form_id'])
+        neighbours = list(form_submissions.filter(id__lt=cur_submission['id']).order_by('-id').values_list('uuid', 'raw_data')[:no_neighbours])
+        neighbours += list(form_submissions.filter(id__gt=cur_submission['id']).order_by('id').values_list('uuid', 'raw_data')[:no_neighbours])
+        this_submission = submissions_cache.get_or_merge(
+            (cur_submission['uuid'], cur_submission['raw_data']), neighbours,
+            lambda uuids: odk_parser.fetch_merge_data(cur_submission['form__form_id'], None, 'json', 'submissions', None, uuids, False, False, None)
+        )
+        if this_submission is None:
+            return return_json({'error': True, 'message': "The submission '%s' could not be merged into a record" % cur_submission['uuid']}, request)
 
-        # terminal.tprint(json.dumps(this_submission[0]), 'debug')
+        # terminal.tprint(json.dumps(this_submission), 'debug')
 
-        return return_json({'error': False, 'submission': this_submission[0], 'raw_submission': cur_submission['raw_data']})
+        return return_json({'error': False, 'submission': this_submission, 'raw_submission': cur_submission['raw_data']}, request)
 
     except Exception as e:
         if settings.DEBUG: terminal.tprint(str(e), 'fail')
         sentry.captureException()
-        return return_json({'error': True, 'message': "There was an error while fetching the submission from the server."})
+        return return_json({'error': True, 'message': "There was an error while fetching the submission from the server."}, request)
 
 